@@ -0,0 +1,206 @@
+import json
+from datetime import datetime, timezone
+from os.path import exists
+
+import utils
+from config import params
+from database import Database
+from metadata import intern
+
+SCHEMA: list = [
+    '''CREATE TABLE IF NOT EXISTS battles (
+        "id" TEXT PRIMARY KEY NOT NULL,
+        "username" TEXT NOT NULL,
+        "splatnet_id" TEXT NOT NULL,
+        "played_time" INTEGER NOT NULL,
+        "duration" INTEGER,
+        "mode" TEXT,
+        "rule" TEXT,
+        "stage" TEXT,
+        "weapon" TEXT,
+        "result" TEXT,
+        "knockout" TEXT,
+        "kill" INTEGER,
+        "assist" INTEGER,
+        "death" INTEGER,
+        "special" INTEGER,
+        "paint" INTEGER,
+        "payload" TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS players (
+        "battle_id" TEXT NOT NULL REFERENCES battles(id) ON DELETE CASCADE,
+        "team" INTEGER NOT NULL,
+        "position" INTEGER NOT NULL,
+        "is_myself" INTEGER NOT NULL,
+        "name" TEXT,
+        "name_id" TEXT,
+        "species" TEXT,
+        "weapon" TEXT,
+        "kill" INTEGER,
+        "assist" INTEGER,
+        "death" INTEGER,
+        "special" INTEGER,
+        "paint" INTEGER,
+        "disconnected" INTEGER NOT NULL,
+        PRIMARY KEY (battle_id, team, position)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS gear (
+        "battle_id" TEXT NOT NULL REFERENCES battles(id) ON DELETE CASCADE,
+        "team" INTEGER NOT NULL,
+        "position" INTEGER NOT NULL,
+        "slot" TEXT NOT NULL,
+        "name" TEXT,
+        "primary_ability" TEXT,
+        "secondary_abilities" TEXT,
+        PRIMARY KEY (battle_id, team, position, slot)
+    )''',
+    'CREATE INDEX IF NOT EXISTS battles_played_time ON battles (username, played_time)',
+    'CREATE INDEX IF NOT EXISTS battles_mode ON battles (username, mode)',
+    'CREATE INDEX IF NOT EXISTS battles_rule ON battles (username, rule)',
+    'CREATE INDEX IF NOT EXISTS battles_stage ON battles (username, stage)',
+    'CREATE INDEX IF NOT EXISTS battles_weapon ON battles (username, weapon)',
+    'CREATE INDEX IF NOT EXISTS players_weapon ON players (weapon)',
+]
+
+_POWER = ("COALESCE(json_extract(payload, '$.data.vsHistoryDetail.xMatch.lastXPower'), "
+          "json_extract(payload, '$.data.vsHistoryDetail.bankaraMatch.bankaraPower.power'), "
+          "json_extract(payload, '$.data.vsHistoryDetail.festMatch.myFestPower'))")
+
+BATTLE_COLUMNS: tuple = ('id', 'played_time', 'duration', 'mode', 'rule', 'stage', 'weapon', 'result', 'knockout',
+                         'kill', 'assist', 'death', 'special', 'paint', 'power')
+BATTLE_QUERY: str = (f"SELECT {', '.join(BATTLE_COLUMNS[:-1])}, {_POWER} FROM battles "
+                     "WHERE username=? ORDER BY played_time")
+
+PLAYER_COLUMNS: tuple = ('battle_id', 'played_time', 'mode', 'rule', 'stage', 'result', 'team', 'position', 'is_myself',
+                         'name', 'name_id', 'species', 'weapon', 'kill', 'assist', 'death', 'special', 'paint', 'disconnected')
+PLAYER_QUERY: str = ("SELECT p.battle_id, b.played_time, b.mode, b.rule, b.stage, b.result, p.team, p.position, p.is_myself, "
+                     "p.name, p.name_id, p.species, p.weapon, p.kill, p.assist, p.death, p.special, p.paint, p.disconnected "
+                     "FROM players p JOIN battles b ON b.id = p.battle_id WHERE b.username=? ORDER BY b.played_time, p.team, p.position")
+
+# columns the analytics queries may group by, so they never get built from user input
+GROUPABLE: tuple = ('mode', 'rule', 'stage', 'weapon')
+
+class ArchiveDatabase(Database):
+    '''Opt-in local archive of vsHistoryDetail payloads, normalized into battles, players and gear tables.
+    Enabled with the `archive` config value. Stored in `archive_path` (archive.db by default).'''
+    def __init__(self, database_name: str | None = None):
+        self.database_name = database_name or params.get('archive_path', 'archive.db')
+        self.table_name = "battles"
+        self.migrations = [SCHEMA]
+        # reads don't create archive.db just to find it empty. other backends have nothing on disk to check
+        self._created = exists(self.database_name) or params.get('storage', 'sqlite') != 'sqlite'
+
+    async def store(self, username: str, battle_data: dict, raw: bytes | None = None) -> str:
+        '''Archives a view_battle response, replacing any earlier copy. Returns the battle's stat.ink uuid.
+        Pass the undecoded response body as `raw` to store it as-is instead of re-serializing `battle_data`.'''
+        data = battle_data['data']['vsHistoryDetail']
+        battle_id = await utils.decode_battle_id(data['id'])
+        teams = [data['myTeam'], *data['otherTeams']]
+        me = next((player for player in data['myTeam']['players'] if player['isMyself']), None)
+        played_time = int(datetime.strptime(data['playedTime'], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc).timestamp())
+        my_result = me['result'] if me is not None and me['result'] is not None else {}
+        battle_row = (
+            battle_id, username, data['id'], played_time, data.get('duration'),
+            intern(data['vsMode']['mode']), intern(data['vsRule']['rule']), intern(data['vsStage']['name']),
+            intern(me['weapon']['name']) if me is not None else None,
+            data['judgement'], data.get('knockout'),
+            my_result.get('kill'), my_result.get('assist'), my_result.get('death'), my_result.get('special'),
+            me['paint'] if me is not None else None,
+            raw.decode('utf-8') if raw is not None else json.dumps(battle_data, separators=(',', ':')),
+        )
+        player_rows, gear_rows = [], []
+        for team_index, team in enumerate(teams):
+            for position, player in enumerate(team['players'], start=1):
+                result = player['result'] or {}
+                player_rows.append((
+                    battle_id, team_index, position, int(bool(player['isMyself'])), player['name'], player['nameId'],
+                    intern(player['species']), intern(player['weapon']['name']),
+                    result.get('kill'), result.get('assist'), result.get('death'), result.get('special'),
+                    player['paint'], int(player['result'] is None),
+                ))
+                for slot, key in [('headgear', 'headGear'), ('clothing', 'clothingGear'), ('shoes', 'shoesGear')]:
+                    gear = player[key]
+                    gear_rows.append((
+                        battle_id, team_index, position, slot, intern(gear.get('name')), intern(gear['primaryGearPower']['name']),
+                        intern(','.join(ability['name'] for ability in gear['additionalGearPowers'])),
+                    ))
+        async with self as database:
+            await database.execute("DELETE FROM players WHERE battle_id=?", (battle_id,))
+            await database.execute("DELETE FROM gear WHERE battle_id=?", (battle_id,))
+            await database.execute(f"INSERT OR REPLACE INTO battles VALUES ({', '.join('?' * len(battle_row))})", battle_row)
+            await database.executemany("INSERT INTO players VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", player_rows)
+            await database.executemany("INSERT INTO gear VALUES (?, ?, ?, ?, ?, ?, ?)", gear_rows)
+            await database.commit()
+        self._created = True
+        return battle_id
+
+    async def get(self, battle_id: str) -> dict | None:
+        '''Returns the archived view_battle response for a stat.ink uuid, exactly as SplatNet sent it'''
+        if not self._created:
+            return None
+        async with self as database:
+            async with database.execute("SELECT payload FROM battles WHERE id=?", (battle_id,)) as cursor:
+                row = await cursor.fetchone()
+        return utils.json_loads(row[0]) if row is not None else None
+
+    async def battles(self, username: str, since: int | None = None, until: int | None = None) -> list:
+        '''Returns (id, played_time, mode, rule, stage, weapon, result) rows, newest first'''
+        if not self._created:
+            return []
+        async with self as database:
+            async with database.execute(
+                "SELECT id, played_time, mode, rule, stage, weapon, result FROM battles "
+                "WHERE username=? AND played_time>=? AND played_time<=? ORDER BY played_time DESC",
+                (username, since or 0, until if until is not None else 2**63 - 1)
+            ) as cursor:
+                return await cursor.fetchall()
+
+    async def iter_rows(self, username: str, per: str = 'battle'):
+        '''Yields one tuple per battle (or per player, with per='player'), oldest first, straight off the cursor.
+        Column names are in BATTLE_COLUMNS / PLAYER_COLUMNS.'''
+        if per not in ['battle', 'player']:
+            raise ValueError("per must be 'battle' or 'player'")
+        if not self._created:
+            return
+        query = BATTLE_QUERY if per == 'battle' else PLAYER_QUERY
+        async with self as database:
+            async with database.execute(query, (username,)) as cursor:
+                async for row in cursor:
+                    yield row
+
+    async def win_rates(self, username: str, by: str = 'weapon', mode: str | None = None) -> list:
+        '''Returns (key, wins, losses, win_rate) rows grouped by one of GROUPABLE, most played first'''
+        return await self._grouped(username, by, mode,
+            "SUM(result='WIN'), SUM(result IN ('LOSE', 'DEEMED_LOSE', 'EXEMPTED_LOSE')), "
+            "CAST(SUM(result='WIN') AS REAL) / NULLIF(SUM(result IN ('WIN', 'LOSE', 'DEEMED_LOSE', 'EXEMPTED_LOSE')), 0)")
+
+    async def kill_death(self, username: str, by: str = 'weapon', mode: str | None = None) -> list:
+        '''Returns (key, kills, deaths, kd) rows grouped by one of GROUPABLE, most played first'''
+        return await self._grouped(username, by, mode,
+            "SUM(kill), SUM(death), CAST(SUM(kill) AS REAL) / NULLIF(SUM(death), 0)")
+
+    async def _grouped(self, username: str, by: str, mode: str | None, aggregates: str) -> list:
+        if by not in GROUPABLE:
+            raise ValueError(f'Can only group by one of {GROUPABLE}')
+        if not self._created:
+            return []
+        query = f"SELECT {by}, {aggregates} FROM battles WHERE username=?"
+        arguments = [username]
+        if mode is not None:
+            query += " AND mode=?"
+            arguments.append(mode)
+        query += f" GROUP BY {by} ORDER BY COUNT(*) DESC"
+        async with self as database:
+            async with database.execute(query, arguments) as cursor:
+                return await cursor.fetchall()
+
+_archive: ArchiveDatabase | None = None
+
+def get_archive() -> ArchiveDatabase | None:
+    '''Returns the shared ArchiveDatabase, or None if archiving is turned off'''
+    global _archive
+    if not params.get('archive', False):
+        return None
+    if _archive is None:
+        _archive = ArchiveDatabase()
+    return _archive
@@ -0,0 +1,109 @@
+import asyncio, heapq, itertools, sys
+
+import dynamo, events, statink, utils
+from config import params
+from progress import Progress
+
+# SplatNet keeps this many battles in each history list (latest, and one per mode), dropping the oldest as new ones arrive
+WINDOW: int = 50
+MODES: list = ['latest', 'regular', 'bankara', 'x', 'event', 'private']
+
+class Budget:
+    '''A semaphore that hands free slots to the waiter with the lowest priority value, instead of the one that asked first'''
+    def __init__(self, slots: int) -> None:
+        self.free = slots
+        self.waiters = []
+        self.order = itertools.count()
+
+    async def acquire(self, priority) -> None:
+        if self.free > 0 and not self.waiters:
+            self.free -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.order), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release() # handed a slot just as it was cancelled, pass it on
+            raise
+
+    def release(self) -> None:
+        # on the next tick, so a task that releases and asks again right away competes for its own slot
+        asyncio.get_running_loop().call_soon(self._hand_off)
+
+    def _hand_off(self) -> None:
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.free += 1
+
+class Backfill:
+    '''Process-wide backfill state. Every backfill running at once (backfill, web, monitor --backfill) shares one budget.'''
+    budget: Budget | None = None
+
+def get_budget() -> Budget:
+    '''Returns the shared budget of `backfill_concurrency` uploads in flight, across every account'''
+    if Backfill.budget is None:
+        Backfill.budget = Budget(max(1, params.get('backfill_concurrency', 4)))
+    return Backfill.budget
+
+def slack(positions: list) -> int:
+    '''How many more battles can be played before one at these positions (0 = newest) in its lists drops out of all of them'''
+    return max(WINDOW - 1 - position for position in positions)
+
+async def discover(username: str) -> tuple[list, dict]:
+    '''Finds every battle stat.ink is missing across all modes. Returns (pending, all_battles),
+    where pending is (slack, played at, SplatNet id) tuples, oldest first.'''
+    positions, all_battles, missing = {}, {}, set()
+    for mode in MODES:
+        found, battles = await dynamo.find_missing_battles(username, mode)
+        missing.update(found)
+        for position, battle_id in enumerate(battles):
+            positions.setdefault(battle_id, []).append(position)
+        all_battles.update(battles)
+    pending = sorted(((slack(positions[battle_id]), utils.battle_played_at(all_battles[battle_id]), all_battles[battle_id]) for battle_id in missing),
+                     key=lambda battle: battle[1])
+    return pending, all_battles
+
+def priorities(pending: list) -> list:
+    '''The budget priority of each of an account's battles, uploaded oldest first: the least slack of it and every battle
+    after it, so an account's whole queue is ranked against other accounts by the battle of it closest to expiring'''
+    least, ranked = None, []
+    for remaining_slack, played_at, _ in reversed(pending):
+        least = remaining_slack if least is None else min(least, remaining_slack)
+        ranked.append((least, played_at))
+    return ranked[::-1]
+
+async def drain(username: str, pending: list) -> None:
+    '''Uploads one account's pending battles oldest first, so each battle's predecessor is already in previous_powers,
+    each waiting for a slot in the shared budget'''
+    budget, previous_powers = get_budget(), {}
+    for done, ((_, _, battle_id), priority) in enumerate(zip(pending, priorities(pending)), start=1):
+        await budget.acquire(priority)
+        try:
+            await statink.upload_battle(username, battle_id, previous_powers, missing=True)
+        except Exception as e:
+            print(f"Failed to upload a battle for {username}: {e!r}", file=sys.stderr)
+        finally:
+            budget.release()
+        events.emit('sync_progress', username=username, remaining=len(pending) - done)
+
+async def run(usernames: list) -> None:
+    '''Backfills every mode of several accounts at once. Accounts with battles closest to falling out of SplatNet's window
+    go first, with at most `backfill_concurrency` uploads in flight (one per account). Each account's battles go oldest first.'''
+    drains, discovered = [], {}
+    for username in usernames:
+        # each account starts uploading as soon as it's discovered, the budget sorts out who goes first from there
+        pending, discovered[username] = await discover(username)
+        # fields deferred on earlier polls, from the histories just fetched. new battles resolve theirs as they're formatted
+        await statink.resolve_deferred_fields(username)
+        events.emit('sync_started', username=username, queued=len(pending))
+        if not pending:
+            Progress.log("No missing battles found!")
+        drains.append(asyncio.create_task(drain(username, pending)))
+    await asyncio.gather(*drains)
+    for username, all_battles in discovered.items():
+        await dynamo.reupload_incomplete_battles(username, all_battles)
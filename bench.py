@@ -0,0 +1,351 @@
+#! /usr/bin/env python3
+# Small benchmarks for Dynamo. Run `python bench.py --help` for the list.
+
+import argparse, base64, glob, json, os, random, subprocess, sys
+from timeit import Timer
+
+def bench_importtime(args: argparse.Namespace) -> int:
+    """Imports `main` in a fresh interpreter with -X importtime and checks the total against a budget"""
+    env = {**os.environ, 'PYTHONDONTWRITEBYTECODE': '0'}
+    totals = []
+    for _ in range(args.runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {args.module}'],
+                                capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+        if result.returncode != 0:
+            print(result.stderr, file=sys.stderr)
+            return result.returncode
+        modules = []
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            # nesting is shown by indenting the name past its single separating space
+            modules.append((int(cumulative), name[1:].rstrip()))
+        # top level imports are the ones with no indentation
+        totals.append((sum(us for us, name in modules if not name.startswith(' ')), modules))
+    total, modules = min(totals, key=lambda t: t[0])
+    print(f"import {args.module}: {total / 1000:.1f}ms (best of {args.runs}, budget {args.budget}ms)")
+    for us, name in sorted(modules, reverse=True)[:args.top]:
+        print(f"  {us / 1000:8.1f}ms  {name.strip()}")
+    for heavy in ['aiohttp', 'aiosqlite', 'bs4', 'nest_asyncio']:
+        if any(name.strip() == heavy for _, name in modules):
+            print(f"  warning: {heavy} was imported eagerly")
+    return 0 if total / 1000 <= args.budget else 1
+
+def synthetic_battle(n: int = 0) -> dict:
+    """A vsHistoryDetail response shaped like SplatNet's, for when there are no recorded payloads to use"""
+    def gear(kind: str) -> dict:
+        return {
+            'name': f'{kind} #{random.randrange(300)}', 'image': {'url': 'https://example.invalid/' + 'a' * 64},
+            'primaryGearPower': {'name': 'Ink Saver (Main)', 'image': {'url': 'https://example.invalid/' + 'b' * 64}},
+            'additionalGearPowers': [{'name': random.choice(['Run Speed Up', 'Swim Speed Up', 'Unknown']),
+                                      'image': {'url': 'https://example.invalid/' + 'c' * 64}} for _ in range(3)],
+            'brand': {'name': 'Zink', 'id': 'QnJhbmQtMTk=', 'image': {'url': 'https://example.invalid/' + 'd' * 64}},
+        }
+    def player(i: int) -> dict:
+        return {
+            'id': base64.b64encode(f'VsPlayer-u-{n}:{i}'.encode()).decode(), 'isMyself': i == 0,
+            'name': f'Player{i}', 'nameId': f'{1000 + i}', 'byname': 'Fresh Squid', 'species': 'INKLING',
+            'nameplate': {'badges': [None, None, None], 'background': {'textColor': {'r': 1, 'g': 1, 'b': 1, 'a': 1}, 'id': 'TmFtZXBsYXRlQmFja2dyb3VuZC0x'}},
+            'weapon': {'name': random.choice(['Splattershot', 'Dynamo Roller', "N-ZAP '85", 'Splat Charger']), 'id': 'V2VhcG9uLTQw',
+                       'image': {'url': 'https://example.invalid/' + 'e' * 64}, 'specialWeapon': {'maskingImage': {'width': 1024, 'height': 1024}}},
+            'paint': random.randrange(1500), 'crown': False, 'festDragonCert': 'NONE',
+            'headGear': gear('Headgear'), 'clothingGear': gear('Clothing'), 'shoesGear': gear('Shoes'),
+            'result': {'kill': random.randrange(15), 'death': random.randrange(15), 'assist': random.randrange(5), 'special': random.randrange(6), 'noroshiTry': None},
+        }
+    raw_id = f'VsHistoryDetail-u-qwertyuiopasdfghjklz:RECENT:20240501T12{n // 60 % 60:02d}{n % 60:02d}_0123456789abcdef0123456789abcdef{n:08d}'
+    return {'data': {'vsHistoryDetail': {
+        '__typename': 'VsHistoryDetail', 'id': base64.b64encode(raw_id.encode()).decode(),
+        'vsRule': {'name': 'Turf War', 'id': 'VnNSdWxlLTA=', 'rule': 'TURF_WAR'}, 'vsMode': {'mode': 'REGULAR', 'id': 'VnNNb2RlLTE='},
+        'judgement': random.choice(['WIN', 'LOSE']), 'knockout': 'NEITHER', 'duration': 180,
+        'playedTime': f'2024-05-01T12:{n // 60 % 60:02d}:{n % 60:02d}Z', 'awards': [{'name': 'Top Splatter', 'rank': 'GOLD'}],
+        'vsStage': {'name': random.choice(['Scorch Gorge', 'Eeltail Alley']), 'id': 'VnNTdGFnZS0x', 'image': {'url': 'https://example.invalid/' + 'f' * 64}},
+        'myTeam': {'players': [player(i) for i in range(4)], 'color': {'r': 0.1, 'g': 0.2, 'b': 0.3, 'a': 1}, 'judgement': 'WIN',
+                   'result': {'paintRatio': 0.55, 'score': None, 'noroshi': None}, 'tricolorRole': None, 'festTeamName': None},
+        'otherTeams': [{'players': [player(i) for i in range(4, 8)], 'color': {'r': 0.4, 'g': 0.5, 'b': 0.6, 'a': 1}, 'judgement': 'LOSE',
+                        'result': {'paintRatio': 0.45, 'score': None, 'noroshi': None}, 'tricolorRole': None, 'festTeamName': None}],
+        'previousHistoryDetail': {'id': None}, 'nextHistoryDetail': {'id': None},
+        'bankaraMatch': None, 'festMatch': None, 'xMatch': None, 'leagueMatch': None,
+    }}}
+
+def load_payloads(directory: str | None, count: int) -> list:
+    """Loads recorded responses (*.json) from a directory, or makes synthetic ones"""
+    if directory:
+        payloads = []
+        for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+            with open(path, 'rb') as fp:
+                payloads.append(fp.read())
+        if payloads:
+            return payloads
+        print(f"No *.json payloads in {directory}, using synthetic ones", file=sys.stderr)
+    return [json.dumps(synthetic_battle(n)).encode() for n in range(count)]
+
+def bench_decode(args: argparse.Namespace) -> int:
+    """Times decoding the same payloads with every available JSON backend"""
+    payloads = load_payloads(args.payloads, args.count)
+    size = sum(len(payload) for payload in payloads)
+    backends = {'json': json.loads}
+    try:
+        import orjson
+        backends['orjson'] = orjson.loads
+    except ImportError:
+        print("orjson isn't installed, only timing the stdlib", file=sys.stderr)
+    print(f"decoding {len(payloads)} payloads, {size / 1024:.0f}KiB total")
+    baseline = None
+    for name, loads in backends.items():
+        best = min(Timer(lambda: [loads(payload) for payload in payloads]).repeat(repeat=args.repeat, number=1))
+        baseline = baseline or best
+        print(f"  {name:8} {best * 1000:8.2f}ms  {size / best / 1024 ** 2:8.1f}MiB/s  {baseline / best:5.2f}x")
+    return 0
+
+def bench_format(args: argparse.Namespace) -> int:
+    """Times statink.format_battle_body inline, then in process pools of increasing size"""
+    import multiprocessing, time
+    from concurrent.futures import ProcessPoolExecutor
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    from statink import format_battle_body
+    payloads = load_payloads(args.payloads, args.count)
+    print(f"formatting {len(payloads)} payloads")
+    start = time.perf_counter()
+    for payload in payloads:
+        format_battle_body(payload)
+    baseline = time.perf_counter() - start
+    print(f"  inline     {len(payloads) / baseline:8.0f} battles/s")
+    for workers in args.workers:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            list(pool.map(format_battle_body, payloads[:workers])) # start the workers before timing
+            start = time.perf_counter()
+            list(pool.map(format_battle_body, payloads, chunksize=max(1, len(payloads) // (workers * 4))))
+            elapsed = time.perf_counter() - start
+        print(f"  {workers:2} workers {len(payloads) / elapsed:8.0f} battles/s  {baseline / elapsed:5.2f}x")
+    return 0
+
+def bench_cache_memory(args: argparse.Namespace) -> int:
+    """Measures how much memory cached responses take as dicts, msgpack, and compressed msgpack"""
+    import time, tracemalloc
+    import compact
+    payloads = load_payloads(args.payloads, args.count)
+    # a history list response shaped like latestBattleHistories, with one node per payload
+    history = {'data': {'latestBattleHistories': {'historyGroups': {'nodes': [{'historyDetails': {'nodes': [
+        {'id': battle['data']['vsHistoryDetail']['id'], 'judgement': battle['data']['vsHistoryDetail']['judgement'],
+         'udemae': 'S+5', 'vsMode': battle['data']['vsHistoryDetail']['vsMode'], 'vsRule': battle['data']['vsHistoryDetail']['vsRule'],
+         'vsStage': battle['data']['vsHistoryDetail']['vsStage'], 'player': {'weapon': {'name': 'Splattershot'}}}
+        for battle in map(json.loads, payloads)]}}]}}}}
+    formats = {
+        'dict': (lambda decoded: decoded, lambda stored: stored),
+        'json bytes': (lambda decoded: json.dumps(decoded, separators=(',', ':')).encode(), json.loads),
+        'msgpack': (lambda decoded: compact.pack(decoded, None), compact.unpack),
+        'msgpack+zlib': (lambda decoded: compact.pack(decoded, 'zlib'), compact.unpack),
+    }
+    if compact._zstandard() is not None:
+        formats['msgpack+zstd'] = (lambda decoded: compact.pack(decoded, 'zstd'), compact.unpack)
+    else:
+        print("zstandard isn't installed, skipping msgpack+zstd", file=sys.stderr)
+    print(f"{len(payloads)} battle details plus one history list of {len(payloads)} battles")
+    print(f"  {'format':14} {'details':>10} {'history':>10} {'decode/battle':>14}")
+    for name, (store, load) in formats.items():
+        sizes = []
+        for responses in [[json.loads(payload) for payload in payloads], [history]]:
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            stored = [store(json.loads(json.dumps(response))) for response in responses]
+            sizes.append(tracemalloc.get_traced_memory()[0] - before)
+            tracemalloc.stop()
+        details = [store(json.loads(payload)) for payload in payloads[:50]]
+        start = time.perf_counter()
+        for entry in details:
+            load(entry)
+        decode = (time.perf_counter() - start) / len(details)
+        print(f"  {name:14} {sizes[0] / 1024:8.0f}KiB {sizes[1] / 1024:8.0f}KiB {decode * 1e6:12.0f}us")
+    return 0
+
+def bench_uuid_list(args: argparse.Namespace) -> int:
+    """Polls a local stand-in for stat.ink's uuid-list, with and without the stored list, and counts what was downloaded"""
+    import asyncio, uuid
+    from aiohttp import web
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    import statink, database
+    from config import params
+    params['storage'] = 'memory' # the stored lists only need to last the run
+    database.get_user_database() # applies nest_asyncio, which has to happen before the stand-in server's loop runs
+
+    uuids = [str(uuid.uuid4()) for _ in range(args.count)]
+    served = {'requests': 0, 'bytes': 0}
+    async def uuid_list(request: web.Request) -> web.Response:
+        served['requests'] += 1
+        validators = {}
+        if request.app['validators'] in ['etag', 'both']:
+            validators['ETag'] = '"v1"'
+        if request.app['validators'] in ['last-modified', 'both']:
+            validators['Last-Modified'] = 'Wed, 01 May 2024 12:00:00 GMT'
+        if (validators.get('ETag') and request.headers.get('If-None-Match') == validators['ETag']) or \
+           (validators.get('Last-Modified') and request.headers.get('If-Modified-Since') == validators['Last-Modified']):
+            return web.Response(status=304, headers=validators)
+        body = json.dumps(uuids).encode()
+        served['bytes'] += len(body)
+        return web.Response(body=body, content_type='application/json', headers=validators)
+
+    async def run() -> None:
+        print(f"{args.polls} polls of a {args.count} uuid list")
+        for validators in ['none', 'etag', 'last-modified']:
+            app = web.Application()
+            app['validators'] = validators
+            app.router.add_get('/api/v3/s3s/uuid-list', uuid_list)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            statink.API_BASE = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/api/v3'
+            for username in [None, f'bench-{validators}']:
+                served.update(requests=0, bytes=0)
+                for _ in range(args.polls):
+                    assert len(await statink.fetch_uploaded_battles('key', username)) == args.count
+                print(f"  validators={validators:13} {'stored' if username else 'unstored':8} "
+                      f"{served['requests']:4} requests {served['bytes'] / 1024:8.0f}KiB")
+            await runner.cleanup()
+
+    asyncio.run(run())
+    sys.stdout.flush()
+    os._exit(0) # database connections are never closed, so don't wait on their threads
+
+def bench_history_memory(args: argparse.Namespace) -> int:
+    """Peak memory of collecting battle ids from every mode's history for more and more accounts, buffered like
+    fetch_battle_ids used to (every response, then every node, then the ids) and streamed through splatnet.iter_battle_ids"""
+    import asyncio, gc, tracemalloc
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    import splatnet, utils
+    from config import DEFAULTS, params
+    from database import Cache
+    args.cache_format = params['cache_format'] = args.cache_format or DEFAULTS['cache_format']
+    modes = ['latest', *splatnet.HISTORY_MODES]
+
+    def history(mode: str, account: str) -> bytes:
+        return json.dumps({'data': {f'{mode}BattleHistories': {'historyGroups': {'nodes': [{'historyDetails': {'nodes': [
+            {'id': base64.b64encode(f'VsHistoryDetail-u-{account}:RECENT:20240501T12{n // 60:02d}{n % 60:02d}_{mode}{n:032d}'.encode()).decode(),
+             'judgement': 'WIN', 'udemae': 'S+5', 'vsMode': {'mode': 'REGULAR', 'id': 'VnNNb2RlLTE='}, 'vsRule': {'name': 'Turf War', 'rule': 'TURF_WAR'},
+             'vsStage': {'name': 'Scorch Gorge', 'id': 'VnNTdGFnZS0x', 'image': {'url': 'https://example.invalid/' + 'f' * 64}},
+             'player': {'weapon': {'name': 'Splattershot', 'image': {'url': 'https://example.invalid/' + 'e' * 64}}},
+             'myTeam': {'result': {'paintPoint': 1000, 'score': None}}, 'nextHistoryDetail': None, 'previousHistoryDetail': None}
+            for n in range(10 * group, 10 * group + 10)]}} for group in range(5)]}}}}).encode()
+
+    async def graphql(bullet_token: str, g_token: str, query: str, return_json: bool = False, **kwargs) -> dict:
+        return utils.json_loads(history(query.removesuffix('BattleHistories'), bullet_token))
+    splatnet.graphql = graphql # the stand-in for SplatNet, decoding a fresh response every time
+
+    async def buffered(account: str) -> dict:
+        responses = [await Cache.graphql(account, 'g', f'{mode}BattleHistories', return_json=True, refresh=True) for mode in modes]
+        nodes = [node for mode, response in zip(modes, responses) for node in response['data'][f'{mode}BattleHistories']['historyGroups']['nodes']]
+        details = [detail for node in nodes for detail in node['historyDetails']['nodes']]
+        return {await utils.decode_battle_id(detail['id']): detail['id'] for detail in details}
+
+    async def streamed(account: str) -> dict:
+        return await splatnet.fetch_battle_ids(account, 'g', modes)
+
+    async def peak(fetch, accounts: int) -> int:
+        Cache.cache.clear()
+        gc.collect()
+        tracemalloc.start()
+        for account in range(accounts):
+            await fetch(f'account{account}')
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak
+
+    async def run() -> None:
+        print(f"{len(modes)} modes of 50 battles per account, cache_format={args.cache_format}")
+        print(f"  {'accounts':>8} {'buffered':>10} {'streamed':>10}")
+        await buffered('warmup'), await streamed('warmup') # lazy imports and first-use allocations aren't part of either
+        for accounts in args.accounts:
+            print(f"  {accounts:8} {await peak(buffered, accounts) / 1024:8.0f}KiB {await peak(streamed, accounts) / 1024:8.0f}KiB")
+    asyncio.run(run())
+    return 0
+
+def bench_replay(args: argparse.Namespace) -> int:
+    """Runs every battle in a recorded cassette through statink.format_request, offline: the history lookups for ranks,
+    powers, challenge progress and deferred fields are replayed from the cassette too. With --output, writes the stat.ink
+    payloads as JSON lines to diff against a later run, and with --compare, reports the battles whose payload changed since one."""
+    import asyncio, time
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    import cassette, database, statink, utils
+    from config import params
+    from splatnet import VIEW_BATTLE_HASH
+    params.update(storage='memory', cassette='replay', cassette_path=args.cassette) # deferred fields only need to last the run
+    bodies = [entry['body'] for key, entries in cassette.load(args.cassette).items() if VIEW_BATTLE_HASH in key for entry in entries if entry['status'] == 200]
+    if not bodies:
+        print(f"{args.cassette} has no recorded battles. Record some with `cassette` set to 'record'.")
+        return 1
+    battles = sorted((utils.json_loads(body) for body in bodies), key=lambda battle: battle['data']['vsHistoryDetail']['playedTime'])
+    users = database.get_user_database() # applies nest_asyncio before the loop runs
+
+    async def run() -> list:
+        # the recorded tokens were redacted, and replayed requests never send them anyway
+        await users.set('replay', {'session_token': cassette.REDACTED, 'bullet_token': cassette.REDACTED, 'g_token': cassette.REDACTED,
+                                   'user_data': '{}', 'statink_key': None})
+        payloads, previous_powers = [], {}
+        for battle in battles:
+            # oldest first, like an upload run, so each battle's predecessor is already known
+            payloads.append(await statink.format_request('replay', battle, previous_powers))
+            previous_powers[battle['data']['vsHistoryDetail']['id']] = await statink.find_battle_bankara_power(battle)
+        return payloads
+
+    print(f"formatting {len(battles)} recorded battles")
+    start = time.perf_counter()
+    payloads = asyncio.run(run())
+    elapsed = time.perf_counter() - start
+    print(f"  {len(battles) / elapsed:8.0f} battles/s")
+    lines = [json.dumps(payload, sort_keys=True, separators=(',', ':')) for payload in payloads]
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.writelines(line + '\n' for line in lines)
+    status = 0
+    if args.compare:
+        with open(args.compare) as fp:
+            expected = fp.read().splitlines()
+        stable = lambda line: {key: value for key, value in json.loads(line).items() if key not in statink.VOLATILE_FIELDS}
+        changed = sum(stable(line) != stable(old) for line, old in zip(lines, expected)) + abs(len(lines) - len(expected))
+        print(f"  {changed} of {len(lines)} payloads differ from {args.compare}")
+        status = 1 if changed else 0
+    sys.stdout.flush()
+    os._exit(status) # database connections are never closed, so don't wait on their threads
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Dynamo benchmarks')
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+    importtime = subparsers.add_parser('importtime', help='cold start import cost of main.py')
+    importtime.add_argument('--module', default='main')
+    importtime.add_argument('--runs', type=int, default=5)
+    importtime.add_argument('--top', type=int, default=10)
+    importtime.add_argument('--budget', type=float, default=float(os.environ.get('DYNAMO_IMPORT_BUDGET_MS', 100)), help='milliseconds (DYNAMO_IMPORT_BUDGET_MS)')
+    importtime.set_defaults(func=bench_importtime)
+    decode = subparsers.add_parser('decode', help='JSON decode time of battle payloads per backend')
+    decode.add_argument('--payloads', help='directory of recorded responses (*.json). Synthetic payloads are used if not given')
+    decode.add_argument('--count', type=int, default=200, help='number of synthetic payloads')
+    decode.add_argument('--repeat', type=int, default=5)
+    decode.set_defaults(func=bench_decode)
+    format = subparsers.add_parser('format', help='stat.ink formatting throughput, inline and with offload=process')
+    format.add_argument('--payloads', help='directory of recorded responses (*.json). Synthetic payloads are used if not given')
+    format.add_argument('--count', type=int, default=2000, help='number of synthetic payloads')
+    format.add_argument('--workers', type=int, nargs='+', default=sorted({1, 2, os.cpu_count() or 1}))
+    format.set_defaults(func=bench_format)
+    cache_memory = subparsers.add_parser('cache-memory', help='memory used by cached responses per cache_format')
+    cache_memory.add_argument('--payloads', help='directory of recorded responses (*.json). Synthetic payloads are used if not given')
+    cache_memory.add_argument('--count', type=int, default=200, help='number of synthetic payloads')
+    cache_memory.set_defaults(func=bench_cache_memory)
+    uuid_list = subparsers.add_parser('uuid-list', help='uuid-list downloads with and without the stored list, against a local stand-in server')
+    uuid_list.add_argument('--count', type=int, default=5000, help='uuids in the list')
+    uuid_list.add_argument('--polls', type=int, default=20)
+    uuid_list.set_defaults(func=bench_uuid_list)
+    history_memory = subparsers.add_parser('history-memory', help='peak memory of collecting battle ids from every mode, buffered and streamed')
+    history_memory.add_argument('--accounts', type=int, nargs='+', default=[1, 4, 16])
+    history_memory.add_argument('--cache-format', choices=['dict', 'msgpack', 'zlib', 'zstd'], default=None, help='defaults to the shipped config')
+    history_memory.set_defaults(func=bench_history_memory)
+    replay = subparsers.add_parser('replay', help='stat.ink formatting of the battles in a recorded cassette, and what changed since an earlier run')
+    replay.add_argument('--cassette', default='cassette.dyn')
+    replay.add_argument('--output', help='file to write the payloads to, one JSON line per battle')
+    replay.add_argument('--compare', help='payloads written by an earlier --output to compare against')
+    replay.set_defaults(func=bench_replay)
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
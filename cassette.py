@@ -0,0 +1,149 @@
+import hashlib, json, struct
+from urllib.parse import urlsplit
+
+import compact, utils
+from config import params
+
+aiohttp = utils.lazy_import('aiohttp')
+
+# string values under these keys are credentials, wherever they turn up in a recorded body
+SECRET_KEYS: frozenset = frozenset({
+    'session_token', 'code', 'access_token', 'id_token', 'accessToken', 'idToken', 'bulletToken', 'f', 'request_id',
+})
+REDACTED: str = 'REDACTED'
+# response headers worth keeping. the rest (Set-Cookie especially) are dropped
+KEPT_HEADERS: tuple = ('Content-Type',)
+# every entry in a cassette file is this header (the packed entry's length) followed by the entry
+FRAME: struct.Struct = struct.Struct('>I')
+
+class Cassette:
+    '''Process-wide record/replay state, set with `cassette` ('record' or 'replay') and `cassette_path`'''
+    entries: dict | None = None
+    """ formatted as {request key: [recorded responses, in the order they were recorded]} """
+    served: dict = {}
+    """ formatted as {request key: responses replayed so far} """
+    recorded: dict = {}
+    """ formatted as {request key: hash of the last body recorded}, so identical repeats aren't written twice """
+
+def mode() -> str:
+    return params.get('cassette') or ''
+
+def request_key(method: str, url: str, body=None) -> str:
+    '''What a request is matched on: method, host, path and query string, and for GraphQL the persisted query and its
+    variables. Never the headers, cookies or other request bodies, which carry the tokens.'''
+    parts = urlsplit(str(url))
+    key = f'{method.upper()} {parts.netloc}{parts.path}' + (f'?{parts.query}' if parts.query else '')
+    if isinstance(body, dict) and 'persistedQuery' in body.get('extensions', {}):
+        key += f" {body['extensions']['persistedQuery']['sha256Hash']} {json.dumps(body.get('variables') or {}, sort_keys=True)}"
+    return key
+
+def redact(value):
+    '''Returns a copy of a decoded JSON body with every credential replaced'''
+    if isinstance(value, dict):
+        return {key: REDACTED if key in SECRET_KEYS and isinstance(item, str) else redact(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+def redact_body(body: bytes) -> bytes:
+    try:
+        decoded = utils.json_loads(body)
+    except ValueError:
+        return body # html and scripts (the webview version lookup) have no credentials in them
+    if (redacted := redact(decoded)) == decoded:
+        return body # kept byte for byte, so replayed battles format exactly like live ones
+    return json.dumps(redacted, separators=(',', ':')).encode()
+
+def load(path: str) -> dict:
+    '''Reads a cassette file into {request key: [entries]}'''
+    entries = {}
+    with open(path, 'rb') as fp:
+        while header := fp.read(FRAME.size):
+            entry = compact.unpack(fp.read(FRAME.unpack(header)[0]))
+            entries.setdefault(entry['key'], []).append(entry)
+    return entries
+
+def record(key: str, status: int, headers: dict, body: bytes) -> None:
+    '''Appends a redacted exchange to the cassette, unless it's the same as the last one recorded for this request'''
+    body = redact_body(body)
+    digest = hashlib.sha1(body).digest() + status.to_bytes(2, 'big')
+    if Cassette.recorded.get(key) == digest:
+        return
+    Cassette.recorded[key] = digest
+    blob = compact.pack({'key': key, 'status': status, 'headers': {name: headers[name] for name in KEPT_HEADERS if name in headers}, 'body': body}, 'zlib')
+    with open(params.get('cassette_path', 'cassette.dyn'), 'ab') as fp:
+        fp.write(FRAME.pack(len(blob)) + blob)
+
+def replay(key: str) -> 'Response':
+    '''Returns the recorded responses to a request in order, repeating the last one once they run out'''
+    if Cassette.entries is None:
+        Cassette.entries = load(params.get('cassette_path', 'cassette.dyn'))
+    if not (entries := Cassette.entries.get(key)):
+        raise RuntimeError(f"{key} isn't in the cassette {params.get('cassette_path', 'cassette.dyn')}. Record it first with `cassette` set to 'record'.")
+    served = Cassette.served.get(key, 0)
+    Cassette.served[key] = served + 1
+    entry = entries[min(served, len(entries) - 1)]
+    return Response(entry['status'], entry['headers'], entry['body'])
+
+class Response:
+    '''A recorded or replayed response, with the part of aiohttp.ClientResponse the SplatNet and NSO code uses'''
+    def __init__(self, status: int, headers: dict, body: bytes) -> None:
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    async def read(self) -> bytes:
+        return self.body
+
+    async def text(self, encoding: str = 'utf-8') -> str:
+        return self.body.decode(encoding)
+
+    async def json(self, **kwargs):
+        return utils.json_loads(self.body)
+
+class _Call:
+    '''session.get/post(...), usable with both `await` and `async with` like aiohttp's'''
+    def __init__(self, session: 'Session', method: str, url: str, kwargs: dict) -> None:
+        self.session, self.method, self.url, self.kwargs = session, method, url, kwargs
+
+    def __await__(self):
+        return self.session.send(self.method, self.url, self.kwargs).__await__()
+
+    async def __aenter__(self) -> Response:
+        return await self.session.send(self.method, self.url, self.kwargs)
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        pass
+
+class Session:
+    '''Stands in for aiohttp.ClientSession while recording or replaying'''
+    def __init__(self) -> None:
+        self.session = None
+
+    async def __aenter__(self) -> 'Session':
+        if mode() != 'replay':
+            self.session = await aiohttp.ClientSession().__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        if self.session is not None:
+            await self.session.__aexit__(exc_type, exc_value, traceback)
+
+    def get(self, url: str, **kwargs) -> _Call:
+        return _Call(self, 'GET', url, kwargs)
+
+    def post(self, url: str, **kwargs) -> _Call:
+        return _Call(self, 'POST', url, kwargs)
+
+    async def send(self, method: str, url: str, kwargs: dict) -> Response:
+        key = request_key(method, url, kwargs.get('json'))
+        if mode() == 'replay':
+            return replay(key)
+        async with self.session.request(method, url, **kwargs) as r:
+            response = Response(r.status, dict(r.headers), await r.read())
+        record(key, response.status, response.headers, response.body)
+        return response
+
+def client_session():
+    '''The session SplatNet and NSO requests go through: aiohttp's own, unless `cassette` is recording or replaying'''
+    return Session() if mode() in ['record', 'replay'] else aiohttp.ClientSession()
@@ -0,0 +1,48 @@
+import zlib
+
+import utils
+
+msgpack = utils.lazy_import('msgpack')
+
+# first byte of every blob, so blobs decode the same whatever `cache_format` is set to now
+NONE, ZLIB, ZSTD = b'0', b'z', b's'
+
+def _zstandard():
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        return None
+
+def compress(body: bytes, compression: str | None = 'zlib') -> bytes:
+    '''Compresses with 'zstd' (falling back to zlib if `zstandard` isn't installed), 'zlib', or None'''
+    match compression:
+        case 'zstd' if (zstandard := _zstandard()) is not None:
+            return ZSTD + zstandard.ZstdCompressor(level=3).compress(body)
+        case 'zstd' | 'zlib':
+            return ZLIB + zlib.compress(body, 6)
+        case _:
+            return NONE + body
+
+def decompress(blob: bytes) -> bytes:
+    match blob[:1]:
+        case b's':
+            zstandard = _zstandard()
+            if zstandard is None:
+                raise RuntimeError("This blob was compressed with zstd. Install it with `pip install zstandard`.")
+            return zstandard.ZstdDecompressor().decompress(blob[1:])
+        case b'z':
+            return zlib.decompress(blob[1:])
+        case _:
+            return blob[1:]
+
+def pack(obj, compression: str | None = 'zlib') -> bytes:
+    '''Encodes a decoded JSON response as (optionally compressed) msgpack'''
+    return compress(msgpack.packb(obj, use_bin_type=True), compression)
+
+def unpack(blob: bytes):
+    return msgpack.unpackb(decompress(blob), raw=False)
+
+def compression_for(cache_format: str) -> str | None:
+    '''Maps a `cache_format` config value ('msgpack', 'zlib', 'zstd') to its compression'''
+    return cache_format if cache_format in ['zlib', 'zstd'] else None
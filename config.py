@@ -1,32 +1,126 @@
-import json, asyncio
+import json, asyncio, os
+
+CONFIG_PATH: str = os.environ.get('DYNAMO_CONFIG', 'config.json')
+
+DEFAULTS: dict = {
+    'refresh': 60,
+    'threaded': True,
+    'flush_prints': False,
+    'detailed': False,
+    'freaky': False,
+    'metrics': False,
+    'metrics_sink': 'api',
+    'archive': False,
+    'archive_path': 'archive.db',
+    'json_backend': 'auto',
+    'defer_fields': True,
+    'offload': 'off',
+    'offload_workers': 0,
+    'cache_format': 'dict',
+    'cache_path': '',
+    'uuid_list_ttl': 3600,
+    'events_socket': '',
+    'events_sse_port': 0,
+    'webhooks': [],
+    'web_token': '',
+    'schedule_aware': True,
+    'quiet_hours': '',
+    'storage': 'sqlite',
+    'database_path': 'main.db',
+    'vault': False,
+    'vault_keyfile': 'vault.key',
+    'vault_cache_ttl': 30,
+    'backfill_concurrency': 4,
+    'cassette': '',
+    'cassette_path': 'cassette.dyn',
+    'presence_observer': '',
+    'presence_friends': {},
+    'presence_interval': 0
+}
+
+# config key -> environment variable, for running headless (systemd, cron, containers)
+ENVIRONMENT: dict = {
+    'refresh': 'DYNAMO_REFRESH',
+    'threaded': 'DYNAMO_THREADED',
+    'flush_prints': 'DYNAMO_FLUSH_PRINTS',
+    'detailed': 'DYNAMO_DETAILED',
+    'freaky': 'DYNAMO_FREAKY',
+    'metrics': 'DYNAMO_METRICS',
+    'metrics_sink': 'DYNAMO_METRICS_SINK',
+    'archive': 'DYNAMO_ARCHIVE',
+    'archive_path': 'DYNAMO_ARCHIVE_PATH',
+    'json_backend': 'DYNAMO_JSON_BACKEND',
+    'defer_fields': 'DYNAMO_DEFER_FIELDS',
+    'offload': 'DYNAMO_OFFLOAD',
+    'offload_workers': 'DYNAMO_OFFLOAD_WORKERS',
+    'cache_format': 'DYNAMO_CACHE_FORMAT',
+    'cache_path': 'DYNAMO_CACHE_PATH',
+    'uuid_list_ttl': 'DYNAMO_UUID_LIST_TTL',
+    'events_socket': 'DYNAMO_EVENTS_SOCKET',
+    'events_sse_port': 'DYNAMO_EVENTS_SSE_PORT',
+    'webhooks': 'DYNAMO_WEBHOOKS',
+    'web_token': 'DYNAMO_WEB_TOKEN',
+    'schedule_aware': 'DYNAMO_SCHEDULE_AWARE',
+    'quiet_hours': 'DYNAMO_QUIET_HOURS',
+    'storage': 'DYNAMO_STORAGE',
+    'database_path': 'DYNAMO_DATABASE_PATH',
+    'vault': 'DYNAMO_VAULT',
+    'vault_keyfile': 'DYNAMO_VAULT_KEYFILE',
+    'vault_cache_ttl': 'DYNAMO_VAULT_CACHE_TTL',
+    'backfill_concurrency': 'DYNAMO_BACKFILL_CONCURRENCY',
+    'cassette': 'DYNAMO_CASSETTE',
+    'cassette_path': 'DYNAMO_CASSETTE_PATH',
+    'presence_observer': 'DYNAMO_PRESENCE_OBSERVER',
+    'presence_friends': 'DYNAMO_PRESENCE_FRIENDS',
+    'presence_interval': 'DYNAMO_PRESENCE_INTERVAL'
+}
 
 async def generate_config_py():
-    global params
     threaded = input('Would you like to run threads? (Used for a fancy loading bar) (Y/n) ')
     flush_prints = input('Would you like each loading statement to be on a new line? (y/N) ')
     detailed = input('Would you like to see detailed step output? (y/N) ')
     freaky = input('Are you a 𝒻𝓇𝑒𝒶𝓀? (y/N) ')
 
     data = {
-        'refresh': 60,
+        **DEFAULTS,
         'threaded': True if threaded.lower() == 'y' or threaded == '' else False,
         'flush_prints': True if flush_prints.lower() == 'y' else False if flush_prints == '' else False,
         'detailed': True if detailed.lower() == 'y' else False if detailed == '' else False,
-        'freaky': True if freaky.lower() == 'y' else False if freaky == '' else False
+        'freaky': True if freaky.lower() == 'y' else False if freaky == '' else False,
     }
 
-    with open('config.json', 'w') as fp:
+    with open(CONFIG_PATH, 'w') as fp:
         json.dump(data, fp, indent=4)
-    
-    params = data
-
-try:
-    params = json.load(open('config.json'))
-except FileNotFoundError:
-    params = {
-        'refresh': 60,
-        'threaded': True,
-        'flush_prints': False,
-        'detailed': False,
-        'freaky': False
-    }
\ No newline at end of file
+
+    # update in place, other modules hold a reference to this dict
+    params.update(data)
+
+def load_config(path: str = CONFIG_PATH) -> dict:
+    '''Loads a config file over the defaults, without prompting if it doesn't exist'''
+    global CONFIG_PATH
+    CONFIG_PATH = path
+    params.clear()
+    params.update(DEFAULTS)
+    try:
+        with open(path) as fp:
+            params.update(json.load(fp))
+    except FileNotFoundError:
+        pass
+    return params
+
+def load_environment() -> dict:
+    '''Overrides config values with any DYNAMO_* environment variables that are set'''
+    for key, variable in ENVIRONMENT.items():
+        value = os.environ.get(variable)
+        if value is None:
+            continue
+        match DEFAULTS[key]:
+            case bool(): params[key] = value.lower() in ['1', 'y', 'yes', 'true', 'on']
+            case int(): params[key] = int(value)
+            case list(): params[key] = [item.strip() for item in value.split(',') if item.strip()]
+            case dict(): params[key] = dict(item.strip().split('=', 1) for item in value.split(',') if '=' in item)
+            case _: params[key] = value
+    return params
+
+params: dict = {}
+load_config(CONFIG_PATH)
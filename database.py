@@ -1,13 +1,22 @@
-import aiohttp
-import aiosqlite
+from __future__ import annotations
+
 import asyncio
-import nest_asyncio
-from os.path import exists
+import hashlib
+import json
 from time import time
+from typing import TYPE_CHECKING
 
+import compact, metrics, vault
 from config import params
+from utils import lazy_import, json_loads
+
+if TYPE_CHECKING:
+    import aiohttp
 
-nest_asyncio.apply()
+aiosqlite = lazy_import('aiosqlite')
+
+# seconds a connection waits on another process's write lock (fleet workers share main.db) before giving up
+BUSY_TIMEOUT: float = 30
 
 class Cache:
     cache = {}
@@ -19,99 +28,297 @@ class Cache:
         }
     }
     """
+    inflight = {}
+    """ requests currently being made, formatted as {key: asyncio.Future} """
+
+    @staticmethod
+    async def single_flight(key, fetch):
+        '''Awaits `fetch()` at most once at a time per key. Callers that arrive while it's running share its result.
+        An exception is raised to every caller waiting on it, but nothing is cached, so the next call tries again.'''
+        while (future := Cache.inflight.get(key)) is not None:
+            metrics.increment('dynamo_coalesced_requests_total')
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if future.cancelled():
+                    continue # whoever was fetching got cancelled, not us. take over
+                raise
+        future = asyncio.get_running_loop().create_future()
+        Cache.inflight[key] = future
+        try:
+            result = await fetch()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception() # mark as retrieved, in case nobody else was waiting
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del Cache.inflight[key]
+
+    @staticmethod
+    def fresh(entry: dict | None) -> bool:
+        return entry is not None and (entry['expires'] > time() or entry['expires'] == -1)
+
+    @staticmethod
+    async def recall(key) -> dict | None:
+        '''Returns the fresh entry for a key from memory, or from `cache_path` on disk if it's set'''
+        entry = Cache.cache.get(key)
+        if not Cache.fresh(entry) and (disk := get_cache_database()) is not None:
+            entry = await disk.get(key)
+            if Cache.fresh(entry):
+                Cache.cache[key] = entry
+        return entry if Cache.fresh(entry) else None
+
+    @staticmethod
+    async def remember(key, entry: dict) -> None:
+        Cache.cache[key] = entry
+        if (disk := get_cache_database()) is not None and ('packed' in entry or 'compressed' in entry):
+            await disk.set(key, entry)
+
+    @staticmethod
+    def entry(data, expires: int) -> dict:
+        """Builds a cache entry, packing decoded responses as msgpack when `cache_format` isn't 'dict'"""
+        cache_format = params.get('cache_format', 'dict')
+        if cache_format != 'dict' and isinstance(data, dict):
+            return {'packed': compact.pack(data, compact.compression_for(cache_format)), 'expires': expires}
+        return {'data': data, 'expires': expires}
+
+    @staticmethod
+    def value(entry: dict):
+        return compact.unpack(entry['packed']) if 'packed' in entry else entry['data']
+
     @staticmethod
-    async def graphql(bullet_token: str, g_token: str, query: str, expires_after: int = 0, return_json: bool = False) -> aiohttp.ClientResponse | dict:
+    async def graphql(bullet_token: str, g_token: str, query: str, expires_after: int = 0, return_json: bool = False, refresh: bool = False) -> aiohttp.ClientResponse | dict:
+        '''Returns a cached query response if there's a fresh one. refresh=True always fetches, but still caches the result.'''
         from splatnet import graphql
         await Cache.purge()
-        if (bullet_token, g_token, query) in Cache.cache:
-            if Cache.cache[(bullet_token, g_token, query)]['expires'] > time() or Cache.cache[(bullet_token, g_token, query)]['expires'] == -1:
-                return Cache.cache[(bullet_token, g_token, query)]['data']
-        
-        data = await graphql(bullet_token, g_token, query, return_json=return_json)
-        expires = int(time()) + (expires_after if expires_after != 0 else params['refresh']) 
-        Cache.cache[(bullet_token, g_token, query)] = {
-            'data': data,
-            'expires': int(time()) + expires
-        }
-        return data
+        if not refresh and (entry := await Cache.recall((bullet_token, g_token, query))) is not None:
+            metrics.increment('dynamo_cache_hits_total', kind='graphql')
+            return Cache.value(entry)
+        metrics.increment('dynamo_cache_misses_total', kind='graphql')
+        async def fetch():
+            data = await graphql(bullet_token, g_token, query, return_json=return_json)
+            expires = int(time()) + (expires_after if expires_after != 0 else params['refresh']) 
+            await Cache.remember((bullet_token, g_token, query), Cache.entry(data, expires))
+            return data
+        return await Cache.single_flight(('graphql', bullet_token, g_token, query, return_json), fetch)
     
-    async def view_battle(vsResultId, bullet_token: str, g_token: str):
-        from splatnet import view_battle
+    async def view_battle(vsResultId, bullet_token: str, g_token: str, raw: bool = False) -> dict | bytes:
+        '''Returns the decoded battle, or with raw=True the response body exactly as SplatNet sent it.
+        Bodies are only decoded the first time they're asked for decoded, so raw-only callers (see offload.py) skip it.
+        When `cache_format` isn't 'dict', only the compressed body is kept and it's decoded on every access instead.'''
+        from splatnet import view_battle_raw
         await Cache.purge()
-        if (vsResultId, g_token) in Cache.cache:
-            if Cache.cache[(vsResultId, g_token)]['expires'] > time() or Cache.cache[(vsResultId, g_token)]['expires'] == -1:
-                return Cache.cache[(vsResultId, g_token)]['data']
-        
-        data = await view_battle(vsResultId, bullet_token, g_token)
-        expires = int(time()) + params['refresh']
-        Cache.cache[(vsResultId, g_token)] = {
-            'data': data,
-            'expires': int(time()) + expires
-        }
-        return data
+        if (entry := await Cache.recall((vsResultId, g_token))) is not None:
+            metrics.increment('dynamo_cache_hits_total', kind='battle')
+            return Cache.body(entry) if raw else Cache.decoded((vsResultId, g_token))
+        metrics.increment('dynamo_cache_misses_total', kind='battle')
+        async def fetch():
+            body = await view_battle_raw(vsResultId, bullet_token, g_token)
+            expires = int(time()) + params['refresh']
+            if (cache_format := params.get('cache_format', 'dict')) != 'dict':
+                entry = {'compressed': compact.compress(body, compact.compression_for(cache_format)), 'expires': expires}
+            else:
+                entry = {'data': None, 'raw': body, 'expires': expires}
+            await Cache.remember((vsResultId, g_token), entry)
+            return body
+        body = await Cache.single_flight(('battle', vsResultId, g_token), fetch)
+        return body if raw else Cache.decoded((vsResultId, g_token), body)
+
+    @staticmethod
+    def body(entry: dict) -> bytes:
+        return compact.decompress(entry['compressed']) if 'compressed' in entry else entry['raw']
+
+    @staticmethod
+    def decoded(key, body: bytes | None = None) -> dict:
+        '''Decodes a cached battle body, keeping the result next to it unless the entry is compressed'''
+        entry = Cache.cache.get(key)
+        if entry is None:
+            return json_loads(body)
+        if 'compressed' in entry:
+            return json_loads(body if body is not None else Cache.body(entry))
+        if entry['data'] is None:
+            entry['data'] = json_loads(entry['raw'])
+        return entry['data']
     
     async def purge() -> None:
-        for key in Cache.cache:
-            if Cache.cache[key]['expires'] < time():
-                del Cache.cache[key]
+        now = time()
+        for key in [key for key, entry in Cache.cache.items() if entry['expires'] != -1 and entry['expires'] < now]:
+            del Cache.cache[key]
+
+class Backend:
+    '''Where Database tables live. Every Database with the same `database_name` shares one backend and one connection.
+
+    Another backend (say, a networked one several hosts share) subclasses this and is added with `register_backend`.
+    `connect()` returns an object with the part of aiosqlite.Connection Dynamo uses: `execute(sql, parameters)`,
+    awaitable and usable as an async context manager yielding a cursor with `fetchone()`, `fetchall()` and `async for`,
+    plus `executemany(sql, rows)`, `commit()` and `close()`. The SQL is SQLite's: `?` placeholders, `INSERT OR REPLACE`,
+    `INSERT OR IGNORE` and `ON CONFLICT ... DO UPDATE`.'''
+    def __init__(self, database_name: str) -> None:
+        self.database_name = database_name
+        self.migrated = set()
+        self._connection = None
+        self._lock = None
+
+    async def connect(self):
+        raise NotImplementedError
+
+    async def connection(self):
+        if self._connection is None:
+            connection = await self.connect()
+            if self._connection is None:
+                self._connection = connection
+            else:
+                await connection.close() # another task connected while this one was
+        return self._connection
+
+    async def migrate(self, component: str, migrations: list) -> None:
+        '''Applies the migrations `component` hasn't had yet, checking once per process'''
+        if component in self.migrated:
+            return
+        self._lock = self._lock or asyncio.Lock()
+        async with self._lock:
+            if component not in self.migrated:
+                await self.apply(await self.connection(), component, migrations)
+                self.migrated.add(component)
+
+    async def apply(self, database, component: str, migrations: list) -> None:
+        '''Runs every migration past the version schema_migrations has for `component`, then records the new version'''
+        await database.execute('CREATE TABLE IF NOT EXISTS schema_migrations ("component" TEXT PRIMARY KEY NOT NULL, "version" INTEGER NOT NULL)')
+        async with database.execute("SELECT version FROM schema_migrations WHERE component=?", (component,)) as cursor:
+            row = await cursor.fetchone()
+        version = row[0] if row is not None else 0
+        for statements in migrations[version:]:
+            for statement in statements:
+                await database.execute(statement)
+        if len(migrations) > version:
+            await database.execute("INSERT OR REPLACE INTO schema_migrations VALUES (?, ?)", (component, len(migrations),))
+        await database.commit()
+
+    async def close(self) -> None:
+        self.migrated = set() # an in-memory database is gone with its connection, so check again on the next one
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            await connection.close()
+
+class SQLiteBackend(Backend):
+    '''A SQLite file, set up so fleet workers and the web server can read while one of them writes'''
+    PRAGMAS: tuple = (
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL', # safe with WAL, and saves an fsync per commit
+        'PRAGMA foreign_keys=ON',
+        'PRAGMA temp_store=MEMORY',
+    )
+
+    async def connect(self):
+        connection = await aiosqlite.connect(self.database_name, timeout=BUSY_TIMEOUT)
+        for pragma in self.PRAGMAS:
+            await connection.execute(pragma)
+        return connection
+
+    async def apply(self, database, component: str, migrations: list) -> None:
+        # on a connection of its own, so BEGIN IMMEDIATE can't run into another task's open transaction.
+        # other processes migrating at the same time wait for it, then see the version recorded here
+        async with aiosqlite.connect(self.database_name, timeout=BUSY_TIMEOUT, isolation_level=None) as migrating:
+            await migrating.execute('BEGIN IMMEDIATE')
+            try:
+                await super().apply(migrating, component, migrations)
+            except BaseException:
+                await migrating.execute('ROLLBACK')
+                raise
+
+class MemoryBackend(Backend):
+    '''An in-memory SQLite database that's gone when the process exits. For tests and benchmarks.'''
+    async def connect(self):
+        return await aiosqlite.connect(':memory:')
+
+BACKENDS: dict = {
+    'sqlite': SQLiteBackend,
+    'memory': MemoryBackend,
+}
+_backends: dict = {}
+
+def register_backend(name: str, backend: type) -> None:
+    '''Makes a Backend subclass selectable with the `storage` config value'''
+    BACKENDS[name] = backend
+
+def get_backend(database_name: str) -> Backend:
+    '''Returns the shared backend for a database, of the kind set with `storage` (sqlite by default)'''
+    kind = params.get('storage', 'sqlite')
+    if kind not in BACKENDS:
+        raise ValueError(f"Unknown storage backend {kind}, expected one of: {', '.join(BACKENDS)}")
+    if (kind, database_name) not in _backends:
+        _backends[(kind, database_name)] = BACKENDS[kind](database_name)
+    return _backends[(kind, database_name)]
+
+async def close_all() -> None:
+    '''Closes every backend's connection'''
+    for backend in list(_backends.values()):
+        await backend.close()
 
 class Database:
+    '''Subclasses set `database_name`, `table_name`, and `migrations`: a list of migrations, each a list of SQL statements.
+    They run in order the first time a database is used, and never twice. Don't edit a migration that has shipped, add another.'''
+    migrations: list = []
+
     async def __aenter__(self) -> aiosqlite.Connection:
-        self.database = await aiosqlite.connect(self.database_name)
+        backend = get_backend(self.database_name)
+        await backend.migrate(self.table_name, self.migrations)
+        self.database = await backend.connection()
         return self.database
-    
+
     async def __aexit__(self, exc_type, exc_value, traceback):
         try:
             await self.database.commit()
         except:
             pass
-    
-    def __del__(self):
-        try:
-            asyncio.run(self.database.close())
-        except:
-            pass
-    
+
     def __len__(self):
         return asyncio.run(self.length())
-    
+
     def __contains__(self, battle_id):
         return asyncio.run(self.contains(battle_id))
-    
+
     def __delitem__(self, battle_id):
         return asyncio.run(self.delete(battle_id))
-    
+
     async def length(self):
         async with self as database:
             async with database.execute(f"SELECT * FROM {self.table_name}") as cursor:
                 return len(await cursor.fetchall())
-    
+
     async def list(self):
         async with self as database:
             async with database.execute(f"SELECT * FROM {self.table_name}") as cursor:
                 return await cursor.fetchall()
-    
+
     async def contains(self, battle_id):
         async with self as database:
             async with database.execute(f"SELECT * FROM {self.table_name} WHERE id=?", (battle_id,)) as cursor:
                 return await cursor.fetchone() is not None
-    
+
     async def delete(self, battle_id):
         async with self as database:
             if battle_id in self:
-                await database.execute(f"DELETE FROM {self.table_name} WHERE id=?", (battle_id,)) 
+                await database.execute(f"DELETE FROM {self.table_name} WHERE id=?", (battle_id,))
             await database.commit()
-    
+
     async def close(self):
-        await self.database.close()
-            
+        await get_backend(self.database_name).close()
+
 class UserDatabase(Database):
     def __init__(self): 
-        self.database_name = "main.db"
+        self.database_name = params.get('database_path', 'main.db')
         self.table_name = "users"
-        self.schema = '("username" TEXT PRIMARY KEY UNIQUE NOT NULL, "session_token" TEXT NOT NULL, "bullet_token" TEXT NOT NULL, "g_token" TEXT NOT NULL, "user_data" TEXT NOT NULL, "statink_key" TEXT)'
-        if not exists(self.database_name):
-            asyncio.run(self.create_table())
+        self.migrations = [
+            ['CREATE TABLE IF NOT EXISTS users ("username" TEXT PRIMARY KEY UNIQUE NOT NULL, "session_token" TEXT NOT NULL, "bullet_token" TEXT NOT NULL, "g_token" TEXT NOT NULL, "user_data" TEXT NOT NULL, "statink_key" TEXT)'],
+            ['CREATE TABLE IF NOT EXISTS leases ("name" TEXT PRIMARY KEY NOT NULL, "owner" TEXT NOT NULL, "expires" INTEGER NOT NULL)'],
+        ]
     
     def __contains__(self, battle_id):
         return asyncio.run(self.contains(battle_id))
@@ -125,30 +332,259 @@ class UserDatabase(Database):
     def __setitem__(self, username, data: dict) -> None:
         asyncio.run(self.set(username, data))
     
-    async def get(self, username):
+    async def get(self, username, fresh: bool = False):
+        '''Returns the user's row with credentials decrypted. Served from memory for `vault_cache_ttl` seconds after a read,
+        unless `fresh` (for when another process may have just changed it).'''
+        if not fresh and (row := vault.recall(username)) is not None:
+            return row
         async with self as database:
             async with database.execute(f"SELECT * FROM {self.table_name} WHERE username=?", (username,)) as cursor:
-                return await cursor.fetchone()
+                row = await cursor.fetchone()
+        if row is not None:
+            row = vault.open_row(row)
+            vault.remember(username, row)
+        return row
     
     async def set(self, username, data: dict) -> None:
+        '''Stores the given fields, keeping the rest. Credentials are encrypted when `vault` is on.'''
+        current = await self.get(username, fresh=True)
+        row = vault.seal((username, *(
+            data[column] if column in data else current[index] if current is not None else None
+            for index, column in enumerate(['session_token', 'bullet_token', 'g_token', 'user_data', 'statink_key'], start=1)
+        )))
+        vault.forget(username)
         async with self as database:
-            session_token = data['session_token'] if 'session_token' in data else (await self.get(username))[1] if username in self else None
-            bullet_token = data['bullet_token'] if 'bullet_token' in data else (await self.get(username))[2] if username in self else None
-            g_token = data['g_token'] if 'g_token' in data else (await self.get(username))[3] if username in self else None
-            user_data = data['user_data'] if 'user_data' in data else (await self.get(username))[4] if username in self else None
-            statink_key = data['statink_key'] if 'statink_key' in data else (await self.get(username))[5] if username in self else None
-            if username in self:
-                await database.execute(f"UPDATE {self.table_name} SET session_token=?, bullet_token=?, g_token=?, user_data=?, statink_key=? WHERE username=?", (session_token, bullet_token, g_token, user_data, statink_key, username,))
+            if current is not None:
+                await database.execute(f"UPDATE {self.table_name} SET session_token=?, bullet_token=?, g_token=?, user_data=?, statink_key=? WHERE username=?", (*row[1:], username,))
             else:
-                await database.execute(f"INSERT INTO {self.table_name} VALUES (?, ?, ?, ?, ?, ?)", (username, session_token, bullet_token, g_token, user_data, statink_key,))
+                await database.execute(f"INSERT INTO {self.table_name} VALUES (?, ?, ?, ?, ?, ?)", row)
             await database.commit()
 
+    async def reseal(self) -> int:
+        '''Rewrites every user's credentials the way `vault` says: encrypted if it's on, plaintext if not. Returns the number of users.'''
+        rows = [vault.open_row(row) for row in await self.list()]
+        async with self as database:
+            await database.executemany(f"UPDATE {self.table_name} SET session_token=?, bullet_token=?, g_token=?, user_data=?, statink_key=? WHERE username=?",
+                                       [(*vault.seal(row)[1:], row[0]) for row in rows])
+            await database.commit()
+        vault.forget()
+        return len(rows)
+
     async def contains(self, username):
         async with self as database:
             async with database.execute(f"SELECT * FROM {self.table_name} WHERE username=?", (username,)) as cursor:
                 return await cursor.fetchone() is not None
 
-    async def create_table(self):
+    async def acquire_lease(self, name: str, owner: str, ttl: int) -> bool:
+        '''Takes the lease `name` (e.g. "tokens:<username>") for `ttl` seconds, unless another owner holds an unexpired one.
+        Leases are rows in main.db, so they work across fleet processes. Re-acquiring your own lease extends it.'''
+        now = int(time())
+        async with self as database:
+            await database.execute(
+                "INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT(name) DO UPDATE SET owner=excluded.owner, expires=excluded.expires "
+                "WHERE leases.expires<? OR leases.owner=excluded.owner", (name, owner, now + ttl, now,))
+            await database.commit()
+            async with database.execute("SELECT owner FROM leases WHERE name=?", (name,)) as cursor:
+                return (await cursor.fetchone())[0] == owner
+
+    async def release_lease(self, name: str, owner: str) -> None:
+        async with self as database:
+            await database.execute("DELETE FROM leases WHERE name=? AND owner=?", (name, owner,))
+            await database.commit()
+
+class UploadDatabase(Database):
+    '''Remembers what was last sent to stat.ink for each battle, so unchanged battles aren't sent twice'''
+    def __init__(self):
+        self.database_name = params.get('database_path', 'main.db')
+        self.table_name = "uploads"
+        self.migrations = [
+            [
+                'CREATE TABLE IF NOT EXISTS uploads ("id" TEXT PRIMARY KEY UNIQUE NOT NULL, "username" TEXT NOT NULL, "payload_hash" TEXT NOT NULL, "complete" INTEGER NOT NULL, "response" TEXT, "uploaded_at" INTEGER NOT NULL)',
+                'CREATE INDEX IF NOT EXISTS uploads_incomplete ON uploads (username, complete)',
+            ],
+        ]
+
+    async def get(self, battle_id: str) -> tuple | None:
+        '''Returns (id, username, payload_hash, complete, response, uploaded_at), or None if never uploaded'''
+        async with self as database:
+            async with database.execute(f"SELECT * FROM {self.table_name} WHERE id=?", (battle_id,)) as cursor:
+                return await cursor.fetchone()
+
+    async def set(self, battle_id: str, username: str, payload_hash: str, complete: bool, response: str | None) -> None:
+        async with self as database:
+            await database.execute(f"INSERT OR REPLACE INTO {self.table_name} VALUES (?, ?, ?, ?, ?, ?)", (battle_id, username, payload_hash, int(complete), response, int(time()),))
+            await database.commit()
+
+    async def incomplete(self, username: str) -> list:
+        '''Returns the ids of uploaded battles that were sent with fields still missing'''
+        async with self as database:
+            async with database.execute(f"SELECT id FROM {self.table_name} WHERE username=? AND complete=0", (username,)) as cursor:
+                return [row[0] for row in await cursor.fetchall()]
+
+    async def uploaded(self, username: str) -> set:
+        '''Returns the ids of every battle this user has had accepted by stat.ink'''
+        async with self as database:
+            async with database.execute(f"SELECT id FROM {self.table_name} WHERE username=?", (username,)) as cursor:
+                return {row[0] for row in await cursor.fetchall()}
+
+class UuidListDatabase(Database):
+    '''The last stat.ink uuid-list downloaded for each user, with the validators (ETag, Last-Modified) it came with
+    and a hash of the API key it was downloaded with, since the list belongs to the key rather than the user'''
+    def __init__(self):
+        self.database_name = params.get('database_path', 'main.db')
+        self.table_name = "uuid_lists"
+        self.migrations = [
+            ['CREATE TABLE IF NOT EXISTS uuid_lists ("username" TEXT PRIMARY KEY NOT NULL, "etag" TEXT, "last_modified" TEXT, "uuids" TEXT NOT NULL, "fetched_at" INTEGER NOT NULL)'],
+            # lists stored before this can't be told apart by key, so they're downloaded again
+            ['DELETE FROM uuid_lists', 'ALTER TABLE uuid_lists ADD COLUMN "key_hash" TEXT'],
+        ]
+
+    async def get(self, username: str, key_hash: str) -> tuple | None:
+        '''Returns (username, etag, last_modified, uuids, fetched_at), or None if the list was never downloaded with this key'''
+        async with self as database:
+            async with database.execute(f"SELECT username, etag, last_modified, uuids, fetched_at FROM {self.table_name} WHERE username=? AND key_hash=?", (username, key_hash,)) as cursor:
+                row = await cursor.fetchone()
+        return (*row[:3], json_loads(row[3]), row[4]) if row is not None else None
+
+    async def set(self, username: str, key_hash: str, etag: str | None, last_modified: str | None, uuids: list) -> None:
+        async with self as database:
+            await database.execute(f"INSERT OR REPLACE INTO {self.table_name} VALUES (?, ?, ?, ?, ?, ?)", (username, etag, last_modified, json.dumps(uuids), int(time()), key_hash,))
+            await database.commit()
+
+class PendingFieldDatabase(Database):
+    '''Fields that can only be known once later battles are played (rank_after, x_power_after, challenge win/loss).
+    A row is added with a NULL value when a battle is uploaded without it, and filled in once a later history poll has it.'''
+    def __init__(self):
+        self.database_name = params.get('database_path', 'main.db')
+        self.table_name = "pending_fields"
+        self.migrations = [
+            [
+                'CREATE TABLE IF NOT EXISTS pending_fields ("id" TEXT NOT NULL, "username" TEXT NOT NULL, "splatnet_id" TEXT NOT NULL, "lobby" TEXT NOT NULL, "field" TEXT NOT NULL, "value" TEXT, PRIMARY KEY (id, field))',
+                'CREATE INDEX IF NOT EXISTS pending_fields_unresolved ON pending_fields (username, value)',
+            ],
+        ]
+
+    async def get(self, battle_id: str) -> dict:
+        '''Returns {field: value} for a battle, where unresolved fields are None'''
+        async with self as database:
+            async with database.execute(f"SELECT field, value FROM {self.table_name} WHERE id=?", (battle_id,)) as cursor:
+                return {field: json_loads(value) if value is not None else None for field, value in await cursor.fetchall()}
+
+    async def add(self, battle_id: str, username: str, splatnet_id: str, lobby: str, field: str) -> None:
+        async with self as database:
+            await database.execute(f"INSERT OR IGNORE INTO {self.table_name} VALUES (?, ?, ?, ?, ?, NULL)", (battle_id, username, splatnet_id, lobby, field,))
+            await database.commit()
+
+    async def unresolved(self, username: str) -> list:
+        '''Returns (id, splatnet_id, lobby, field) for every field still waiting on a later battle'''
+        async with self as database:
+            async with database.execute(f"SELECT id, splatnet_id, lobby, field FROM {self.table_name} WHERE username=? AND value IS NULL", (username,)) as cursor:
+                return await cursor.fetchall()
+
+    async def resolve(self, values: list) -> None:
+        '''Takes a list of (id, field, value) and stores them all in one transaction'''
         async with self as database:
-            await database.execute(f"CREATE TABLE {self.table_name} {self.schema}")
+            await database.executemany(f"UPDATE {self.table_name} SET value=? WHERE id=? AND field=?", [(json.dumps(value), battle_id, field) for battle_id, field, value in values])
             await database.commit()
+
+class CacheDatabase(Database):
+    '''On-disk copy of packed Cache entries, so compact history and battle responses survive restarts.
+    Used when `cache_path` is set and `cache_format` isn't 'dict'. Keys are hashed, tokens never hit the disk.'''
+    def __init__(self, database_name: str):
+        self.database_name = database_name
+        self.table_name = "cache"
+        self.migrations = [
+            ['CREATE TABLE IF NOT EXISTS cache ("key" TEXT PRIMARY KEY NOT NULL, "kind" TEXT NOT NULL, "blob" BLOB NOT NULL, "expires" INTEGER NOT NULL)'],
+        ]
+
+    @staticmethod
+    def hash_key(key) -> str:
+        return hashlib.sha256(repr(key).encode()).hexdigest()
+
+    async def get(self, key) -> dict | None:
+        async with self as database:
+            async with database.execute(f"SELECT kind, blob, expires FROM {self.table_name} WHERE key=?", (self.hash_key(key),)) as cursor:
+                row = await cursor.fetchone()
+        return {row[0]: row[1], 'expires': row[2]} if row is not None else None
+
+    async def set(self, key, entry: dict) -> None:
+        kind = 'packed' if 'packed' in entry else 'compressed'
+        async with self as database:
+            await database.execute(f"DELETE FROM {self.table_name} WHERE expires!=-1 AND expires<?", (int(time()),))
+            await database.execute(f"INSERT OR REPLACE INTO {self.table_name} VALUES (?, ?, ?, ?)", (self.hash_key(key), kind, entry[kind], entry['expires'],))
+            await database.commit()
+
+class MetadataDatabase(Database):
+    '''Weapon, stage and ability tables from stat.ink (see metadata.py), packed with compact.pack, one row per SplatNet version'''
+    def __init__(self):
+        self.database_name = params.get('database_path', 'main.db')
+        self.table_name = "metadata"
+        self.migrations = [
+            ['CREATE TABLE IF NOT EXISTS metadata ("version" TEXT PRIMARY KEY NOT NULL, "blob" BLOB NOT NULL, "fetched_at" INTEGER NOT NULL)'],
+        ]
+
+    async def get(self, version: str) -> bytes | None:
+        async with self as database:
+            async with database.execute(f"SELECT blob FROM {self.table_name} WHERE version=?", (version,)) as cursor:
+                row = await cursor.fetchone()
+        return row[0] if row is not None else None
+
+    async def set(self, version: str, blob: bytes) -> None:
+        async with self as database:
+            await database.execute(f"INSERT OR REPLACE INTO {self.table_name} VALUES (?, ?, ?)", (version, blob, int(time()),))
+            await database.commit()
+
+_user_database: UserDatabase | None = None
+_upload_database: UploadDatabase | None = None
+_pending_field_database: PendingFieldDatabase | None = None
+_uuid_list_database: UuidListDatabase | None = None
+_metadata_database: MetadataDatabase | None = None
+
+def get_user_database() -> UserDatabase:
+    '''Returns the shared UserDatabase. Its tables are created (or migrated) on first query.'''
+    global _user_database
+    if _user_database is None:
+        # the sync dunder methods call asyncio.run from inside the running loop
+        import nest_asyncio
+        nest_asyncio.apply()
+        _user_database = UserDatabase()
+    return _user_database
+
+def get_upload_database() -> UploadDatabase:
+    global _upload_database
+    if _upload_database is None:
+        get_user_database()
+        _upload_database = UploadDatabase()
+    return _upload_database
+
+def get_pending_field_database() -> PendingFieldDatabase:
+    global _pending_field_database
+    if _pending_field_database is None:
+        get_user_database()
+        _pending_field_database = PendingFieldDatabase()
+    return _pending_field_database
+
+def get_uuid_list_database() -> UuidListDatabase:
+    global _uuid_list_database
+    if _uuid_list_database is None:
+        get_user_database()
+        _uuid_list_database = UuidListDatabase()
+    return _uuid_list_database
+
+def get_metadata_database() -> MetadataDatabase:
+    global _metadata_database
+    if _metadata_database is None:
+        get_user_database()
+        _metadata_database = MetadataDatabase()
+    return _metadata_database
+
+_cache_database: CacheDatabase | None = None
+
+def get_cache_database() -> CacheDatabase | None:
+    '''Returns the shared on-disk cache, or None if `cache_path` isn't set or entries aren't packed'''
+    global _cache_database
+    if not params.get('cache_path') or params.get('cache_format', 'dict') == 'dict':
+        return None
+    if _cache_database is None:
+        _cache_database = CacheDatabase(params['cache_path'])
+    return _cache_database
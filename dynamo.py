@@ -1,30 +1,60 @@
-import aiohttp, os
+import os, sys
 from subprocess import call, STDOUT
 
-import data, statink, splatnet, nso
-from database import UserDatabase
+import data, statink, splatnet, nso, utils, events, planner, metadata, backfill
+from database import get_user_database, get_upload_database
 from loader import Loader
+from progress import Progress
 
-db = UserDatabase()
+aiohttp = utils.lazy_import('aiohttp')
 
 async def find_missing_battles(username: str, mode: str = 'latest') -> tuple[list, list]:
     """Finds missing battles byh comparing uploaded battles on Stat.ink with all battles on Splatnet"""
     await splatnet.check_tokens_and_regenerate(username)
+    try:
+        await metadata.refresh()
+    except Exception as e:
+        # keys are worked out from names without the tables, so this never stops a sync
+        print(f"Couldn't update weapon and stage metadata: {e!r}", file=sys.stderr)
     loader = Loader(f"Finding missing battles for {username}...", detailed=False).start()
+    db = get_user_database()
     bullet_token, g_token, stat_ink_api_key = db[username][2], db[username][3], db[username][5]
-    uploaded_battles = await statink.fetch_uploaded_battles(stat_ink_api_key)
-    all_battles = await splatnet.fetch_battle_ids(bullet_token, g_token, mode)
-    missing_battles = [i for i in all_battles if i not in uploaded_battles]
+    uploaded_battles = await statink.fetch_uploaded_battles(stat_ink_api_key, username)
+    missing_battles, all_battles = [], {}
+    async for battle_id, splatnet_id in splatnet.iter_battle_ids(bullet_token, g_token, mode):
+        if battle_id in all_battles:
+            continue
+        all_battles[battle_id] = splatnet_id
+        if battle_id not in uploaded_battles:
+            missing_battles.append(battle_id)
+    planner.note_battles(username, all_battles.values())
     loader.stop()
     return missing_battles, all_battles
 
 async def upload_missing_battles(username: str, missing_battle_ids: list) -> None:
     """Uploads battles to stat.ink from the list of missing battle IDs"""
     loader = Loader("Uploading missing battles...", detailed=False).start()
-    for battle in missing_battle_ids:
-        await statink.upload_battle(username, battle)
+    # oldest first, so each battle's predecessor has already been fetched
+    previous_powers = {}
+    events.emit('sync_started', username=username, queued=len(missing_battle_ids))
+    for done, battle in enumerate(sorted(missing_battle_ids, key=utils.battle_played_at), start=1):
+        await statink.upload_battle(username, battle, previous_powers, missing=True)
+        events.emit('sync_progress', username=username, remaining=len(missing_battle_ids) - done)
     loader.stop()
 
+async def reupload_incomplete_battles(username: str, all_battles: dict) -> int:
+    """Re-sends battles that were uploaded before all of their fields were known, if they've since changed. Returns how many were sent."""
+    pending = [battle_id for battle_id in await get_upload_database().incomplete(username) if battle_id in all_battles]
+    if not pending:
+        return 0
+    loader = Loader("Updating incomplete battles...", detailed=False).start()
+    sent = 0
+    previous_powers = {}
+    for battle_id in sorted(pending, key=lambda battle_id: utils.battle_played_at(all_battles[battle_id])):
+        sent += await statink.upload_battle(username, all_battles[battle_id], previous_powers)
+    loader.stop()
+    return sent
+
 async def check_if_git_installed() -> bool:
     """Checks if git is installed on the system"""
     return call(["git", "--version"], stdout=open(os.devnull, 'w'), stderr=STDOUT) == 0
@@ -33,34 +63,37 @@ async def check_if_git_repo() -> bool:
     """Checks if the current directory is a git repository"""
     return os.path.exists(".git")
 
-async def check_for_updates() -> None:
-    """Checks if there is an updated version of the script available on Github"""
+async def check_for_updates(interactive: bool = True) -> None:
+    """Checks if there is an updated version of the script available on Github. Never prompts or pulls when not interactive."""
     loader = Loader("Checking for updates...", detailed=False).start()
     async with aiohttp.ClientSession() as session:
         async with session.get("https://raw.githubusercontent.com/howlagon/dynamo/main/version") as r:
             if r.status != 200:
                 loader.stop()
-                print("Failed to check for updates!")
+                Progress.log("Failed to check for updates!")
                 return None
             latest_version = await r.text()
     
     loader.stop()
     if latest_version.strip() == data.APP_VERSION:
         return
-    print(f"An updated version of Dynamo is available! (v{latest_version.strip()})")
-    if await check_if_git_installed() and await check_if_git_repo():
+    Progress.log(f"An updated version of Dynamo is available! (v{latest_version.strip()})")
+    if interactive and await check_if_git_installed() and await check_if_git_repo():
         update = input("Would you like to update Dynamo? (Y/n): ")
         if update.lower() in ['y', 'yes', '', ' ']:
             call(["git", "pull"])
-            print("Dynamo will now restart to apply the update.")
+            Progress.log("Dynamo will now restart to apply the update.")
             os._exit(0)
         else:
-            print("Run `git pull` to update Dynamo.")
+            Progress.log("Run `git pull` to update Dynamo.")
+    elif await check_if_git_repo():
+        Progress.log("Run `git pull` to update Dynamo.")
     else:
-        print("Please navigate to `https://github.com/howlagon/dynamo` to update Dynamo.")
+        Progress.log("Please navigate to `https://github.com/howlagon/dynamo` to update Dynamo.")
 
 async def check_login(username: str | None = None) -> bool:
     """Checks if the user exists in the database, or if the database is empty"""
+    db = get_user_database()
     if username is None:
         return len(db) > 0
     return db[username] is not None
@@ -71,37 +104,49 @@ async def login() -> None:
     has_token = input("Do you have the session token of the user you want to login as? (y/N) ")
     if has_token.lower() in ['y', 'yes']:
         session_token = input("Enter the session token of the user: ")
-        login_manager.login_with_token(session_token)
+        await login_with_session_token(session_token)
         return
-    print('Please consider reading through the "Token Generation" section in the README before proceeding.')
-    print('Log in to the following url, right click the "Select this account" button, copy the link address, and then paste it here.')
+    Progress.log('Please consider reading through the "Token Generation" section in the README before proceeding.')
+    Progress.log('Log in to the following url, right click the "Select this account" button, copy the link address, and then paste it here.')
     data = input(login_manager.login_url + "\n")
     username, session_token, bullet_token, g_token, user_data, stat_ink_key = await login_manager.login(data)
-    db[username] = {
+    get_user_database()[username] = {
         'session_token': session_token,
         'bullet_token': bullet_token,
         'g_token': g_token,
         'user_data': user_data,
-        'stat_ink_key': stat_ink_key
+        'statink_key': stat_ink_key
     }
 
+async def login_with_session_token(session_token: str, statink_key: str | None = None) -> str:
+    """Logs in without any prompts using an existing session token, then adds the tokens to the database. Returns the username."""
+    login_manager = nso.LoginManager()
+    username, session_token, bullet_token, g_token, user_data, _ = await login_manager.login_with_token(session_token)
+    await get_user_database().set(username, {
+        'session_token': session_token,
+        'bullet_token': bullet_token,
+        'g_token': g_token,
+        'user_data': user_data,
+        'statink_key': statink_key
+    })
+    return username
+
 async def get_users() -> list:
     """Returns a list of all users in the database"""
-    return list([i[0] for i in await db.list()])
+    return list([i[0] for i in await get_user_database().list()])
 
 async def find_and_upload_missing_battles(username: str, check_all: bool = False) -> None:
     """Finds and uploads all missing battles in the latest battles, and other modes if it's the first time the user is running the script"""
-    modes = ["latest"]
     if check_all:
-        modes += ["regular", "bankara", 'xmatch', 'event', 'pbs'] 
-    missing_battles, all_battles = [], []
-    for mode in modes:
-        a, b = await find_missing_battles(username, mode)
-        missing_battles += a
-        all_battles += b
-    del a, b
+        # most at risk of expiring first, sharing the upload budget with any other backfill running
+        await backfill.run([username])
+        return
+    missing_battles, all_battles = await find_missing_battles(username, 'latest')
+    # fields deferred on earlier polls, from the history just fetched. new battles resolve theirs as they're formatted
+    await statink.resolve_deferred_fields(username)
     missing_battle_ids = [all_battles[i] for i in missing_battles]
     if missing_battle_ids:
         await upload_missing_battles(username, missing_battle_ids)
     else:
-        print("No missing battles found!")
\ No newline at end of file
+        Progress.log("No missing battles found!")
+    await reupload_incomplete_battles(username, all_battles)
\ No newline at end of file
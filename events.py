@@ -0,0 +1,132 @@
+import asyncio, json, os, sys
+from time import time
+
+import metrics
+from config import params
+
+# events waiting for a slow subscriber before the oldest ones are dropped
+QUEUE_SIZE: int = 1000
+# webhook delivery: events per POST, seconds to wait for a batch to fill, and attempts per batch
+WEBHOOK_BATCH_SIZE: int = 50
+WEBHOOK_BATCH_INTERVAL: float = 5
+WEBHOOK_RETRIES: int = 5
+
+class EventBus:
+    '''Process-wide publish/subscribe for things Dynamo did. Every event is a JSON-able dict with 'type' and 'time'.
+
+    Types:
+     - battle_uploaded: username, uuid, lobby, rule, result, url
+     - token_refreshed: username
+     - sync_started: username, queued (battles about to be uploaded)
+     - sync_progress: username, remaining
+     - presence_changed: username, state (the onlineState a presence watcher saw, e.g. VS_MODE_FIGHTING)'''
+    queues: list = []
+    tasks: list = []
+    servers: list = []
+
+def emit(type: str, **fields) -> dict:
+    '''Hands an event to every subscriber without waiting on any of them'''
+    event = {'type': type, 'time': round(time(), 3), **fields}
+    for queue in EventBus.queues:
+        if queue.full():
+            queue.get_nowait() # a subscriber that can't keep up loses its oldest events, not everyone else's
+            metrics.increment('dynamo_events_dropped_total')
+        queue.put_nowait(event)
+    metrics.increment('dynamo_events_total', type=type)
+    return event
+
+def subscribe(maxsize: int = QUEUE_SIZE) -> asyncio.Queue:
+    '''Returns a queue that receives every event emitted from now on. Pass it to unsubscribe when done.'''
+    queue = asyncio.Queue(maxsize)
+    EventBus.queues.append(queue)
+    return queue
+
+def unsubscribe(queue: asyncio.Queue) -> None:
+    if queue in EventBus.queues:
+        EventBus.queues.remove(queue)
+
+async def serve_unix(path: str) -> asyncio.AbstractServer:
+    '''Streams events as JSON lines to every client that connects to a Unix socket at `path`'''
+    async def handler(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        queue = subscribe()
+        try:
+            while True:
+                writer.write(json.dumps(await queue.get()).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            unsubscribe(queue)
+            writer.close()
+    if os.path.exists(path):
+        os.remove(path)
+    server = await asyncio.start_unix_server(handler, path)
+    EventBus.servers.append(server)
+    return server
+
+async def serve_sse(host: str = '127.0.0.1', port: int = 9465):
+    '''Starts an aiohttp server streaming events from /events as server-sent events. Returns the runner.'''
+    from aiohttp import web
+    app = web.Application()
+    app.router.add_get('/events', sse_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+async def sse_handler(request):
+    '''aiohttp handler for an SSE stream of events, so other aiohttp apps (see web.py) can mount it too'''
+    from aiohttp import web
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+    await response.prepare(request)
+    queue = subscribe()
+    try:
+        while True:
+            event = await queue.get()
+            await response.write(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode())
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    finally:
+        unsubscribe(queue)
+    return response
+
+async def deliver_webhook(url: str, batch_size: int = WEBHOOK_BATCH_SIZE, interval: float = WEBHOOK_BATCH_INTERVAL, retries: int = WEBHOOK_RETRIES) -> None:
+    '''POSTs events to `url` as JSON arrays, up to `batch_size` at a time, at most every `interval` seconds.
+    A failed batch is retried with exponential backoff, then dropped after `retries` attempts. Runs until cancelled.'''
+    import aiohttp
+    queue = subscribe()
+    try:
+        async with aiohttp.ClientSession() as session:
+            while True:
+                batch = [await queue.get()]
+                deadline = asyncio.get_running_loop().time() + interval
+                while len(batch) < batch_size and (remaining := deadline - asyncio.get_running_loop().time()) > 0:
+                    try:
+                        batch.append(await asyncio.wait_for(queue.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+                for attempt in range(retries):
+                    try:
+                        async with session.post(url, json=batch, timeout=aiohttp.ClientTimeout(total=30)) as r:
+                            if r.status < 500 and r.status != 429:
+                                metrics.increment('dynamo_webhook_batches_total', status=r.status)
+                                break
+                    except (aiohttp.ClientError, asyncio.TimeoutError):
+                        pass
+                    if attempt < retries - 1:
+                        await asyncio.sleep(2 ** attempt)
+                else:
+                    metrics.increment('dynamo_webhook_batches_total', status='dropped')
+                    print(f"Dropped {len(batch)} event(s) for {url} after {retries} attempts", file=sys.stderr)
+    finally:
+        unsubscribe(queue)
+
+async def start(index: int | None = None) -> None:
+    '''Starts the outputs set in config.json: `events_socket` (a Unix socket path), `events_sse_port`, and `webhooks` (URLs).
+    Fleet worker `index` gets the socket path suffixed with its index, and the SSE port plus index + 1.'''
+    if path := params.get('events_socket'):
+        await serve_unix(path if index is None else f'{path}.{index}')
+    if port := params.get('events_sse_port'):
+        EventBus.servers.append(await serve_sse(port=port if index is None else port + index + 1))
+    for url in params.get('webhooks', []):
+        EventBus.tasks.append(asyncio.create_task(deliver_webhook(url)))
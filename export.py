@@ -0,0 +1,97 @@
+import csv, sys
+
+import metadata, statink
+from archive import ArchiveDatabase, BATTLE_COLUMNS, PLAYER_COLUMNS
+
+# rows are buffered this many at a time before being handed to the writer, keeping memory flat
+BATCH_SIZE: int = 4096
+
+# (column, arrow type) for every exported column. stat.ink keys are added next to SplatNet's display names.
+BATTLE_SCHEMA: list = [
+    ('id', 'string'), ('played_time', 'int64'), ('duration', 'int32'), ('mode', 'string'),
+    ('rule', 'string'), ('rule_key', 'string'), ('stage', 'string'), ('stage_key', 'string'),
+    ('weapon', 'string'), ('weapon_key', 'string'), ('result', 'string'), ('knockout', 'string'),
+    ('kill', 'int32'), ('assist', 'int32'), ('death', 'int32'), ('special', 'int32'), ('paint', 'int32'), ('power', 'float64'),
+]
+PLAYER_SCHEMA: list = [
+    ('battle_id', 'string'), ('played_time', 'int64'), ('mode', 'string'), ('rule', 'string'), ('rule_key', 'string'),
+    ('stage', 'string'), ('stage_key', 'string'), ('result', 'string'), ('team', 'int8'), ('position', 'int8'),
+    ('is_myself', 'bool_'), ('name', 'string'), ('name_id', 'string'), ('species', 'string'),
+    ('weapon', 'string'), ('weapon_key', 'string'), ('kill', 'int32'), ('assist', 'int32'), ('death', 'int32'),
+    ('special', 'int32'), ('paint', 'int32'), ('disconnected', 'bool_'),
+]
+
+async def iter_export_rows(username: str, per: str = 'battle', database: ArchiveDatabase | None = None):
+    """Yields export rows as dicts keyed by the schema's columns, one archive row at a time"""
+    columns = BATTLE_COLUMNS if per == 'battle' else PLAYER_COLUMNS
+    database = database if database is not None else ArchiveDatabase()
+    async for row in database.iter_rows(username, per):
+        record = dict(zip(columns, row))
+        record['rule_key'] = await statink.find_statink_mode_rule(record['rule'])
+        record['stage_key'] = metadata.key('stages', record['stage'])
+        record['weapon_key'] = metadata.key('weapons', record['weapon']) if record['weapon'] else None
+        if per == 'player':
+            record['is_myself'] = bool(record['is_myself'])
+            record['disconnected'] = bool(record['disconnected'])
+        yield record
+
+async def _batches(rows, size: int = BATCH_SIZE):
+    batch = []
+    async for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+async def export_csv(username: str, output, per: str = 'battle', database: ArchiveDatabase | None = None) -> int:
+    """Writes the user's archive to `output` (a path, or '-' for stdout) as CSV. Returns the number of rows written."""
+    schema = BATTLE_SCHEMA if per == 'battle' else PLAYER_SCHEMA
+    fp = sys.stdout if output == '-' else open(output, 'w', newline='', encoding='utf-8')
+    try:
+        writer = csv.DictWriter(fp, fieldnames=[name for name, _ in schema], extrasaction='ignore')
+        writer.writeheader()
+        count = 0
+        async for batch in _batches(iter_export_rows(username, per, database)):
+            writer.writerows(batch)
+            count += len(batch)
+        return count
+    finally:
+        if fp is not sys.stdout:
+            fp.close()
+
+async def export_arrow(username: str, output: str, per: str = 'battle', format: str = 'parquet', database: ArchiveDatabase | None = None) -> int:
+    """Writes the user's archive to a Parquet or Arrow IPC file, one record batch at a time. Needs `pyarrow`."""
+    if output == '-':
+        raise ValueError(f"{format} is binary and can't go to stdout, pick an output file")
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise RuntimeError("Exporting to parquet/arrow needs pyarrow. Install it with `pip install pyarrow`, or export to csv instead.")
+    schema = pa.schema([(name, getattr(pa, type)()) for name, type in (BATTLE_SCHEMA if per == 'battle' else PLAYER_SCHEMA)])
+    if format == 'parquet':
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(output, schema, compression='zstd')
+        write = writer.write_batch
+    else:
+        import pyarrow.ipc
+        writer = pa.ipc.new_file(output, schema)
+        write = writer.write_batch
+    count = 0
+    try:
+        async for batch in _batches(iter_export_rows(username, per, database)):
+            write(pa.RecordBatch.from_pylist(batch, schema=schema))
+            count += len(batch)
+    finally:
+        writer.close()
+    return count
+
+async def export(username: str, output: str, format: str = 'csv', per: str = 'battle', database: ArchiveDatabase | None = None) -> int:
+    match format:
+        case 'csv':
+            return await export_csv(username, output, per, database)
+        case 'parquet' | 'arrow':
+            return await export_arrow(username, output, per, format, database)
+        case _:
+            raise ValueError(f'Unknown export format {format}')
@@ -0,0 +1,82 @@
+import asyncio, hashlib, multiprocessing, os, signal, sys, time
+from multiprocessing.connection import wait
+
+import config
+
+# a worker that crashes is restarted after this many seconds, doubling on every crash in a row up to RESTART_BACKOFF_MAX
+RESTART_BACKOFF: float = 1
+RESTART_BACKOFF_MAX: float = 60
+# a worker that stayed up this long is considered healthy again, and its backoff starts over
+HEALTHY_AFTER: float = 60
+
+def shard_of(username: str, shards: int) -> int:
+    '''Which of `shards` workers owns a user. Stable across processes and runs, unlike hash().'''
+    return int.from_bytes(hashlib.sha1(username.encode()).digest()[:8], 'big') % shards
+
+def run_worker(index: int, shards: int, parent_params: dict, backfill: bool) -> None:
+    '''Entry point of a fleet worker process: monitors the users in its shard until SIGTERM'''
+    config.params.clear()
+    config.params.update(parent_params)
+    import database, offload
+    asyncio.run(_worker(index, shards, backfill))
+    asyncio.run(database.close_all())
+    offload.shutdown()
+    os._exit(0)
+
+async def _worker(index: int, shards: int, backfill: bool) -> None:
+    import dynamo, metrics, events
+    from main import monitor
+    metrics.configure()
+    if config.params.get('metrics') and config.params.get('metrics_sink') == 'prometheus':
+        # the supervisor's port plus one per worker
+        await metrics.serve_prometheus(port=config.params.get('metrics_port', 9464) + index + 1)
+    await events.start(index)
+    users = [username for username in await dynamo.get_users() if shard_of(username, shards) == index]
+    print(f"Fleet worker {index} ({os.getpid()}) monitoring {len(users)} user(s)", file=sys.stderr)
+    await monitor(users, backfill=backfill)
+
+def supervise(workers: int, backfill: bool = False) -> int:
+    '''Runs `workers` worker processes, each owning the users that shard_of assigns it, restarting any that crash.
+    SIGINT/SIGTERM stop every worker gracefully. Users added while running are picked up on the next start.'''
+    context = multiprocessing.get_context('spawn')
+    parent_params = dict(config.params)
+    processes, started, backoff, restart_at = {}, {}, {}, {}
+    stopping = False
+
+    def start(index: int) -> None:
+        process = context.Process(target=run_worker, args=(index, workers, parent_params, backfill), name=f'dynamo-fleet-{index}')
+        process.start()
+        processes[index], started[index] = process, time.monotonic()
+
+    def stop(*_) -> None:
+        nonlocal stopping
+        stopping = True
+        for process in processes.values():
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for index in range(workers):
+        start(index)
+    while not stopping or any(process.is_alive() for process in processes.values()):
+        alive = [process.sentinel for process in processes.values() if process.is_alive()]
+        if alive:
+            wait(alive, timeout=1)
+        else:
+            time.sleep(1)
+        if stopping:
+            continue
+        now = time.monotonic()
+        for index, process in processes.items():
+            if process.is_alive() or index in restart_at:
+                continue
+            uptime = now - started[index]
+            backoff[index] = RESTART_BACKOFF if uptime >= HEALTHY_AFTER else min(backoff.get(index, RESTART_BACKOFF / 2) * 2, RESTART_BACKOFF_MAX)
+            restart_at[index] = now + backoff[index]
+            print(f"Fleet worker {index} exited with {process.exitcode} after {uptime:.0f}s, restarting in {backoff[index]:.0f}s", file=sys.stderr)
+        for index, when in list(restart_at.items()):
+            if when <= now:
+                del restart_at[index]
+                start(index)
+    return 0
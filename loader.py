@@ -1,71 +1,47 @@
-# https://stackoverflow.com/a/66558182/16126645
-
-from itertools import cycle
-from shutil import get_terminal_size
-from threading import Thread
-from time import sleep
+import asyncio
 
 from config import params
+from progress import Progress
 
 
 class Loader:
     def __init__(self, desc="Loading...", end="", timeout=0.1, step_type=0, detailed=None):
         """
-        A loader-like context manager
+        A loader-like context manager, drawn by the shared asyncio `Progress` renderer
 
         Args:
             desc (str, optional): The loader's description. Defaults to "Loading...".
-            end (str, optional): Final print. Defaults to "Done!".
-            timeout (float, optional): Sleep time between prints. Defaults to 0.1.
+            end (str, optional): Final print. Defaults to "".
+            timeout (float, optional): Unused, kept for compatibility. The renderer's interval is `Progress.interval`.
+            step_type (int, optional): Unused, kept for compatibility.
+            detailed (bool | None, optional): Only show when detailed output is on (True), off (False), or always (None).
         """
         self.desc = desc
         self.end = end
-        self.timeout = timeout
         self.detailed = detailed
-
-        if params['threaded']:
-            self._thread = Thread(target=self._animate, daemon=True)
-        self.step_options = [
-            ["⢿", "⣻", "⣽", "⣾", "⣷", "⣯", "⣟", "⡿"],
-            ["⢻", "⣹", "⣼", "⣶", "⣧", "⣏", "⡟", "⠿"],
-            ["|", "/", "-", "\\"],
-        ]
-        self.steps = self.step_options[step_type]
+        self._task_id = None
         self.done = False
 
-    def start(self):
+    def _visible(self) -> bool:
         if self.detailed and not params['detailed']:
-            return self
+            return False
         if self.detailed == False and params['detailed']:
-            return self
-        if not params['threaded']:
-            print(f"{self.desc}", end="", flush=True)
-            return self
-        self._thread.start()
-        return self
+            return False
+        return True
 
-    def _animate(self):
-        for c in cycle(self.steps):
-            if self.done:
-                break
-            print(f"\r{c} {self.desc}", flush=True, end="")
-            sleep(self.timeout)
+    def start(self):
+        if self._visible():
+            self._task_id = Progress.begin(self.desc)
+        return self
 
     def __enter__(self):
-        self.start()
+        return self.start()
 
     def stop(self):
         self.done = True
-        if self.detailed and not params['detailed']:
-            return
-        if self.detailed == False and params['detailed']:
-            return
-        cols = get_terminal_size((80, 20)).columns
-        line_start = "\n"
-        if params['flush_prints']:
-            print("\r" + " " * cols, end="", flush=True)
-            line_start = "\r"
-        print(f"{line_start}{self.end}", flush=True, end="\n" if self.end else f"\r")
+        if self._task_id is not None:
+            Progress.end(self._task_id, self.end)
+            self._task_id = None
 
     def __exit__(self, exc_type, exc_value, tb):
         # handle exceptions with those variables ^
@@ -73,11 +49,13 @@ class Loader:
 
 
 if __name__ == "__main__":
-    with Loader("Loading with context manager..."):
-        for i in range(10):
-            sleep(0.25)
+    async def demo():
+        with Loader("Loading with context manager..."):
+            await asyncio.sleep(2.5)
+
+        loaders = [Loader(f"Loading with object #{i}...", "That was fast!" if i == 4 else "").start() for i in range(5)]
+        for loader in loaders:
+            await asyncio.sleep(0.5)
+            loader.stop()
 
-    loader = Loader("Loading with object...", "That was fast!", 0.05).start()
-    for i in range(10):
-        sleep(0.25)
-    loader.stop()
\ No newline at end of file
+    asyncio.run(demo())
@@ -1,28 +1,229 @@
-import os, json, asyncio
+import os, sys, asyncio, argparse, signal, traceback
+from time import monotonic
 import config, data
+from progress import Progress
 
+def parse_args(argv: list | None = None) -> argparse.Namespace:
+    """Parses command line arguments. Every flag can also be set with the DYNAMO_* environment variable named in its help."""
+    env = os.environ.get
+    parser = argparse.ArgumentParser(prog='dynamo', description='All the fun of using stat.ink with none of the hassle.')
+    parser.add_argument('--version', action='version', version=f'Dynamo v{data.APP_VERSION}')
+    parser.add_argument('--config', default=env('DYNAMO_CONFIG', config.CONFIG_PATH), help='path to config.json (DYNAMO_CONFIG)')
+    parser.add_argument('--update-check', action=argparse.BooleanOptionalAction, default=None,
+                        help='check GitHub for a newer version on startup. On by default only when run without a command (DYNAMO_UPDATE_CHECK)')
+    parser.add_argument('--refresh', type=int, default=None, help='seconds between polls of users who played recently in monitor mode, and cache lifetime (DYNAMO_REFRESH)')
+    parser.add_argument('--detailed', action=argparse.BooleanOptionalAction, default=None, help='show detailed step output (DYNAMO_DETAILED)')
+
+    subparsers = parser.add_subparsers(dest='command')
+    for name, help in [('sync', 'upload missing battles from the latest battles, then exit'),
+                       ('backfill', 'upload missing battles from every mode, then exit'),
+                       ('monitor', 'keep polling and uploading new battles until stopped')]:
+        command = subparsers.add_parser(name, help=help)
+        command.add_argument('-u', '--user', action='append', default=None,
+                             help='only run for this user, can be repeated. Defaults to every user (DYNAMO_USERS, comma separated)')
+    monitor = subparsers.choices['monitor']
+    monitor.add_argument('--backfill', action='store_true', help='backfill every mode before the first poll')
+    monitor.add_argument('--observer', default=None,
+                         help="only sync users who are in or just left a match, going by this user's friend list. Defaults to `presence_observer` (DYNAMO_PRESENCE_OBSERVER)")
+
+    fleet = subparsers.add_parser('fleet', help='monitor every user with several worker processes, each owning a shard of users')
+    fleet.add_argument('-w', '--workers', type=int, default=int(env('DYNAMO_FLEET_WORKERS', 0)) or os.cpu_count() or 1,
+                       help='number of worker processes. Defaults to one per core (DYNAMO_FLEET_WORKERS)')
+    fleet.add_argument('--backfill', action='store_true', help='backfill every mode before each worker\'s first poll')
+
+    web = subparsers.add_parser('web', help='run the dashboard and control server, to log in and start/stop syncing per user')
+    web.add_argument('--host', default=env('DYNAMO_WEB_HOST', '127.0.0.1'), help='(DYNAMO_WEB_HOST)')
+    web.add_argument('--port', type=int, default=int(env('DYNAMO_WEB_PORT', 8080)), help='(DYNAMO_WEB_PORT)')
+    web.add_argument('--start', action='store_true', help='start monitoring every user right away')
+
+    users = subparsers.add_parser('users', help='list users, or add one from a session token')
+    users.add_argument('--add', metavar='SESSION_TOKEN', default=env('DYNAMO_SESSION_TOKEN'),
+                       help='log in with a session token instead of listing users (DYNAMO_SESSION_TOKEN)')
+    users.add_argument('--statink-key', default=env('DYNAMO_STATINK_KEY'), help='stat.ink API key for the added user (DYNAMO_STATINK_KEY)')
+
+    vault = subparsers.add_parser('vault', help='encrypt every stored credential with the vault key')
+    vault.add_argument('--decrypt', action='store_true', help='store them as plaintext again instead')
+
+    export = subparsers.add_parser('export', help='export a user\'s archived battles for analysis (needs the archive turned on)')
+    export.add_argument('-u', '--user', action='append', default=None, help='user to export. Defaults to the only user (DYNAMO_USERS)')
+    export.add_argument('-f', '--format', choices=['csv', 'parquet', 'arrow'], default='csv')
+    export.add_argument('--per', choices=['battle', 'player'], default='battle', help='one row per battle, or one row per player in every battle')
+    export.add_argument('-o', '--output', default='-', help='output file, or - for stdout (csv only)')
+
+    args = parser.parse_args(argv)
+    if args.command == 'export' and args.format != 'csv' and args.output == '-':
+        parser.error(f"-f {args.format} writes a binary file, pick one with -o")
+    if args.update_check is None:
+        value = env('DYNAMO_UPDATE_CHECK')
+        args.update_check = args.command is None if value is None else value.lower() in ['1', 'y', 'yes', 'true', 'on']
+    if getattr(args, 'user', None) is None and env('DYNAMO_USERS'):
+        args.user = [user.strip() for user in env('DYNAMO_USERS').split(',') if user.strip()]
+    return args
+
+def setup_config(args: argparse.Namespace) -> None:
+    """Loads config from file, then environment, then flags. Only prompts for a new config when run interactively."""
+    config.load_config(args.config)
+    config.load_environment()
+    if args.refresh is not None:
+        config.params['refresh'] = args.refresh
+    if args.detailed is not None:
+        config.params['detailed'] = args.detailed
+
+args = parse_args() if __name__ == '__main__' else None
 first_time_setup = False
 if __name__ == "__main__":
-    print(f"{'Freaky ' if config.params['freaky'] else ''}Dynamo v{data.APP_VERSION}")
-    if not os.path.exists('config.json'):
+    setup_config(args)
+    if args.command is None:
+        Progress.log(f"{'Freaky ' if config.params['freaky'] else ''}Dynamo v{data.APP_VERSION}")
+    if args.command is None and not os.path.exists(config.CONFIG_PATH):
         first_time_setup = True
-        print("Config file not found! Generating one now.")
+        Progress.log("Config file not found! Generating one now.")
         asyncio.run(config.generate_config_py())
 
-import dynamo, splatnet, nso
+import dynamo, splatnet, metrics, offload, events, planner, database
 
-async def precheck(username: str = None):
-    await dynamo.check_for_updates()
+async def precheck(username: str = None, check_updates: bool = True):
+    if check_updates:
+        await dynamo.check_for_updates()
     exists = await dynamo.check_login(username)
     if not exists:
         await dynamo.login()
 
+async def resolve_users(requested: list | None) -> list:
+    """Returns the requested users, or every user if none were requested. Exits if any of them aren't logged in."""
+    users = await dynamo.get_users()
+    if not requested:
+        if not users:
+            print("No users found! Add one with `users --add SESSION_TOKEN`.", file=sys.stderr)
+            sys.exit(2)
+        return users
+    unknown = [user for user in requested if user not in users]
+    if unknown:
+        print(f"Unknown user(s): {', '.join(unknown)}", file=sys.stderr)
+        sys.exit(2)
+    return requested
+
+async def sync(users: list, check_all: bool = False) -> None:
+    for username in users:
+        await dynamo.find_and_upload_missing_battles(username, check_all=check_all)
+
+def stop_event() -> asyncio.Event:
+    """Returns an event that's set on SIGINT/SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass # windows
+    return stop
+
+async def monitor(users: list, backfill: bool = False) -> None:
+    """Polls each user until SIGINT/SIGTERM, as often as planner.next_interval says. A failure for one user is logged and retried next poll."""
+    stop = stop_event()
+    due = {username: 0 for username in users}
+    while not stop.is_set():
+        for username in users:
+            if due[username] > monotonic():
+                continue
+            try:
+                # backfill only on each user's first poll
+                await dynamo.find_and_upload_missing_battles(username, check_all=backfill and due[username] == 0)
+            except Exception as e:
+                print(f"Failed to sync {username}: {e!r}", file=sys.stderr)
+            due[username] = monotonic() + await planner.next_interval(username)
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=max(0, min(due.values(), default=monotonic() + config.params['refresh']) - monotonic()))
+        except asyncio.TimeoutError:
+            pass
+
+async def watch(users: list, observer: str, backfill: bool = False) -> None:
+    """Like monitor, but with one friend list poll per interval deciding who to sync instead of a history poll per user"""
+    import presence
+    if observer not in await dynamo.get_users():
+        print(f"Unknown observer: {observer}", file=sys.stderr)
+        sys.exit(2)
+    await presence.watch(users, observer, stop_event(), backfill=backfill)
+
+async def run(args: argparse.Namespace) -> None:
+    if args.update_check:
+        await dynamo.check_for_updates(interactive=False)
+    match args.command:
+        case 'users':
+            if args.add:
+                username = await dynamo.login_with_session_token(args.add, args.statink_key)
+                Progress.log(f"Added {username}")
+                return
+            for username in await dynamo.get_users():
+                Progress.log(username)
+        case 'sync':
+            await sync(await resolve_users(args.user))
+        case 'backfill':
+            import backfill
+            await backfill.run(await resolve_users(args.user))
+        case 'monitor':
+            if observer := args.observer or config.params.get('presence_observer'):
+                await watch(await resolve_users(args.user), observer, backfill=args.backfill)
+            else:
+                await monitor(await resolve_users(args.user), backfill=args.backfill)
+        case 'web':
+            import web
+            runner = await web.serve(args.host, args.port, start_all=args.start)
+            print(f"Control server running on http://{args.host}:{args.port}/", file=sys.stderr)
+            await stop_event().wait()
+            await runner.cleanup()
+        case 'vault':
+            enabled, config.params['vault'] = config.params.get('vault'), not args.decrypt
+            count = await database.get_user_database().reseal()
+            print(f"{'Decrypted' if args.decrypt else 'Encrypted'} credentials for {count} user(s)", file=sys.stderr)
+            if not args.decrypt and not enabled:
+                print("Set `vault` to true in config.json (or DYNAMO_VAULT=1) so new tokens are encrypted too", file=sys.stderr)
+        case 'export':
+            import export
+            users = await resolve_users(args.user)
+            if len(users) != 1:
+                print("Pick a user to export with --user.", file=sys.stderr)
+                sys.exit(2)
+            count = await export.export(users[0], args.output, args.format, args.per)
+            print(f"Exported {count} rows", file=sys.stderr)
+
 async def main():
-    await precheck()
+    metrics.configure()
+    if config.params.get('metrics') and config.params.get('metrics_sink') == 'prometheus':
+        await metrics.serve_prometheus(port=config.params.get('metrics_port', 9464))
+    await events.start()
+    if args is not None and args.command is not None:
+        await run(args)
+        return
+    await precheck(check_updates=args is None or args.update_check)
     users = await dynamo.get_users()
     username = users[0]
     await splatnet.check_tokens_and_regenerate(username)
 
 if __name__ == '__main__':
-    asyncio.run(main())
-    os._exit(0)
\ No newline at end of file
+    if args.command == 'fleet':
+        import fleet
+        sys.exit(fleet.supervise(args.workers, backfill=args.backfill))
+    code = 0
+    try:
+        asyncio.run(main())
+    except SystemExit as e:
+        code = e.code
+    except KeyboardInterrupt:
+        code = 130
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        # aiosqlite's worker threads aren't daemons, so the process only exits once they're closed (or with os._exit)
+        try:
+            asyncio.run(database.close_all())
+        finally:
+            offload.shutdown()
+    if not isinstance(code, int):
+        # sys.exit("message") and sys.exit() behave as they would without os._exit
+        if code is not None:
+            print(code, file=sys.stderr)
+        code = 0 if code is None else 1
+    sys.stdout.flush()
+    os._exit(code)
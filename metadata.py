@@ -0,0 +1,139 @@
+import base64, sys
+from time import monotonic
+
+import compact, nso, utils
+from database import get_metadata_database
+
+aiohttp = utils.lazy_import('aiohttp')
+
+# how often to ask SplatNet for its version, to notice an update that changed the weapon or stage list
+VERSION_CHECK_INTERVAL: int = 60 * 60
+# (stat.ink list, table) for the lists that are fetched once per SplatNet version
+LISTS: list = [
+    ('weapon', 'weapons'),
+    ('stage', 'stages'),
+    ('ability', 'abilities'),
+]
+# stored under this prefix plus the SplatNet version, so tables in an older layout are never read back
+STORAGE_PREFIX: str = 'statink2:'
+
+class Metadata:
+    '''Process-wide weapon, stage and ability keys from stat.ink, and every key worked out so far, each string interned once'''
+    version: str | None = None
+    checked: float = 0
+    weapons: dict = {}
+    """ formatted as {SplatNet weapon id: stat.ink key} """
+    stages: dict = {}
+    """ formatted as {SplatNet stage id: stat.ink key} """
+    names: dict = {}
+    """ formatted as {(kind, name in any language stat.ink knows): stat.ink key} """
+    keys: dict = {}
+    """ formatted as {(kind, SplatNet name): stat.ink key}, memoized, and worked out from the name when stat.ink's lists don't have it """
+
+def derive_stage_key(name: str) -> str:
+    return name.lower() \
+               .replace(' ', '_') \
+               .replace('.', '') \
+               .replace("'", '') \
+               .replace('&', 'and')
+
+def derive_weapon_key(name: str) -> str:
+    '''Also used for gear abilities, which stat.ink names the same way'''
+    return name.replace(' ', '_') \
+               .replace('-', '_') \
+               .replace("'", '_') \
+               .replace('.', '') \
+               .replace('(', '') \
+               .replace(')', '') \
+               .lower()
+
+DERIVE: dict = {
+    'stages': derive_stage_key,
+    'weapons': derive_weapon_key,
+    'abilities': derive_weapon_key,
+}
+
+def numeric_id(global_id: str | None) -> int | None:
+    '''Returns the number in a SplatNet node id, e.g. 40 for "V2VhcG9uLTQw" ("Weapon-40")'''
+    if not global_id:
+        return None
+    try:
+        return int(base64.b64decode(global_id).rsplit(b'-', 1)[1])
+    except (ValueError, IndexError):
+        return None
+
+def key(kind: str, name: str) -> str:
+    '''Returns the stat.ink key for a name in any language stat.ink knows, working it out from the name
+    (right for English names) when it doesn't. Looked up only the first time a name is seen.'''
+    if (cached := Metadata.keys.get((kind, name))) is None:
+        cached = Metadata.names.get((kind, name)) or sys.intern(DERIVE[kind](name))
+        Metadata.keys[(kind, sys.intern(name))] = cached
+    return cached
+
+def weapon_key(weapon: dict) -> str:
+    '''stat.ink key for a SplatNet weapon node, by id when stat.ink's list has it'''
+    if (found := Metadata.weapons.get(numeric_id(weapon.get('id')))) is not None:
+        return found
+    return key('weapons', weapon['name'])
+
+def stage_key(stage: dict) -> str:
+    if (found := Metadata.stages.get(numeric_id(stage.get('id')))) is not None:
+        return found
+    return key('stages', stage['name'])
+
+def ability_key(name: str) -> str:
+    return key('abilities', name)
+
+def intern(name: str | None) -> str | None:
+    '''Returns the one shared copy of a name, for rows that repeat the same few names many times'''
+    return sys.intern(name) if name is not None else None
+
+def install(tables: dict) -> None:
+    '''Replaces the tables with {'weapons': [[id, key], ...], 'stages': [[id, key], ...], 'names': [[kind, name, key], ...]}'''
+    Metadata.weapons = {int(entry_id): sys.intern(entry_key) for entry_id, entry_key in tables.get('weapons', [])}
+    Metadata.stages = {int(entry_id): sys.intern(entry_key) for entry_id, entry_key in tables.get('stages', [])}
+    Metadata.names = {(kind, sys.intern(name)): sys.intern(entry_key) for kind, name, entry_key in tables.get('names', [])}
+    Metadata.keys = {} # worked out before stat.ink's names were known
+
+def tables() -> dict:
+    '''The installed tables, as install() takes them'''
+    return {
+        'weapons': [[entry_id, entry_key] for entry_id, entry_key in Metadata.weapons.items()],
+        'stages': [[entry_id, entry_key] for entry_id, entry_key in Metadata.stages.items()],
+        'names': [[kind, name, entry_key] for (kind, name), entry_key in Metadata.names.items()],
+    }
+
+async def fetch() -> dict:
+    '''Downloads stat.ink's weapon, stage and ability lists, as install() takes them. SplatNet ids come from each entry's
+    numeric aliases, and names from every language stat.ink has, so accounts in any language get the right keys.'''
+    import statink
+    tables = {'weapons': [], 'stages': [], 'names': []}
+    async with aiohttp.ClientSession() as session:
+        for endpoint, table in LISTS:
+            async with session.get(f'{statink.API_BASE}/{endpoint}') as r:
+                entries = utils.json_loads(await r.read()) if r.status == 200 else []
+            for entry in entries if isinstance(entries, list) else []:
+                if table in ['weapons', 'stages']:
+                    tables[table].extend([int(alias), entry['key']] for alias in entry.get('aliases') or [] if str(alias).isdigit())
+                tables['names'].extend([table, name, entry['key']] for name in set((entry.get('name') or {}).values()) if name)
+    return tables
+
+async def refresh() -> bool:
+    '''Makes sure the tables are for the SplatNet version that's live, fetching them only when the version is new to main.db.
+    Returns whether they're loaded. Without them, keys are worked out from names, which gives the same keys for English names.'''
+    if Metadata.version is not None and monotonic() - Metadata.checked < VERSION_CHECK_INTERVAL:
+        return True
+    Metadata.checked = monotonic()
+    version = await nso.get_webview_version()
+    if version == Metadata.version:
+        return True
+    storage = get_metadata_database()
+    if (blob := await storage.get(STORAGE_PREFIX + version)) is None:
+        tables = await fetch()
+        if not tables['names']:
+            return False
+        blob = compact.pack(tables)
+        await storage.set(STORAGE_PREFIX + version, blob)
+    install(compact.unpack(blob))
+    Metadata.version = version
+    return True
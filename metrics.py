@@ -0,0 +1,154 @@
+import json, sys
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from time import perf_counter, time
+
+from config import params
+
+# latency buckets in seconds, roughly matching what a splatnet/stat.ink round trip looks like
+BUCKETS: tuple = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_DISABLED = nullcontext()
+
+class Histogram:
+    __slots__ = ('buckets', 'sum', 'count')
+
+    def __init__(self) -> None:
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.buckets[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class JSONSink:
+    '''Writes every observation as a single JSON line, for piping into journald or a log shipper'''
+    def __init__(self, stream=None) -> None:
+        self.stream = stream if stream is not None else sys.stderr
+
+    def record(self, kind: str, name: str, labels: tuple, value: float) -> None:
+        self.stream.write(json.dumps({'ts': round(time(), 3), 'kind': kind, 'name': name, 'labels': dict(labels), 'value': value}) + '\n')
+        self.stream.flush()
+
+class Metrics:
+    '''Process-wide counters and latency histograms.
+
+    Everything is keyed by (name, labels), where labels is a sorted tuple of (key, value) pairs.
+    When metrics are disabled, `timed` hands back a shared nullcontext and `increment` returns immediately.'''
+    enabled: bool = params.get('metrics', False)
+    counters: dict = {}
+    histograms: dict = {}
+    sinks: list = []
+
+    @staticmethod
+    def enable(sink=None) -> None:
+        Metrics.enabled = True
+        if sink is not None:
+            Metrics.sinks.append(sink)
+
+    @staticmethod
+    def disable() -> None:
+        Metrics.enabled = False
+
+    @staticmethod
+    def reset() -> None:
+        Metrics.counters.clear()
+        Metrics.histograms.clear()
+
+def increment(name: str, amount: int = 1, **labels) -> None:
+    if not Metrics.enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    Metrics.counters[key] = Metrics.counters.get(key, 0) + amount
+    for sink in Metrics.sinks:
+        sink.record('counter', name, key[1], amount)
+
+def observe(name: str, value: float, **labels) -> None:
+    if not Metrics.enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    histogram = Metrics.histograms.get(key)
+    if histogram is None:
+        histogram = Metrics.histograms[key] = Histogram()
+    histogram.observe(value)
+    for sink in Metrics.sinks:
+        sink.record('histogram', name, key[1], value)
+
+@contextmanager
+def _timer(name: str, labels: dict):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, perf_counter() - start, **labels)
+
+def timed(stage: str, **labels):
+    """Times the wrapped block as `dynamo_<stage>_seconds`
+
+    Usage:
+        with metrics.timed('upload'):
+            ...
+    """
+    if not Metrics.enabled:
+        return _DISABLED
+    return _timer(f'dynamo_{stage}_seconds', labels)
+
+def snapshot() -> dict:
+    '''Returns a plain dict of every counter and histogram, for in-process consumers'''
+    return {
+        'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in Metrics.counters.items()],
+        'histograms': [{
+            'name': name,
+            'labels': dict(labels),
+            'count': histogram.count,
+            'sum': histogram.sum,
+            'buckets': dict(zip([*BUCKETS, float('inf')], histogram.buckets)),
+        } for (name, labels), histogram in Metrics.histograms.items()],
+    }
+
+def _escape_label(value) -> str:
+    '''Escapes a label value as the text exposition format requires: backslash, double quote and newline'''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape_label(value)}"' for key, value in labels) + '}'
+
+def render_prometheus() -> str:
+    '''Renders all metrics in the Prometheus text exposition format'''
+    lines = []
+    for (name, labels), value in sorted(Metrics.counters.items()):
+        lines.append(f'{name}{_format_labels(labels)} {value}')
+    for (name, labels), histogram in sorted(Metrics.histograms.items(), key=lambda item: item[0]):
+        cumulative = 0
+        for bound, count in zip([*BUCKETS, '+Inf'], histogram.buckets):
+            cumulative += count
+            lines.append(f'{name}_bucket{_format_labels(labels, (("le", bound),))} {cumulative}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {histogram.sum}')
+        lines.append(f'{name}_count{_format_labels(labels)} {histogram.count}')
+    return '\n'.join(lines) + '\n'
+
+async def serve_prometheus(host: str = '127.0.0.1', port: int = 9464):
+    '''Starts a tiny aiohttp server exposing /metrics. Returns the runner so the caller can clean it up.'''
+    from aiohttp import web
+    async def handler(request):
+        return web.Response(text=render_prometheus(), content_type='text/plain')
+    app = web.Application()
+    app.router.add_get('/metrics', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+def configure() -> None:
+    '''Sets up the sink picked in config.json. The prometheus endpoint is started separately with `serve_prometheus`.'''
+    if not params.get('metrics', False):
+        return
+    match params.get('metrics_sink', 'api'):
+        case 'json':
+            Metrics.enable(JSONSink())
+        case _:
+            Metrics.enable()
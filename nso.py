@@ -6,13 +6,17 @@
 # https://github.com/frozenpandaman/s3s
 # https://github.com/ZekeSnider/NintendoSwitchRESTAPI
 
-import aiohttp, re, base64, hashlib, json
+import re, base64, hashlib, json
 from os import urandom
-from bs4 import BeautifulSoup
 from urllib.parse import urlencode
 from sys import exit
 
 from data import APP_VERSION
+from utils import lazy_import
+import cassette
+from progress import Progress
+
+aiohttp = lazy_import('aiohttp')
 
 SPLATNET_URL: str = "https://api.lp1.av5ja.srv.nintendo.net"
 USER_AGENT: str   = 'Mozilla/5.0 (Linux; Android 11; Pixel 5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/94.0.4606.61 Mobile Safari/537.36'
@@ -29,7 +33,8 @@ async def get_nso_version() -> str:
     if NSO_VERSION is not None:
         return NSO_VERSION
     try:
-        async with aiohttp.ClientSession() as session:
+        from bs4 import BeautifulSoup
+        async with cassette.client_session() as session:
             async with session.get("https://apps.apple.com/us/app/nintendo-switch-online/id1234806557") as r:
                 soup = BeautifulSoup(await r.text(), 'html.parser')
         p = soup.find("p", {"class": "whats-new__latest__version"})
@@ -62,11 +67,12 @@ async def get_webview_version() -> str:
         '_dnt': '1',
     }
     
-    async with aiohttp.ClientSession() as session:
+    async with cassette.client_session() as session:
         async with session.get(SPLATNET_URL, headers=headers, cookies=cookies) as r:
             if r.status != 200:
                 return WEBVIEW_FALLBACK
             text = await r.text()
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(text, 'html.parser')
     script_tag = soup.select_one("script[src*='static']")
     if script_tag is None:
@@ -90,7 +96,7 @@ async def get_webview_version() -> str:
         'Upgrade-Insecure-Requests': '1',
         'User-Agent': USER_AGENT,
     }
-    async with aiohttp.ClientSession() as session:
+    async with cassette.client_session() as session:
         async with session.get(script_url, headers=headers) as script:
             if script.status != 200:
                 return WEBVIEW_FALLBACK
@@ -122,24 +128,24 @@ async def _get_session_token(code: str, verifier: bytes, stats_for_nerds=True, r
         'session_token_code_verifier': verifier.replace(b"=", b"")
     }
 
-    async with aiohttp.ClientSession() as session:
+    async with cassette.client_session() as session:
         r = await session.post(f'https://accounts.nintendo.com/connect/1.0.0/api/session_token', data=urlencode(body), headers=headers)
         if r.status != 200 and not recursive:
-            print(f"Got a non-200 response from Nintendo while fetching session token. Retrying...")
+            Progress.log(f"Got a non-200 response from Nintendo while fetching session token. Retrying...")
             return await _get_session_token(code, verifier, stats_for_nerds, True)
         elif recursive:
-            print(f"Unable to recover! Please try again.")
-            if stats_for_nerds: print(f"Response:\n{await r.text()}")
+            Progress.log(f"Unable to recover! Please try again.")
+            if stats_for_nerds: Progress.log(f"Response:\n{await r.text()}")
             exit(1)
         try:
             json = await r.json()
             return json['session_token']
         except json.decoder.JSONDecodeError:
-            print(f"Got an invalid JSON response from Nintendo while fetching session token. Please try again.")
-            if stats_for_nerds: print(f"Response:\n{await r.text()}")
+            Progress.log(f"Got an invalid JSON response from Nintendo while fetching session token. Please try again.")
+            if stats_for_nerds: Progress.log(f"Response:\n{await r.text()}")
             exit(1)
         except KeyError:
-            print(f"Invalid session token code. What.\n\n{await r.text()}")
+            Progress.log(f"Invalid session token code. What.\n\n{await r.text()}")
             exit(1)
 
 async def _get_service_access_tokens(session_token: str) -> dict:
@@ -159,7 +165,7 @@ async def _get_service_access_tokens(session_token: str) -> dict:
         'grant_type': 'urn:ietf:params:oauth:grant-type:jwt-bearer-session-token',
     }
 
-    async with aiohttp.ClientSession() as session:
+    async with cassette.client_session() as session:
         async with session.post('https://accounts.nintendo.com/connect/1.0.0/api/token', headers=headers, json=body) as r:
             try:
                 response = await r.json()
@@ -168,10 +174,10 @@ async def _get_service_access_tokens(session_token: str) -> dict:
                     'id_token': response['id_token'],
                 }
             except KeyError:
-                print(f"Invalid service token code. What.\n\n{await r.text()}")
+                Progress.log(f"Invalid service token code. What.\n\n{await r.text()}")
                 exit(1)
             except json.decoder.JSONDecodeError:
-                print(f"Got an invalid JSON response from Nintendo while fetching service token. Please try again.")
+                Progress.log(f"Got an invalid JSON response from Nintendo while fetching service token. Please try again.")
                 exit(1)
 
 async  def _get_user_details(access_token: str) -> dict:
@@ -187,13 +193,13 @@ async  def _get_user_details(access_token: str) -> dict:
         'Authorization': f'Bearer {access_token}'
     }
 
-    async with aiohttp.ClientSession() as session:
+    async with cassette.client_session() as session:
         async with session.get('https://api.accounts.nintendo.com/2.0.0/users/me', headers=headers) as r:
             try:
                 data = await r.json()
                 return data
             except json.decoder.JSONDecodeError:
-                print(f"Got an invalid JSON response from Nintendo while fetching user details. Please try again.")
+                Progress.log(f"Got an invalid JSON response from Nintendo while fetching user details. Please try again.")
                 exit(1)
 
 async def _get_f_data(service_token: str, na_id: str, hash_method: int = 1, coral_id: int = None) -> tuple[str, int, str]:
@@ -225,13 +231,13 @@ async def _get_f_data(service_token: str, na_id: str, hash_method: int = 1, cora
     if hash_method == 2 and coral_id is not None:
         body['coral_id'] = coral_id
     
-    async with aiohttp.ClientSession() as session:
+    async with cassette.client_session() as session:
         async with session.post(f'https://api.imink.app/f', data=json.dumps(body), headers=headers) as r:
             try:
                 response = await r.json()
                 return response['f'], response['timestamp'], response['request_id']
             except KeyError:
-                print(f"Received an invalid JSON response from imink. Please try again.\n{await r.text()}")
+                Progress.log(f"Received an invalid JSON response from imink. Please try again.\n{await r.text()}")
                 exit(1)
 
 async def _get_web_api_response(id_token: str, user_data: dict, f_data: tuple) -> str:
@@ -253,13 +259,13 @@ async def _get_web_api_response(id_token: str, user_data: dict, f_data: tuple) -
         'User-Agent': f'com.nintendo.znca/{await get_nso_version()}(Android/7.1.2)',
     }
 
-    async with aiohttp.ClientSession() as session:
+    async with cassette.client_session() as session:
         async with session.post(f'https://api-lp1.znc.srv.nintendo.net/v3/Account/Login', json=body, headers=headers) as r:
             try:
                 response = await r.json()
                 return response['result']
             except KeyError:
-                print(f"Received an invalid JSON response from Nintendo while fetching login access token. Please try again.\n{await r.text()}")
+                Progress.log(f"Received an invalid JSON response from Nintendo while fetching login access token. Please try again.\n{await r.text()}")
                 exit(1)
 
 async def _get_g_token(web_api_response: dict, service_access_response: dict, f_data: dict, user_data: dict) -> str:
@@ -285,7 +291,7 @@ async def _get_g_token(web_api_response: dict, service_access_response: dict, f_
     }}
     na_id = user_data['id']
     
-    async with aiohttp.ClientSession() as session:
+    async with cassette.client_session() as session:
         async with session.post('https://api-lp1.znc.srv.nintendo.net/v2/Game/GetWebServiceToken', json=body, headers=headers) as r:
             response = await r.json()
         if response.get('status') == 9403:
@@ -300,12 +306,12 @@ async def _get_g_token(web_api_response: dict, service_access_response: dict, f_
             async with session.post('https://api-lp1.znc.srv.nintendo.net/v2/Game/GetWebServiceToken', json=body, headers=headers) as r:
                 response = await r.json()
     if response.get('status') == 9403:
-        print("ERROR_INVALID_GAME_WEB_TOKEN (unauthorized).")
+        Progress.log("ERROR_INVALID_GAME_WEB_TOKEN (unauthorized).")
         exit(3)
     try:
         g_token = response['result']['accessToken']
     except KeyError:
-        print(f"Received an invalid JSON response from Nintendo while fetching g token. Please try again.\n{await r.text()}")
+        Progress.log(f"Received an invalid JSON response from Nintendo while fetching g token. Please try again.\n{await r.text()}")
     return g_token
 
 async def _get_bullet_token(g_token: str, user_data: dict) -> str:
@@ -325,27 +331,27 @@ async def _get_bullet_token(g_token: str, user_data: dict) -> str:
         '_dnt': '1',
     }
 
-    async with aiohttp.ClientSession() as session:
+    async with cassette.client_session() as session:
         async with session.post(f'{SPLATNET_URL}/api/bullet_tokens', headers=headers, cookies=cookies) as r:
-            if r.status >= 300: print(await r.text())
+            if r.status >= 300: Progress.log(await r.text())
             match r.status:
                 case 204:
-                    print("User has not played online before.")
+                    Progress.log("User has not played online before.")
                     exit(1)
                 case 401:
-                    print("ERROR_INVALID_GAME_WEB_TOKEN (unauthorized).")
+                    Progress.log("ERROR_INVALID_GAME_WEB_TOKEN (unauthorized).")
                     exit(3)
                 case 403:
-                    print("ERROR_OBSOLETE_VERSION (forbidden).")
+                    Progress.log("ERROR_OBSOLETE_VERSION (forbidden).")
                     exit(3)
             try:
                 bullet_data = await r.json()
                 return bullet_data['bulletToken']
             except [json.decoder.JSONDecodeError, TypeError]:
-                print(f"Invalid JSON response from Nintendo to {r.request.url}.\n{await r.text()}")
+                Progress.log(f"Invalid JSON response from Nintendo to {r.request.url}.\n{await r.text()}")
                 exit(3)
             except:
-                print(f"Invalid bullet token code. What.\n\n{await r.text()}")
+                Progress.log(f"Invalid bullet token code. What.\n\n{await r.text()}")
                 exit(3)
 
 async def generate_new_tokens(session_token: str) -> tuple:
@@ -383,7 +389,7 @@ class LoginManager:
             session_token_code = re.search(r'de=(.*)&st', code).group(1)
             session_token = await _get_session_token(session_token_code, self.session_code_verifier)
         except KeyError:
-            print("Invalid session token code.")
+            Progress.log("Invalid session token code.")
         service_access_response = await _get_service_access_tokens(session_token)
         access_token, id_token = service_access_response['access_token'], service_access_response['id_token']
         user_data = await _get_user_details(access_token)
@@ -0,0 +1,50 @@
+import asyncio, multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+import metadata
+from config import params
+
+_executor: Executor | None = None
+_metadata_version: str | None = None
+""" the SplatNet version whose metadata tables the process pool's workers were started with """
+
+def _init_worker(parent_params: dict, version: str | None, tables: dict) -> None:
+    # spawned workers load config.json from scratch and never fetch metadata, so hand them what the parent ended up with
+    params.clear()
+    params.update(parent_params)
+    metadata.install(tables)
+    metadata.Metadata.version = version
+
+def get_executor() -> Executor | None:
+    '''Returns the shared executor for CPU-bound work, or None if `offload` is off.
+    `offload` is 'process' (a pool with `offload_workers` processes, one per core by default), 'thread', or 'off'.'''
+    global _executor, _metadata_version
+    if isinstance(_executor, ProcessPoolExecutor) and _metadata_version != metadata.Metadata.version:
+        # the tables changed since the workers started. work already queued finishes on the old pool
+        _executor.shutdown(wait=False)
+        _executor = None
+    if _executor is None:
+        workers = params.get('offload_workers') or None
+        match params.get('offload', 'off'):
+            case 'process':
+                _metadata_version = metadata.Metadata.version
+                _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker,
+                                                initargs=(dict(params), _metadata_version, metadata.tables()))
+            case 'thread':
+                _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dynamo-offload')
+    return _executor
+
+async def run(function, *args):
+    '''Runs `function(*args)` on the executor, or inline when offloading is off.
+    With processes, `function` and its arguments have to be picklable, so pass bytes rather than big dicts.'''
+    executor = get_executor()
+    if executor is None:
+        return function(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+def shutdown(wait: bool = True) -> None:
+    '''Stops the workers. Call before exiting, os._exit won't wait for worker processes to notice on their own.'''
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait, cancel_futures=True)
+        _executor = None
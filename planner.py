@@ -0,0 +1,104 @@
+from datetime import datetime, timezone
+from time import time
+
+import splatnet, utils
+from config import params
+from database import get_user_database
+
+# an account that played this recently is polled every `refresh` seconds
+RECENTLY_PLAYED: int = 30 * 60
+# everyone else is polled this many times less often, but never less than every IDLE_MAX seconds so a new session isn't missed for long
+IDLE_FACTOR: float = 5
+IDLE_MAX: int = 5 * 60
+# with nothing open (maintenance) or in `quiet_hours`, polling backs off this much
+BACKOFF_FACTOR: float = 15
+BACKOFF_MAX: int = 30 * 60
+
+# (schedules key, match setting key, mode) for the rotations that decide whether anything is playable
+ROTATIONS: list = [
+    ('regularSchedules', 'regularMatchSetting', 'regular'),
+    ('bankaraSchedules', 'bankaraMatchSettings', 'bankara'),
+    ('xSchedules', 'xMatchSetting', 'x'),
+    ('festSchedules', 'festMatchSettings', 'fest'),
+]
+
+class Planner:
+    '''Process-wide poll planning state. Rotations are the same for everyone, so they're fetched once per window for the whole fleet.'''
+    schedule: dict | None = None
+    expires: float = 0
+    retry_at: float = 0
+    last_played: dict = {}
+    """ formatted as {username: unix time of their newest battle} """
+
+def _timestamp(value: str) -> float:
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc).timestamp()
+
+def open_modes(schedule: dict, now: float | None = None) -> set:
+    '''Returns the modes with a rotation running at `now` (regular, bankara, x, fest, event)'''
+    now = now if now is not None else time()
+    data, modes = schedule['data'], set()
+    for key, setting, mode in ROTATIONS:
+        for node in (data.get(key) or {}).get('nodes', []):
+            if node.get(setting) and _timestamp(node['startTime']) <= now < _timestamp(node['endTime']):
+                modes.add(mode)
+    for node in (data.get('eventSchedules') or {}).get('nodes', []):
+        if any(_timestamp(period['startTime']) <= now < _timestamp(period['endTime']) for period in node.get('timePeriods', [])):
+            modes.add('event')
+    return modes
+
+def window_end(schedule: dict, now: float | None = None) -> float | None:
+    '''Returns when the current rotation window ends, which is when the schedule needs fetching again'''
+    now = now if now is not None else time()
+    ends = [_timestamp(node['endTime']) for key, _, _ in ROTATIONS for node in (schedule['data'].get(key) or {}).get('nodes', [])
+            if _timestamp(node['startTime']) <= now < _timestamp(node['endTime'])]
+    return min(ends) if ends else None
+
+async def rotations(username: str) -> dict | None:
+    '''Returns the schedules response, fetched with this user's tokens at most once per rotation window. None if it's unavailable.'''
+    now = time()
+    if Planner.schedule is not None and now < Planner.expires:
+        return Planner.schedule
+    if now < Planner.retry_at:
+        return None
+    db = get_user_database()
+    bullet_token, g_token = db[username][2], db[username][3]
+    try:
+        response = await splatnet.graphql(bullet_token, g_token, 'schedules', return_json=True)
+    except Exception:
+        response = None
+    if not isinstance(response, dict) or not response.get('data'):
+        Planner.schedule, Planner.retry_at = None, now + params['refresh']
+        return None
+    Planner.schedule = response
+    Planner.expires = window_end(response, now) or now + params['refresh']
+    return response
+
+def in_quiet_hours(now: float | None = None) -> bool:
+    '''Whether local time is inside `quiet_hours` ("HH:MM-HH:MM", may wrap past midnight)'''
+    if not (quiet_hours := params.get('quiet_hours')):
+        return False
+    start, end = quiet_hours.split('-')
+    current = datetime.fromtimestamp(now if now is not None else time()).strftime('%H:%M')
+    return start <= current < end if start <= end else current >= start or current < end
+
+def note_battles(username: str, battle_ids) -> None:
+    '''Remembers when a user last played, from the SplatNet ids of their battle history'''
+    played = [utils.battle_played_at(battle_id) for battle_id in battle_ids]
+    if played := [stamp for stamp in played if stamp]:
+        newest = datetime.strptime(max(played), '%Y%m%dT%H%M%S').replace(tzinfo=timezone.utc).timestamp()
+        Planner.last_played[username] = max(newest, Planner.last_played.get(username, 0))
+
+async def next_interval(username: str) -> float:
+    '''Seconds to wait before polling a user again. Just `refresh` with `schedule_aware` turned off.'''
+    base = params['refresh']
+    if not params.get('schedule_aware', True):
+        return base
+    now = time()
+    schedule = await rotations(username)
+    # no schedule means SplatNet didn't answer, not that it's down for maintenance, so that's polled as usual
+    if (schedule is not None and not open_modes(schedule, now)) or in_quiet_hours(now):
+        return max(base, min(base * BACKOFF_FACTOR, BACKOFF_MAX))
+    last_played = Planner.last_played.get(username)
+    if last_played is not None and now - last_played < RECENTLY_PLAYED:
+        return base
+    return max(base, min(base * IDLE_FACTOR, IDLE_MAX))
@@ -0,0 +1,100 @@
+import asyncio, sys
+from time import monotonic
+
+import dynamo, events, planner, splatnet
+from config import params
+from database import get_user_database
+
+# onlineState values of a friend who's queued for or playing a match
+PLAYING: frozenset = frozenset({'VS_MODE_MATCHING', 'VS_MODE_FIGHTING', 'COOP_MODE_MATCHING', 'COOP_MODE_FIGHTING'})
+# a friend leaving one of these has just finished a match, which is in their history now
+FIGHTING: frozenset = frozenset({'VS_MODE_FIGHTING', 'COOP_MODE_FIGHTING'})
+
+class Presence:
+    '''Process-wide presence state: the online state each tracked account had on the last friends poll'''
+    states: dict = {}
+    """ formatted as {username: onlineState} """
+    synced: dict = {}
+    """ formatted as {username: monotonic time of their last sync} """
+
+def friend_name(username: str) -> str:
+    '''The name a tracked account goes by in the observer's friend list, from `presence_friends` (their username by default)'''
+    return (params.get('presence_friends') or {}).get(username, username)
+
+async def friend_states(observer: str) -> dict | None:
+    '''Returns {friend name: onlineState} for everyone on the observer's friend list, or None if SplatNet didn't answer'''
+    db = get_user_database()
+    for attempt in range(2):
+        bullet_token, g_token = db[observer][2], db[observer][3]
+        try:
+            # decoded while the session is still open, a returned ClientResponse can't be read anymore
+            response = await splatnet.graphql(bullet_token, g_token, 'friends', return_json=True)
+        except ValueError:
+            response = None # not JSON, an expired token gets an empty 401
+        if isinstance(response, dict) and response.get('data') and not response.get('errors'):
+            break
+        if attempt or not await splatnet.check_tokens_and_regenerate(observer):
+            return None
+    nodes = (response['data'].get('friends') or {}).get('nodes') or []
+    states = {}
+    for node in nodes:
+        for name in [node.get('nickname'), node.get('playerName')]:
+            if name:
+                states.setdefault(name, node.get('onlineState') or 'OFFLINE')
+    return states
+
+def due(previous: str | None, current: str, last_synced: float | None, now: float | None = None) -> bool:
+    '''Whether an account's history is worth syncing, going by its online state on the last two polls.
+    That's on its first poll, when it just left a match, or when it's playing and hasn't synced in `refresh` seconds
+    (a match that started and ended between polls looks like an account that's still queueing).'''
+    now = now if now is not None else monotonic()
+    if last_synced is None or (previous in FIGHTING and current != previous):
+        return True
+    return current in PLAYING and now - last_synced >= params['refresh']
+
+async def watch(users: list, observer: str, stop: asyncio.Event, backfill: bool = False) -> None:
+    '''Polls the observer's friend list every `presence_interval` seconds (`refresh` by default) until `stop` is set,
+    and syncs only the tracked accounts that are in a match or just left one. Accounts that aren't on the friend list
+    (the observer itself, for one) are polled on their own, as often as planner.next_interval says.'''
+    interval = params.get('presence_interval') or params['refresh']
+    solo, warned, reachable = {}, set(), True
+    for username in users:
+        Presence.states.setdefault(username, None)
+    while not stop.is_set():
+        started, syncing = monotonic(), []
+        try:
+            states = await friend_states(observer)
+        except Exception as e:
+            print(f"Failed to poll {observer}'s friends: {e!r}", file=sys.stderr)
+            states = None
+        if states is None and reachable:
+            print(f"Couldn't read {observer}'s friend list, polling every account on its own until it's back", file=sys.stderr)
+        reachable = states is not None
+        for username in users:
+            current = states.get(friend_name(username)) if states is not None else None
+            if current is None:
+                if states is not None and username not in warned and username != observer:
+                    print(f"{friend_name(username)} isn't on {observer}'s friend list, polling {username} on its own", file=sys.stderr)
+                    warned.add(username)
+                if solo.setdefault(username, 0) <= monotonic():
+                    syncing.append(username)
+                continue
+            solo.pop(username, None)
+            previous, Presence.states[username] = Presence.states[username], current
+            if current != previous:
+                events.emit('presence_changed', username=username, state=current)
+            if due(previous, current, Presence.synced.get(username)):
+                syncing.append(username)
+        for username in syncing:
+            try:
+                # backfill only on each user's first sync
+                await dynamo.find_and_upload_missing_battles(username, check_all=backfill and username not in Presence.synced)
+            except Exception as e:
+                print(f"Failed to sync {username}: {e!r}", file=sys.stderr)
+            Presence.synced[username] = monotonic()
+            if username in solo:
+                solo[username] = monotonic() + await planner.next_interval(username)
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=max(0, started + interval - monotonic()))
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,112 @@
+import asyncio, sys
+from itertools import cycle
+from shutil import get_terminal_size
+from time import monotonic
+
+from config import params
+from utils import freakify
+
+class Progress:
+    '''A single asyncio-driven status line shared by every running step.
+
+    Steps register with `begin` and finish with `end`. While anything is running, one renderer task redraws
+    the line every `interval` seconds with the newest step, how many others are running, and throughput.
+    When stdout isn't a TTY (or `threaded` is off) nothing is animated; each step is logged as a plain line instead.'''
+    tasks: dict = {}
+    completed: int = 0
+    started_at: float | None = None
+    interval: float = 0.1
+    steps = ["⢿", "⣻", "⣽", "⣾", "⣷", "⣯", "⣟", "⡿"]
+    _next_id: int = 0
+    _renderer: asyncio.Task | None = None
+    _line_width: int = 0
+
+    @staticmethod
+    def interactive() -> bool:
+        return params['threaded'] and sys.stdout.isatty()
+
+    @staticmethod
+    def begin(desc: str) -> int:
+        Progress._next_id += 1
+        task_id = Progress._next_id
+        Progress.tasks[task_id] = desc
+        if Progress.started_at is None:
+            Progress.started_at = monotonic()
+        if not Progress.interactive():
+            _write(f"{desc}\n")
+            return task_id
+        if Progress._renderer is None or Progress._renderer.done():
+            try:
+                Progress._renderer = asyncio.get_running_loop().create_task(Progress._render())
+            except RuntimeError:
+                # no loop running (e.g. called from sync code), so just draw once
+                Progress._draw(Progress.steps[0])
+        return task_id
+
+    @staticmethod
+    def end(task_id: int, message: str = "") -> None:
+        if Progress.tasks.pop(task_id, None) is None:
+            return
+        Progress.completed += 1
+        if message:
+            Progress.log(message)
+        if not Progress.tasks and Progress._renderer is None:
+            Progress._reset()
+
+    @staticmethod
+    def log(message: str) -> None:
+        '''Prints a full line without tearing the status line'''
+        if Progress.interactive() and Progress._line_width:
+            _write("\r" + " " * Progress._line_width + "\r")
+            Progress._line_width = 0
+        _write(f"{message}\n")
+
+    @staticmethod
+    def throughput() -> float:
+        if Progress.started_at is None:
+            return 0.0
+        elapsed = monotonic() - Progress.started_at
+        return Progress.completed / elapsed if elapsed > 0 else 0.0
+
+    @staticmethod
+    def status() -> str:
+        if not Progress.tasks:
+            return ""
+        newest = Progress.tasks[max(Progress.tasks)]
+        others = len(Progress.tasks) - 1
+        line = newest + (f" (+{others} more)" if others else "")
+        if Progress.completed:
+            line += f" | {Progress.completed} done, {Progress.throughput():.1f}/s"
+        return line
+
+    @staticmethod
+    def _draw(spinner: str) -> None:
+        cols = get_terminal_size((80, 20)).columns
+        line = f"{spinner} {Progress.status()}"[:cols - 1]
+        _write("\r" + line.ljust(Progress._line_width))
+        Progress._line_width = len(line)
+
+    @staticmethod
+    def _reset() -> None:
+        Progress.completed = 0
+        Progress.started_at = None
+
+    @staticmethod
+    async def _render() -> None:
+        try:
+            for spinner in cycle(Progress.steps):
+                if not Progress.tasks:
+                    break
+                Progress._draw(spinner)
+                await asyncio.sleep(Progress.interval)
+        finally:
+            if Progress._line_width:
+                _write("\r" + " " * Progress._line_width + ("\r" if params['flush_prints'] else "\n"))
+                Progress._line_width = 0
+            Progress._renderer = None
+            Progress._reset()
+
+def _write(text: str) -> None:
+    # every line Dynamo prints goes through here, so `freaky` only has to be applied once
+    sys.stdout.write(freakify(text) if params['freaky'] else text)
+    sys.stdout.flush()
@@ -1,28 +1,50 @@
-import aiohttp, json
-import nso, utils
-from database import UserDatabase
+from __future__ import annotations
+
+import asyncio, json, os, socket
+import cassette, nso, utils, metrics, events
+from database import get_user_database, Cache
 from loader import Loader
 
-db = UserDatabase()
+aiohttp = utils.lazy_import('aiohttp')
 
 async def generate_tokens(username) -> dict:
     with Loader(f"Regenerating tokens for {username}..."):
+        db = get_user_database()
         session_token = db[username][1]
         bullet_token, g_token = await nso.generate_new_tokens(session_token)
         await db.set(username, {'bullet_token': bullet_token, 'g_token': g_token})
+    events.emit('token_refreshed', username=username)
 
 async def check_tokens(username) -> bool:
     loader = Loader(f"Checking tokens for {username}...").start()
+    db = get_user_database()
     bullet_token, g_token = db[username][2], db[username][3]
-    response = await graphql(bullet_token, g_token, 'home')
+    with metrics.timed('token_check'):
+        response = await graphql(bullet_token, g_token, 'home')
     loader.stop()
+    metrics.increment('dynamo_token_checks_total', status=response.status)
     return response.status == 200
 
+# how long a process may hold an account's token lease before others assume it died
+TOKEN_LEASE_SECONDS: int = 120
+
 async def check_tokens_and_regenerate(username) -> bool:
-    if not await check_tokens(username): 
-        await generate_tokens(username)
-        return await check_tokens(username)
-    return True
+    if await check_tokens(username):
+        return True
+    # only one process regenerates an account's tokens at a time, the rest wait and use the new ones
+    db = get_user_database()
+    owner = f'{socket.gethostname()}:{os.getpid()}'
+    stale = (await db.get(username))[2] # the token check_tokens just tried, which may be cached
+    while not await db.acquire_lease(f'tokens:{username}', owner, TOKEN_LEASE_SECONDS):
+        await asyncio.sleep(1)
+        if (await db.get(username, fresh=True))[2] != stale:
+            return await check_tokens(username)
+    try:
+        if (await db.get(username, fresh=True))[2] == stale or not await check_tokens(username):
+            await generate_tokens(username)
+    finally:
+        await db.release_lease(f'tokens:{username}', owner)
+    return await check_tokens(username)
 
 async def graphql(bullet_token: str, g_token: str, query: str = None, hash: str = None, return_json=False) -> aiohttp.ClientResponse | dict:
     assert (query or hash) and not (query and hash), "Must provide either a query or a hash, but not both"
@@ -126,11 +148,17 @@ async def generate_headers(bullet_token: str, user_data: dict | None = None) ->
 		'Accept-Encoding':  'gzip, deflate'
 	}
 
+VIEW_BATTLE_HASH: str = 'f893e1ddcfb8a4fd645fd75ced173f18b2750e5cfba41d2669b9814f6ceaec46'
+
 async def view_battle(vsResultId, bullet_token: str, g_token: str):
+    return utils.json_loads(await view_battle_raw(vsResultId, bullet_token, g_token))
+
+async def view_battle_raw(vsResultId, bullet_token: str, g_token: str) -> bytes:
+    '''Same as view_battle, but returns the undecoded response body'''
     body = {
         'extensions': {
             'persistedQuery': {
-                'sha256Hash': 'f893e1ddcfb8a4fd645fd75ced173f18b2750e5cfba41d2669b9814f6ceaec46',
+                'sha256Hash': VIEW_BATTLE_HASH,
                 'version': 1
             }
         },
@@ -141,7 +169,8 @@ async def view_battle(vsResultId, bullet_token: str, g_token: str):
     cookies = {
         '_gtoken': g_token
     }
-    return await process_request(bullet_token, json=body, cookies=cookies, return_json=True)
+    with metrics.timed('detail_fetch'):
+        return await process_request(bullet_token, json=body, cookies=cookies, return_raw=True)
 
 async def view_coop(coopHistoryDetailId: str, g_token: str) -> dict:
     # unfinished
@@ -162,32 +191,49 @@ async def view_coop(coopHistoryDetailId: str, g_token: str) -> dict:
     return await process_request(json=body, cookies=cookies)
 
 async def process_request(bullet_token, **kwargs) -> aiohttp.ClientResponse:
-    async with aiohttp.ClientSession() as session:
-        async with session.post(f'https://api.lp1.av5ja.srv.nintendo.net/api/graphql', headers=kwargs['headers'] if 'headers' in kwargs else await generate_headers(bullet_token), json=kwargs['json'], cookies=kwargs['cookies']) as r:
+    if 'headers' in kwargs:
+        headers = kwargs['headers']
+    else:
+        # a replayed response doesn't need real headers, and working them out would go to the network
+        headers = {} if cassette.mode() == 'replay' else await generate_headers(bullet_token)
+    async with cassette.client_session() as session:
+        async with session.post(f'{nso.SPLATNET_URL}/api/graphql', headers=headers, json=kwargs['json'], cookies=kwargs['cookies']) as r:
+            if kwargs.get('return_raw'):
+                return await r.read()
             if kwargs.get('return_json') is not None and kwargs['return_json']:
-                return await r.json()
+                return utils.json_loads(await r.read())
             return r
 
-async def fetch_battle_ids(bullet_token: str, g_token: str, modes: str | list) -> dict:
-    loader = Loader("Fetching battle IDs...", detailed=True).start()
-    if isinstance(modes, list) and any([i not in ['regular', 'bankara', 'x', 'event', 'private', 'latest'] for i in modes]):
+HISTORY_MODES: list = ['regular', 'bankara', 'x', 'event', 'private']
+
+def history_modes(modes: str | list) -> list:
+    '''Checks and expands a mode, 'all', or a list of modes into the history queries to run'''
+    if isinstance(modes, list) and any([i not in HISTORY_MODES + ['latest'] for i in modes]):
         raise ValueError('Invalid mode(s) provided')
-    elif isinstance(modes, str) and modes not in ['regular', 'bankara', 'x', 'event', 'private', 'all', 'latest']:
+    elif isinstance(modes, str) and modes not in HISTORY_MODES + ['all', 'latest']:
         raise ValueError('Invalid mode provided')
     if modes == 'all':
-        modes = ['regular', 'bankara', 'x', 'event', 'private']
-    elif isinstance(modes, str):
-        modes = [modes]
-    battle_ids = {}
-    battle_histories = []
-    battle_nodes = []
-    for mode in modes:
-        response = await graphql(bullet_token, g_token, f'{mode}BattleHistories', return_json=True)
-        battle_nodes.extend(response['data'][f'{mode}BattleHistories']['historyGroups']['nodes'])
-    for node in battle_nodes:
-        battle_histories.extend(node['historyDetails']['nodes'])
-    for battle in battle_histories:
-        battle_id = await utils.decode_battle_id(battle['id'])
-        battle_ids[battle_id] = battle['id'] # such good code i know!
+        return HISTORY_MODES
+    return [modes] if isinstance(modes, str) else modes
+
+async def iter_battle_ids(bullet_token: str, g_token: str, modes: str | list):
+    '''Yields (stat.ink uuid, SplatNet id) for every battle in each mode's history, newest first, as each response is parsed.
+    Only one mode's response is held here at a time. The cache keeps its own copy: every mode's whole decoded tree with
+    `cache_format` 'dict' (the default), which grows with every account, or compressed with 'zlib'.'''
+    for mode in history_modes(modes):
+        with metrics.timed('history_fetch', mode=mode):
+            # refreshed through the cache so deferred fields can be resolved from this same response
+            response = await Cache.graphql(bullet_token, g_token, f'{mode}BattleHistories', return_json=True, refresh=True)
+        groups = response['data'][f'{mode}BattleHistories']['historyGroups']['nodes']
+        del response
+        for group in groups:
+            for battle in group['historyDetails']['nodes']:
+                yield await utils.decode_battle_id(battle['id']), battle['id']
+        del groups
+
+async def fetch_battle_ids(bullet_token: str, g_token: str, modes: str | list) -> dict:
+    '''Returns {stat.ink uuid: SplatNet id} for every battle in the given modes, newest first'''
+    loader = Loader("Fetching battle IDs...", detailed=True).start()
+    battle_ids = {battle_id: splatnet_id async for battle_id, splatnet_id in iter_battle_ids(bullet_token, g_token, modes)}
     loader.stop()
     return battle_ids
\ No newline at end of file
@@ -1,17 +1,44 @@
-import aiohttp
-import utils
+import utils, metrics, archive, offload, events, metadata
 import json
-import msgpack
+import hashlib
 import re
 from datetime import datetime
+from time import time
 from splatnet import graphql
-from database import UserDatabase, Cache
+from database import get_user_database, get_upload_database, get_pending_field_database, get_uuid_list_database, Cache
+from config import params
 from loader import Loader
+from progress import Progress
 from data import APP_VERSION
 
-async def format_request(username: str, battle_data: dict) -> dict:
-    # skips level_before/after, cash_before/after
+aiohttp = utils.lazy_import('aiohttp')
+
+# overridable for pointing Dynamo at a stand-in server (see `bench.py uuid-list`)
+API_BASE: str = 'https://stat.ink/api/v3'
+
+async def format_request(username: str, battle_data: dict, previous_powers: dict | None = None) -> dict:
+    """Formats a view_battle response for stat.ink.
+    `previous_powers` maps SplatNet battle ids to their Anarchy power, for battles already fetched this run (see upload_battle)."""
+    with metrics.timed('format'):
+        return await _format_request(username, battle_data, previous_powers)
+
+async def _format_request(username: str, battle_data: dict, previous_powers: dict | None = None) -> dict:
+    payload, _, context = await format_parts(username, battle_data, previous_powers)
+    payload.update(context)
+    return payload
+
+async def format_parts(username: str, battle_data: dict, previous_powers: dict | None = None) -> tuple[dict, dict, dict]:
+    """Returns the payload from the battle itself, its facts, and the fields from other battles, unmerged"""
     loader = Loader('Formatting battle data...', detailed=True).start()
+    payload, facts = await build_payload(battle_data)
+    context = await gather_format_context(username, facts, previous_powers)
+    loader.stop()
+    return payload, facts, context
+
+async def build_payload(battle_data: dict) -> tuple[dict, dict]:
+    """Formats everything that comes from the battle itself. Never touches the network or database, so it can run in a worker.
+    Returns the payload, and the facts gather_format_context needs to look up the rest."""
+    # skips level_before/after, cash_before/after
     data = battle_data['data']['vsHistoryDetail']
     previous_history_detail = data['previousHistoryDetail'].get('id')
     lobby_mode = await find_statink_lobby_mode(battle_data)
@@ -23,8 +50,8 @@ async def format_request(username: str, battle_data: dict) -> dict:
         'uuid': await utils.decode_battle_id(data['id']),
         'lobby': lobby_mode,
         'rule': await find_statink_mode_rule(data['vsRule']['rule']),
-        'stage': await find_statink_stage(data['vsStage']['name']),
-        'weapon': await find_statink_weapon(me['weapon']['name']),
+        'stage': metadata.stage_key(data['vsStage']),
+        'weapon': metadata.weapon_key(me['weapon']),
         'result': data['judgement'].lower(),
         'knockout': None,
         'rank_in_team': players.index(next(filter(lambda n: n.get('isMyself') == True, players))) + 1,
@@ -62,30 +89,13 @@ async def format_request(username: str, battle_data: dict) -> dict:
         payload['knockout'] = 'yes' if data['knockout'] in ['WIN', 'LOSE'] else 'no'
         payload['our_team_count'] = data['myTeam']['result']['score']
         payload['their_team_count'] = data['otherTeams'][0]['result']['score']
-    #### series, open ####
-    if lobby_mode in ['bankara_open', 'bankara_challenge']:
-        rank_before = await find_rank_before(username, previous_history_detail)
-        payload['rank_before'] = rank_before[0].lower()
-        if len(rank_before) > 1:
-            payload['rank_before_s_plus'] = rank_before[1]
-        rank_after = await find_rank_after(username, data['id'])
-        payload['rank_after'] = rank_after[0].lower()
-        if len(rank_after) > 1:
-            payload['rank_after_s_plus'] = rank_after[1]
     #### open ####
     if lobby_mode in ['bankara_open']:
         bankara_power = await find_bankara_power(data['bankaraMatch'])
         if bankara_power is not None: payload['bankara_power_after'] = bankara_power
-        bankara_power_before = await get_anarchy_power_before(username, previous_history_detail)
-        if bankara_power_before is not None: payload['bankara_power_before'] = bankara_power_before
-    #### x, series (for win/loss) ####
-    if lobby_mode in ['xmatch', 'bankara_challenge']:
-        payload['challenge_win'], payload['challenge_lose'] = await get_challenge_win_loss(username, data['id'], lobby_mode)
-    #### x (for x poewr) ####
+    #### x ####
     if lobby_mode in ['xmatch']:
         payload['x_power_before'] = data['xMatch']['lastXPower']
-        x_power_after = await get_x_power_after(username, data['id'])
-        if x_power_after is not None: payload['x_power_after'] = x_power_after
     
     payload['our_team_color'] = await utils.rgba_to_hex(data['myTeam']['color'])
     payload['their_team_color'] = await utils.rgba_to_hex(data['otherTeams'][0]['color'])
@@ -105,27 +115,130 @@ async def format_request(username: str, battle_data: dict) -> dict:
     payload['start_at'] = int(proper_datetime)
     payload['end_at'] = proper_datetime + data['duration']
     # print('\n', payload, '\n')
-    
-    loader.stop()
+
+    facts = {
+        'uuid': payload['uuid'],
+        'lobby': lobby_mode,
+        'rule': payload['rule'],
+        'result': payload['result'],
+        'digest': payload_digest(payload),
+        'id': data['id'],
+        'previous_id': previous_history_detail,
+        'bankara_power': await find_bankara_power(data['bankaraMatch']) if data.get('bankaraMatch') else None,
+    }
+    return payload, facts
+
+async def gather_format_context(username: str, facts: dict, previous_powers: dict | None = None) -> dict:
+    """Looks up the fields that depend on other battles (ranks, powers, challenge progress), using the facts from build_payload"""
+    payload = {}
+    lobby_mode, history_detail, previous_history_detail = facts['lobby'], facts['id'], facts['previous_id']
+    #### series, open ####
+    if lobby_mode in ['bankara_open', 'bankara_challenge']:
+        rank_before = await find_rank_before(username, previous_history_detail)
+        if rank_before is not None:
+            payload['rank_before'] = rank_before[0].lower()
+            if len(rank_before) > 1:
+                payload['rank_before_s_plus'] = rank_before[1]
+        rank_after = await resolve_or_defer(username, facts, 'rank_after', lambda: find_rank_after(username, history_detail))
+        if rank_after is not None:
+            payload['rank_after'] = rank_after[0].lower()
+            if len(rank_after) > 1:
+                payload['rank_after_s_plus'] = rank_after[1]
+    #### open ####
+    if lobby_mode in ['bankara_open']:
+        bankara_power_before = await get_anarchy_power_before(username, previous_history_detail, previous_powers)
+        if bankara_power_before is not None: payload['bankara_power_before'] = bankara_power_before
+    #### x, series (for win/loss) ####
+    if lobby_mode in ['xmatch', 'bankara_challenge']:
+        win_loss = await resolve_or_defer(username, facts, 'challenge_win_lose', lambda: get_challenge_win_loss(username, history_detail, lobby_mode))
+        if win_loss is not None:
+            payload['challenge_win'], payload['challenge_lose'] = win_loss
+    #### x (for x poewr) ####
+    if lobby_mode in ['xmatch']:
+        x_power_after = await resolve_or_defer(username, facts, 'x_power_after', lambda: get_x_power_after(username, history_detail))
+        if x_power_after is not None: payload['x_power_after'] = x_power_after
     return payload
 
-async def upload_battle(username: str, battle_id: str):
-    db = UserDatabase()
+def format_battle_body(raw: bytes) -> tuple[bytes, dict]:
+    """Decodes a raw view_battle response and runs build_payload on it, without an event loop.
+    Takes and returns bytes so it's cheap to hand to a worker process (see offload.py)."""
+    payload, facts = utils.run_sync(build_payload(utils.json_loads(raw)))
+    return json.dumps(payload, separators=(',', ':')).encode(), facts
+
+def merge_body(body: bytes, fields: dict) -> bytes:
+    """Adds fields to an encoded JSON object without decoding it"""
+    if not fields:
+        return body
+    return body[:-1] + b',' + json.dumps(fields, separators=(',', ':')).encode()[1:]
+
+# left out of the payload hash, so updating Dynamo doesn't make every battle look changed
+VOLATILE_FIELDS: tuple = ('agent', 'agent_version', 'automated')
+
+def payload_digest(payload: dict) -> str:
+    '''Hash of what build_payload made, worked out where it ran (in a worker, with offloading on)'''
+    stable = {key: value for key, value in payload.items() if key not in VOLATILE_FIELDS}
+    return hashlib.sha256(json.dumps(stable, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+def hash_payload(digest: str, context: dict) -> str:
+    '''Hash of a whole payload from its payload_digest and the fields gather_format_context added, so it's never re-encoded'''
+    return hashlib.sha256((digest + json.dumps(context, sort_keys=True, separators=(',', ':'))).encode()).hexdigest()
+
+def is_complete(lobby: str, context: dict) -> bool:
+    '''Whether gather_format_context found every field that only shows up after the next battle is played'''
+    match lobby:
+        case 'bankara_open': return 'rank_after' in context
+        case 'bankara_challenge': return 'rank_after' in context and 'challenge_win' in context
+        case 'xmatch': return 'x_power_after' in context and 'challenge_win' in context
+        case _: return True
+
+async def upload_battle(username: str, battle_id: str, previous_powers: dict | None = None, missing: bool = False) -> bool:
+    """Formats and uploads a battle, unless stat.ink already has this exact payload. Returns whether it was sent.
+    Pass `missing` when stat.ink's uuid-list just said it doesn't have the battle (deleted there, or a new `statink_key`),
+    so it's sent whatever was uploaded before.
+    When uploading several battles oldest first, pass the same `previous_powers` dict to each call; every battle's
+    Anarchy power is remembered there so the next battle doesn't have to fetch its predecessor again."""
+    db = get_user_database()
     bullet_token, g_token = db[username][2], db[username][3]
     # get battle data
-    battle_data = await Cache.view_battle(battle_id, bullet_token, g_token)
-    request = await format_request(username, battle_data)
-    loader = Loader('Uploading battle...', detailed=True).start()
+    if (battle_archive := archive.get_archive()) is not None:
+        await battle_archive.store(username, await Cache.view_battle(battle_id, bullet_token, g_token),
+                                   raw=await Cache.view_battle(battle_id, bullet_token, g_token, raw=True))
+    body = request = None
+    with metrics.timed('format'):
+        if offload.get_executor() is not None:
+            # decode, format, encode and hash in a worker, only the lookups that need the cache and database stay here
+            body, facts = await offload.run(format_battle_body, await Cache.view_battle(battle_id, bullet_token, g_token, raw=True))
+            context = await gather_format_context(username, facts, previous_powers)
+            body = merge_body(body, context)
+        else:
+            request, facts, context = await format_parts(username, await Cache.view_battle(battle_id, bullet_token, g_token), previous_powers)
+            request.update(context)
+    if previous_powers is not None:
+        previous_powers[battle_id] = facts['bankara_power']
+    payload_hash = hash_payload(facts['digest'], context)
+    uploads = get_upload_database()
+    previous_upload = await uploads.get(facts['uuid'])
+    if not missing and previous_upload is not None and previous_upload[2] == payload_hash:
+        metrics.increment('dynamo_uploads_skipped_total')
+        return False
+    loader = Loader('Uploading battle...' if previous_upload is None else 'Re-uploading changed battle...', detailed=True).start()
     headers = {
         'Authorization': f'Bearer {db[username][5]}',
         'Content-Type': 'application/json'
     }
-    async with aiohttp.ClientSession() as session:
-        async with session.post('https://stat.ink/api/v3/battle', headers=headers, json=request) as r:
-            data = await r.json()
+    with metrics.timed('upload'):
+        async with aiohttp.ClientSession() as session:
+            async with session.post(f'{API_BASE}/battle', headers=headers, **({'json': request} if body is None else {'data': body})) as r:
+                data = utils.json_loads(await r.read())
     loader.stop()
+    metrics.increment('dynamo_uploads_total', status=r.status)
     # print('\n', json.dumps(request), '\n')
-    print('\n', json.dumps(data), '\n')
+    Progress.log(json.dumps(data))
+    if 200 <= r.status < 300:
+        await uploads.set(facts['uuid'], username, payload_hash, is_complete(facts['lobby'], context), json.dumps(data))
+        events.emit('battle_uploaded', username=username, uuid=facts['uuid'], lobby=facts['lobby'], rule=facts['rule'],
+                    result=facts['result'], url=data.get('url') if isinstance(data, dict) else None)
+    return True
 
 async def find_statink_lobby_mode(battle_data: dict) -> str:
     """Takes a battle data dict and returns the lobby mode for stat.ink"""
@@ -158,21 +271,10 @@ async def find_statink_mode_rule(rule: str) -> str:
         case 'TRI_COLOR': return 'tricolor'
 
 async def find_statink_stage(stage: str) -> str:
-    match stage:
-        case _: return stage.lower() \
-                             .replace(' ', '_') \
-                             .replace('.', '') \
-                             .replace("'", '') \
-                             .replace('&', 'and')
+    return metadata.key('stages', stage)
 
 async def find_statink_weapon(weapon: str) -> str:
-    return weapon.replace(' ', '_') \
-                 .replace('-', '_') \
-                 .replace("'", '_') \
-                 .replace('.', '') \
-                 .replace('(', '') \
-                 .replace(')', '') \
-                 .lower()
+    return metadata.key('weapons', weapon)
 
 async def find_me_from_players(players: list) -> dict | None:
     for player in players:
@@ -187,73 +289,151 @@ async def find_bankara_power(bankara_match: dict) -> int | None:
 async def find_rank_before(username: str, previous_history_detail: str | None) -> str | None:
     """Takes a mode and battle id and returns the rank of the previous battle"""
     if previous_history_detail is None: return None
-    db = UserDatabase()
+    return await find_rank_after(username, previous_history_detail)
+
+async def find_rank_after(username: str, history_detail: str) -> str | None:
+    """Returns the rank a battle ended on, from the same cached history as the other deferred fields, or None if it's not in it"""
+    db = get_user_database()
+    bullet_token, g_token = db[username][2], db[username][3]
+    matches = await Cache.graphql(bullet_token, g_token, 'latestBattleHistories', return_json=True)
+    if (found := (await _index_history(matches)).get(history_detail)) is None:
+        return None
+    return await read_deferred_field(*found, None, 'rank_after')
+
+def deferred_source(field: str, lobby: str) -> str:
+    """The battle history a field that depends on later battles is read from. Challenge progress is in the
+    X Match history for X battles and the Anarchy one for Series battles."""
+    match field:
+        case 'rank_after': return 'latest'
+        case 'challenge_win_lose': return 'x' if lobby == 'xmatch' else 'bankara'
+        case 'x_power_after': return 'x'
+
+async def _index_history(response: dict) -> dict:
+    """Maps each battle id in a history response to (history group, battle node)"""
+    histories = response['data'][[key for key in response['data'].keys() if 'Histories' in key][0]]
+    return {battle['id']: (group, battle) for group in histories['historyGroups']['nodes'] for battle in group['historyDetails']['nodes']}
+
+async def read_deferred_field(group: dict, battle: dict, lobby: str, field: str):
+    """Reads a field from a battle's history node and group. None if SplatNet doesn't have it yet."""
+    match field:
+        case 'rank_after':
+            return await split_rank(battle['udemae']) if battle.get('udemae') else None
+        case 'challenge_win_lose':
+            measurement = group.get('bankaraMatchChallenge' if lobby == 'bankara_challenge' else 'xMatchMeasurement')
+            return [measurement['winCount'], measurement['loseCount']] if measurement else None
+        case 'x_power_after':
+            measurement = group.get('xMatchMeasurement')
+            return measurement.get('xPowerAfter') if measurement else None
+
+async def resolve_or_defer(username: str, facts: dict, field: str, resolve):
+    """Returns a field that depends on later battles from the (cached) history it's in. Only when SplatNet doesn't have
+    it yet is it marked pending, to be filled in by resolve_deferred_fields on a later poll, and None returned.
+    With `defer_fields` turned off, `resolve` is awaited inline instead."""
+    if not params.get('defer_fields', True):
+        return await resolve()
+    pending = get_pending_field_database()
+    known = await pending.get(facts['uuid'])
+    if known.get(field) is not None:
+        return known[field]
+    db = get_user_database()
     bullet_token, g_token = db[username][2], db[username][3]
-    matches = await Cache.graphql(bullet_token, g_token, 'latest', return_json=True)
-    # wacky list comprehension
-    battles = [node['historyDetails']['nodes'] for node in matches['data']['latestBattleHistories']['historyGroups']['nodes']][0]
-    battle = [battle for battle in battles if battle['id'] == previous_history_detail][0]
-    rank = await split_rank(battle['udemae'])
-    return rank
-
-async def find_rank_after(username: str, history_detail: str) -> str:
-    db = UserDatabase()
+    history = await Cache.graphql(bullet_token, g_token, f"{deferred_source(field, facts['lobby'])}BattleHistories", return_json=True)
+    if (found := (await _index_history(history)).get(facts['id'])) is not None:
+        if (value := await read_deferred_field(*found, facts['lobby'], field)) is not None:
+            return value
+    await pending.add(facts['uuid'], username, facts['id'], facts['lobby'], field)
+    return None
+
+async def resolve_deferred_fields(username: str) -> int:
+    """Fills in every pending field for a user with one (usually cached) history fetch per mode. Returns how many fields were resolved.
+    Run before uploading, so fields deferred on an earlier poll are filled from the history this poll just fetched."""
+    pending = get_pending_field_database()
+    rows = await pending.unresolved(username)
+    if not rows:
+        return 0
+    db = get_user_database()
     bullet_token, g_token = db[username][2], db[username][3]
-    matches = await Cache.graphql(bullet_token, g_token, 'latest', return_json=True)
-    # wacky list comprehension
-    battles = [node['historyDetails']['nodes'] for node in matches['data']['latestBattleHistories']['historyGroups']['nodes']][0]
-    battle = [battle for battle in battles if battle['id'] == history_detail][0]
-    rank = await split_rank(battle['udemae'])
-    return rank
+    histories = {}
+    for mode in {deferred_source(field, lobby) for _, _, lobby, field in rows}:
+        histories[mode] = await _index_history(await Cache.graphql(bullet_token, g_token, f'{mode}BattleHistories', return_json=True))
+    resolved = []
+    for battle_id, history_detail, lobby, field in rows:
+        found = histories[deferred_source(field, lobby)].get(history_detail)
+        if found is None:
+            continue
+        if (value := await read_deferred_field(*found, lobby, field)) is not None:
+            resolved.append((battle_id, field, value))
+    if resolved:
+        await pending.resolve(resolved)
+    return len(resolved)
 
 async def split_rank(rank):
     regex = r"([CBAS][-+]?)(\d\d?)?"
     match = re.match(regex, rank)
     return match.groups()
 
-async def fetch_uploaded_battles(stat_ink_api_key: str):
+async def fetch_uploaded_battles(stat_ink_api_key: str, username: str | None = None) -> set:
+    """Returns the uuids of every battle stat.ink has for this API key.
+    With a username, the last list is kept in main.db and only downloaded again when it changed (or the user's
+    `statink_key` did): conditionally, if stat.ink sent an ETag or Last-Modified, otherwise once every `uuid_list_ttl`
+    seconds. In between, the stored list plus the battles we uploaded ourselves is trusted."""
     headers = {
         'Authorization': f'Bearer {stat_ink_api_key}'
     }
+    key_hash = hashlib.sha256(stat_ink_api_key.encode()).hexdigest()
+    cached = await get_uuid_list_database().get(username, key_hash) if username is not None else None
+    if cached is not None:
+        _, etag, last_modified, uuids, fetched_at = cached
+        if etag is None and last_modified is None and time() - fetched_at < params.get('uuid_list_ttl', 3600):
+            metrics.increment('dynamo_uuid_list_total', result='trusted')
+            return set(uuids) | await get_upload_database().uploaded(username)
+        if etag is not None: headers['If-None-Match'] = etag
+        if last_modified is not None: headers['If-Modified-Since'] = last_modified
     with Loader('Fetching uploaded battles...', detailed=True):
         async with aiohttp.ClientSession() as session:
-            async with session.get('https://stat.ink/api/v3/s3s/uuid-list', headers=headers) as r:
-                data = await r.json()
-    return data
+            async with session.get(f'{API_BASE}/s3s/uuid-list', headers=headers) as r:
+                if r.status == 304 and cached is not None:
+                    metrics.increment('dynamo_uuid_list_total', result='not_modified')
+                    return set(cached[3])
+                data = utils.json_loads(await r.read())
+    metrics.increment('dynamo_uuid_list_total', result='downloaded')
+    if r.status == 200 and username is not None and isinstance(data, list):
+        await get_uuid_list_database().set(username, key_hash, r.headers.get('ETag'), r.headers.get('Last-Modified'), data)
+    return set(data)
 
 async def get_challenge_win_loss(username, history_detail: str, mode: str):
     assert mode in ['xmatch', 'bankara_challenge']
     if mode == 'bankara_challenge':
         mode = 'bankara'
     
-    db = UserDatabase()
+    db = get_user_database()
     bullet_token, g_token = db[username][2], db[username][3]
     matches = await graphql(bullet_token, g_token, f'{mode}', return_json=True)
-    nodes = matches['data'][[key for key in matches['data'].keys() if 'Histories' in key][0]]['nodes']
-    for node in nodes:
-        for battle in node['historyDetails']['nodes']:
-            if history_detail == battle['id']:
-                break
+    node, _ = (await _index_history(matches))[history_detail]
     measurement = node['bankaraMatchChallenge' if mode == 'bankara' else 'xMatchMeasurement']
     return measurement['winCount'], measurement['loseCount']
 
 async def get_x_power_after(username, history_detail: str):
-    db = UserDatabase()
+    db = get_user_database()
     bullet_token, g_token = db[username][2], db[username][3]
     matches = await graphql(bullet_token, g_token, 'xmatch', return_json=True)
-    nodes = matches['data'][[key for key in matches['data'].keys() if 'Histories' in key][0]]['nodes']
-    for node in nodes:
-        for battle in node['historyDetails']['nodes']:
-            if history_detail == battle['id']:
-                break
+    node, _ = (await _index_history(matches))[history_detail]
     return node['xMatchMeasurement']['xPowerAfter']
 
-async def get_anarchy_power_before(username, previous_history_detail: str | None):
+async def find_battle_bankara_power(battle_data: dict) -> int | None:
+    bankara_match = battle_data['data']['vsHistoryDetail'].get('bankaraMatch')
+    return await find_bankara_power(bankara_match) if bankara_match else None
+
+async def get_anarchy_power_before(username, previous_history_detail: str | None, previous_powers: dict | None = None):
     if previous_history_detail is None: return None
-    db = UserDatabase()
+    if previous_powers is not None and previous_history_detail in previous_powers:
+        metrics.increment('dynamo_predecessor_hits_total')
+        return previous_powers[previous_history_detail]
+    # the previous battle wasn't part of this run (oldest battle in the window), so fetch it
+    db = get_user_database()
     bullet_token, g_token = db[username][2], db[username][3]
     previous_battle = await Cache.view_battle(previous_history_detail, bullet_token, g_token)
-    return previous_battle['data']['vsHistoryDetail']['bankaraMatch']['bankaraPower']['power']
+    return await find_battle_bankara_power(previous_battle)
 
 async def format_player(player_dict: dict, rank_in_team: int) -> dict:
     new_dict = {
@@ -262,7 +442,7 @@ async def format_player(player_dict: dict, rank_in_team: int) -> dict:
         'name': player_dict['name'],
         'number': player_dict['nameId'],
         'splashtag_title': player_dict['byname'],
-        'weapon': await find_statink_weapon(player_dict['weapon']['name']),
+        'weapon': metadata.weapon_key(player_dict['weapon']),
         'inked': player_dict['paint'],
         'gears': {
             'headgear': await format_gear_structure(player_dict['headGear']),
@@ -290,8 +470,8 @@ async def format_player(player_dict: dict, rank_in_team: int) -> dict:
 
 async def format_gear_structure(gear_dict: dict) -> dict:
     new_dict = {
-        'primary_ability': await find_statink_weapon(gear_dict['primaryGearPower']['name']),
-        'secondary_abilities': [await find_statink_weapon(ability['name']) for ability in gear_dict['additionalGearPowers'] if ability['name'].lower() != 'unknown']
+        'primary_ability': metadata.ability_key(gear_dict['primaryGearPower']['name']),
+        'secondary_abilities': [metadata.ability_key(ability['name']) for ability in gear_dict['additionalGearPowers'] if ability['name'].lower() != 'unknown']
     }
     return new_dict
 
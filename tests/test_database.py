@@ -0,0 +1,192 @@
+import asyncio, os, sqlite3, stat, sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database, vault
+from config import params
+from database import Cache
+
+@pytest.fixture(autouse=True)
+def memory_storage(monkeypatch):
+    '''Keeps every test's main.db in memory, gone once `run` closes it'''
+    monkeypatch.setitem(params, 'storage', 'memory')
+    monkeypatch.setattr(Cache, 'cache', {})
+    monkeypatch.setattr(Cache, 'inflight', {})
+
+def run(check) -> None:
+    database.get_user_database() # applies nest_asyncio before the loop runs
+    async def checked():
+        try:
+            await check()
+        finally:
+            await database.close_all()
+    asyncio.run(checked())
+
+class Things(database.Database):
+    '''A table whose first migration can't run twice: the CREATE fails, and the seed row would be inserted again'''
+    def __init__(self, database_name: str):
+        self.database_name = database_name
+        self.table_name = "things"
+        self.migrations = [
+            ['CREATE TABLE things ("name" TEXT PRIMARY KEY NOT NULL)', "INSERT INTO things VALUES ('seed')"],
+            ['ALTER TABLE things ADD COLUMN "count" INTEGER NOT NULL DEFAULT 0'],
+        ]
+
+    async def rows(self) -> list:
+        async with self as database:
+            async with database.execute(f"SELECT * FROM {self.table_name}") as cursor:
+                return await cursor.fetchall()
+
+def version(path) -> int | None:
+    with sqlite3.connect(path) as connection:
+        row = connection.execute("SELECT version FROM schema_migrations WHERE component='things'").fetchone()
+    return row[0] if row is not None else None
+
+def test_migrations_run_once_in_order(monkeypatch, tmp_path):
+    monkeypatch.setitem(params, 'storage', 'sqlite')
+    path = str(tmp_path / 'main.db')
+    async def check():
+        assert await Things(path).rows() == [('seed', 0)]
+        await database.close_all()
+        # a new connection checks schema_migrations again, and finds nothing left to run
+        assert await Things(path).rows() == [('seed', 0)]
+    run(check)
+    assert version(path) == 2
+
+def test_migrations_upgrade_a_partially_migrated_database(monkeypatch, tmp_path):
+    monkeypatch.setitem(params, 'storage', 'sqlite')
+    path = str(tmp_path / 'main.db')
+    with sqlite3.connect(path) as connection:
+        connection.execute('CREATE TABLE schema_migrations ("component" TEXT PRIMARY KEY NOT NULL, "version" INTEGER NOT NULL)')
+        connection.execute("INSERT INTO schema_migrations VALUES ('things', 1)")
+        connection.execute('CREATE TABLE things ("name" TEXT PRIMARY KEY NOT NULL)')
+        connection.execute("INSERT INTO things VALUES ('old')")
+    async def check():
+        assert await Things(path).rows() == [('old', 0)]
+    run(check)
+    assert version(path) == 2
+
+def test_migrations_rerun_after_an_in_memory_database_is_reopened():
+    async def check():
+        assert await Things('main.db').rows() == [('seed', 0)]
+        await database.close_all()
+        assert await Things('main.db').rows() == [('seed', 0)]
+    run(check)
+
+def test_concurrent_migrations_wait_for_each_other(tmp_path):
+    path = str(tmp_path / 'main.db')
+    things = Things(path)
+    # two backends on one file, like two fleet workers starting at once
+    backends = [database.SQLiteBackend(path), database.SQLiteBackend(path)]
+    async def check():
+        try:
+            await asyncio.gather(*[backend.migrate(things.table_name, things.migrations) for backend in backends])
+        finally:
+            for backend in backends:
+                await backend.close()
+    asyncio.run(check())
+    assert version(path) == 2
+    with sqlite3.connect(path) as connection:
+        assert connection.execute("SELECT * FROM things").fetchall() == [('seed', 0)]
+
+def test_single_flight_shares_one_fetch():
+    calls = []
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+    async def check():
+        assert await asyncio.gather(*[Cache.single_flight('key', fetch) for _ in range(5)]) == [1] * 5
+        assert Cache.inflight == {}
+        assert await Cache.single_flight('key', fetch) == 2
+    asyncio.run(check())
+
+def test_single_flight_raises_to_every_caller_and_caches_nothing():
+    calls = []
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        if len(calls) == 1:
+            raise ValueError('boom')
+        return 'ok'
+    async def check():
+        results = await asyncio.gather(*[Cache.single_flight('key', fetch) for _ in range(3)], return_exceptions=True)
+        assert [type(result) for result in results] == [ValueError] * 3
+        assert await Cache.single_flight('key', fetch) == 'ok'
+    asyncio.run(check())
+
+def test_single_flight_takes_over_from_a_cancelled_fetch():
+    async def fetch():
+        await asyncio.sleep(0.01)
+        return 'ok'
+    async def check():
+        first = asyncio.create_task(Cache.single_flight('key', fetch))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(Cache.single_flight('key', fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == 'ok'
+        with pytest.raises(asyncio.CancelledError):
+            await first
+    asyncio.run(check())
+
+def test_cached_graphql_is_fetched_once(monkeypatch):
+    import splatnet
+    calls = []
+    async def graphql(bullet_token, g_token, query, return_json=False):
+        calls.append(query)
+        await asyncio.sleep(0.01)
+        return {'data': {'query': query}}
+    monkeypatch.setattr(splatnet, 'graphql', graphql)
+    async def check():
+        responses = await asyncio.gather(*[Cache.graphql('b', 'g', 'latestBattleHistories', return_json=True) for _ in range(3)])
+        assert responses == [{'data': {'query': 'latestBattleHistories'}}] * 3
+        await Cache.graphql('b', 'g', 'latestBattleHistories', return_json=True)
+        assert calls == ['latestBattleHistories']
+    asyncio.run(check())
+
+@pytest.fixture
+def vault_key(monkeypatch, tmp_path):
+    '''Turns the vault on with a fresh key file'''
+    pytest.importorskip('cryptography')
+    monkeypatch.delenv(vault.KEY_ENVIRONMENT, raising=False)
+    monkeypatch.setitem(params, 'vault', True)
+    monkeypatch.setitem(params, 'vault_keyfile', str(tmp_path / 'vault.key'))
+    monkeypatch.setattr(vault.Vault, 'fernet', None)
+    monkeypatch.setattr(vault.Vault, 'rows', {})
+    return tmp_path / 'vault.key'
+
+ROW: tuple = ('alice', 'session', 'bullet', 'g', '{}', 'statink')
+
+def test_vault_seals_only_credentials(vault_key):
+    sealed = vault.seal(ROW)
+    assert stat.S_IMODE(os.stat(vault_key).st_mode) == 0o600
+    assert [value.startswith(vault.PREFIX) for value in sealed] == [False, True, True, True, False, True]
+    assert vault.open_row(sealed) == ROW
+    assert vault.open_row(ROW) == ROW # written before the vault was on
+
+def test_vault_refuses_another_key(vault_key, monkeypatch):
+    sealed = vault.seal(ROW)
+    monkeypatch.setattr(vault.Vault, 'fernet', None)
+    vault_key.write_bytes(vault._cryptography().Fernet.generate_key())
+    with pytest.raises(RuntimeError):
+        vault.open_row(sealed)
+
+def test_reseal_encrypts_and_decrypts_every_user(vault_key, monkeypatch):
+    monkeypatch.setitem(params, 'vault', False)
+    db = database.get_user_database()
+    async def stored() -> list:
+        return [row[1] for row in await db.list()]
+    async def check():
+        await db.set('alice', dict(zip(['session_token', 'bullet_token', 'g_token', 'user_data', 'statink_key'], ROW[1:])))
+        assert await stored() == ['session']
+        monkeypatch.setitem(params, 'vault', True)
+        assert await db.reseal() == 1
+        assert (await stored())[0].startswith(vault.PREFIX)
+        assert await db.get('alice') == ROW
+        monkeypatch.setitem(params, 'vault', False)
+        await db.reseal()
+        assert await stored() == ['session']
+    run(check)
@@ -0,0 +1,81 @@
+import asyncio, os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database, nso, presence, splatnet
+from aiohttp import web
+from config import params
+
+FRIENDS: dict = {'data': {'friends': {'nodes': [
+    {'id': 'RnJpZW5kLWE=', 'nickname': 'Alice', 'playerName': 'Alice', 'onlineState': 'VS_MODE_FIGHTING'},
+    {'id': 'RnJpZW5kLWI=', 'nickname': 'Bee', 'playerName': 'Bumble', 'onlineState': 'OFFLINE'},
+]}}}
+
+@pytest.fixture(autouse=True)
+def memory_storage(monkeypatch):
+    '''Keeps every test's users in an in-memory main.db, gone once `run` closes it'''
+    monkeypatch.setitem(params, 'storage', 'memory')
+
+async def with_splatnet(check) -> None:
+    '''Runs `check` against a stand-in for SplatNet that answers the friends query for bullet token "good" and 401s anything else'''
+    async def graphql(request: web.Request) -> web.Response:
+        if request.headers.get('Authorization') != 'Bearer good':
+            return web.Response(status=401)
+        return web.json_response(FRIENDS)
+    app = web.Application()
+    app.router.add_post('/api/graphql', graphql)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    url, nso.SPLATNET_URL = nso.SPLATNET_URL, f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+    try:
+        await check()
+    finally:
+        nso.SPLATNET_URL = url
+        await runner.cleanup()
+        await database.close_all()
+
+def run(check) -> None:
+    database.get_user_database() # applies nest_asyncio before the loop runs
+    asyncio.run(with_splatnet(check))
+
+async def add_observer(bullet_token: str) -> None:
+    await database.get_user_database().set('observer', {
+        'session_token': 's', 'bullet_token': bullet_token, 'g_token': 'g', 'user_data': '{}', 'statink_key': None,
+    })
+
+def test_friend_states_reads_a_live_response():
+    async def check():
+        await add_observer('good')
+        assert await presence.friend_states('observer') == {'Alice': 'VS_MODE_FIGHTING', 'Bee': 'OFFLINE', 'Bumble': 'OFFLINE'}
+    run(check)
+
+def test_friend_states_regenerates_expired_tokens(monkeypatch):
+    async def regenerate(username: str) -> bool:
+        await database.get_user_database().set(username, {'bullet_token': 'good'})
+        return True
+    monkeypatch.setattr(splatnet, 'check_tokens_and_regenerate', regenerate)
+    async def check():
+        await add_observer('expired')
+        assert (await presence.friend_states('observer'))['Alice'] == 'VS_MODE_FIGHTING'
+    run(check)
+
+def test_friend_states_gives_up_when_tokens_stay_invalid(monkeypatch):
+    async def regenerate(username: str) -> bool:
+        return True
+    monkeypatch.setattr(splatnet, 'check_tokens_and_regenerate', regenerate)
+    async def check():
+        await add_observer('expired')
+        assert await presence.friend_states('observer') is None
+    run(check)
+
+def test_due(monkeypatch):
+    monkeypatch.setitem(params, 'refresh', 60)
+    assert presence.due(None, 'OFFLINE', None)
+    assert presence.due('VS_MODE_FIGHTING', 'VS_MODE_MATCHING', 0, now=1)
+    assert not presence.due('ONLINE', 'ONLINE', 0, now=1)
+    assert not presence.due('VS_MODE_MATCHING', 'VS_MODE_MATCHING', 0, now=30)
+    assert presence.due('VS_MODE_MATCHING', 'VS_MODE_MATCHING', 0, now=61)
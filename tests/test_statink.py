@@ -0,0 +1,155 @@
+import asyncio, os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database, splatnet, statink
+from aiohttp import web
+from config import params
+from database import Cache, get_pending_field_database, get_upload_database
+
+@pytest.fixture(autouse=True)
+def memory_storage(monkeypatch):
+    '''Keeps every test's main.db in memory, gone once `run` closes it'''
+    monkeypatch.setitem(params, 'storage', 'memory')
+    monkeypatch.setattr(Cache, 'cache', {})
+    monkeypatch.setattr(Cache, 'inflight', {})
+
+def run(check) -> None:
+    database.get_user_database() # applies nest_asyncio before the loop runs
+    async def checked():
+        try:
+            await database.get_user_database().set('alice', {
+                'session_token': 's', 'bullet_token': 'b', 'g_token': 'g', 'user_data': '{}', 'statink_key': 'key',
+            })
+            await check()
+        finally:
+            await database.close_all()
+    asyncio.run(checked())
+
+def history(query: str, battles: list, **group) -> dict:
+    '''A battle history response with one group holding `battles`'''
+    return {'data': {query: {'historyGroups': {'nodes': [{**group, 'historyDetails': {'nodes': battles}}]}}}}
+
+@pytest.fixture
+def histories(monkeypatch) -> dict:
+    '''What the stand-in for SplatNet answers each history query with, and how often each was asked for'''
+    responses = {'asked': []}
+    async def graphql(bullet_token, g_token, query, return_json=False):
+        responses['asked'].append(query)
+        return responses[query]
+    monkeypatch.setattr(splatnet, 'graphql', graphql)
+    return responses
+
+FACTS: dict = {'uuid': 'uuid-2', 'id': 'battle-2', 'lobby': 'bankara_challenge'}
+
+def test_deferred_fields_are_read_from_their_history():
+    group = {'bankaraMatchChallenge': {'winCount': 3, 'loseCount': 1}, 'xMatchMeasurement': {'winCount': 2, 'loseCount': 0, 'xPowerAfter': 2000.5}}
+    async def check():
+        assert await statink.read_deferred_field(group, {'udemae': 'S+12'}, 'bankara_challenge', 'rank_after') == ('S+', '12')
+        assert await statink.read_deferred_field(group, {'udemae': None}, 'bankara_challenge', 'rank_after') is None
+        assert await statink.read_deferred_field(group, {}, 'bankara_challenge', 'challenge_win_lose') == [3, 1]
+        assert await statink.read_deferred_field(group, {}, 'xmatch', 'challenge_win_lose') == [2, 0]
+        assert await statink.read_deferred_field(group, {}, 'xmatch', 'x_power_after') == 2000.5
+        assert await statink.read_deferred_field({}, {}, 'xmatch', 'x_power_after') is None
+    asyncio.run(check())
+    assert statink.deferred_source('rank_after', 'bankara_open') == 'latest'
+    assert statink.deferred_source('challenge_win_lose', 'xmatch') == 'x'
+    assert statink.deferred_source('challenge_win_lose', 'bankara_challenge') == 'bankara'
+
+def test_known_fields_are_returned_without_deferring(histories):
+    histories['latestBattleHistories'] = history('latestBattleHistories', [{'id': 'battle-2', 'udemae': 'A-'}, {'id': 'battle-1', 'udemae': 'B+'}])
+    async def check():
+        assert await statink.resolve_or_defer('alice', FACTS, 'rank_after', None) == ('A-', None)
+        assert await get_pending_field_database().get('uuid-2') == {}
+        # the same cached response answers the rank before
+        assert await statink.find_rank_before('alice', 'battle-1') == ('B+', None)
+        assert await statink.find_rank_after('alice', 'battle-0') is None
+        assert histories['asked'] == ['latestBattleHistories']
+    run(check)
+
+def test_missing_fields_are_resolved_on_a_later_poll(histories):
+    histories['bankaraBattleHistories'] = history('bankaraBattleHistories', [{'id': 'battle-2'}])
+    async def check():
+        assert await statink.resolve_or_defer('alice', FACTS, 'challenge_win_lose', None) is None
+        assert await get_pending_field_database().get('uuid-2') == {'challenge_win_lose': None}
+        assert await statink.resolve_deferred_fields('alice') == 0
+        # the next poll's history has the challenge's progress
+        histories['bankaraBattleHistories'] = history('bankaraBattleHistories', [{'id': 'battle-2'}], bankaraMatchChallenge={'winCount': 4, 'loseCount': 2})
+        Cache.cache.clear()
+        assert await statink.resolve_deferred_fields('alice') == 1
+        assert await get_pending_field_database().get('uuid-2') == {'challenge_win_lose': [4, 2]}
+        assert await statink.resolve_or_defer('alice', FACTS, 'challenge_win_lose', None) == [4, 2]
+    run(check)
+
+def test_fields_are_resolved_inline_when_deferring_is_off(monkeypatch):
+    monkeypatch.setitem(params, 'defer_fields', False)
+    async def resolve():
+        return 'inline'
+    async def check():
+        assert await statink.resolve_or_defer('alice', FACTS, 'rank_after', resolve) == 'inline'
+    run(check)
+
+@pytest.fixture
+def uuid_list(monkeypatch) -> dict:
+    '''A stand-in for stat.ink's uuid-list. Set 'uuids' and 'headers' to change what it answers; 'requests' has the headers of each request.'''
+    state = {'uuids': {'Bearer key': ['a', 'b']}, 'headers': {}, 'requests': []}
+    async def handler(request: web.Request) -> web.Response:
+        state['requests'].append(dict(request.headers))
+        etag = state['headers'].get('ETag')
+        if etag is not None and request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304)
+        return web.json_response(state['uuids'][request.headers['Authorization']], headers=state['headers'])
+    async def start() -> web.AppRunner:
+        app = web.Application()
+        app.router.add_get('/api/v3/s3s/uuid-list', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        monkeypatch.setattr(statink, 'API_BASE', f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/api/v3')
+        return runner
+    state['start'] = start
+    return state
+
+def test_uuid_list_is_revalidated_with_its_etag(uuid_list):
+    uuid_list['headers'] = {'ETag': '"1"'}
+    async def check():
+        runner = await uuid_list['start']()
+        try:
+            assert await statink.fetch_uploaded_battles('key', 'alice') == {'a', 'b'}
+            assert await statink.fetch_uploaded_battles('key', 'alice') == {'a', 'b'}
+            assert [request.get('If-None-Match') for request in uuid_list['requests']] == [None, '"1"']
+        finally:
+            await runner.cleanup()
+    run(check)
+
+def test_uuid_list_without_validators_is_trusted_until_its_ttl(uuid_list, monkeypatch):
+    async def check():
+        runner = await uuid_list['start']()
+        try:
+            assert await statink.fetch_uploaded_battles('key', 'alice') == {'a', 'b'}
+            await get_upload_database().set('c', 'alice', 'hash', True, None)
+            # trusted, plus what was uploaded since
+            assert await statink.fetch_uploaded_battles('key', 'alice') == {'a', 'b', 'c'}
+            assert len(uuid_list['requests']) == 1
+            monkeypatch.setitem(params, 'uuid_list_ttl', 0)
+            assert await statink.fetch_uploaded_battles('key', 'alice') == {'a', 'b'}
+            assert len(uuid_list['requests']) == 2
+        finally:
+            await runner.cleanup()
+    run(check)
+
+def test_uuid_list_is_downloaded_again_for_a_new_key(uuid_list):
+    uuid_list['headers'] = {'ETag': '"1"'}
+    uuid_list['uuids']['Bearer other'] = ['z']
+    async def check():
+        runner = await uuid_list['start']()
+        try:
+            assert await statink.fetch_uploaded_battles('key', 'alice') == {'a', 'b'}
+            assert await statink.fetch_uploaded_battles('other', 'alice') == {'z'}
+            assert [request.get('If-None-Match') for request in uuid_list['requests']] == [None, None]
+        finally:
+            await runner.cleanup()
+    run(check)
@@ -1,14 +1,44 @@
 import base64
-import builtins
-import threading
+import importlib.util
+import json
+import re
+import sys
 import uuid
-from time import sleep
-from sys import stdout
 
 from config import params
 
 NAMESPACE = uuid.UUID('b3a2dbf5-2c09-4792-b78c-00b548b70aeb')
 
+def lazy_import(name: str):
+    """Returns a module that is only actually imported the first time one of its attributes is used"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+_loads = None
+
+def json_loads(raw: bytes | str):
+    """Decodes JSON with orjson when it's installed (and the `json_backend` config allows it), otherwise the stdlib"""
+    global _loads
+    if _loads is None:
+        _loads = json.loads
+        if params.get('json_backend', 'auto') in ['auto', 'orjson']:
+            try:
+                import orjson
+                _loads = orjson.loads
+            except ImportError:
+                if params.get('json_backend') == 'orjson':
+                    raise
+    return _loads(raw)
+
 async def decode_b64(b64: str) -> str:
     return base64.b64decode(b64).decode('utf-8')
 
@@ -16,6 +46,20 @@ async def decode_battle_id(b64: str) -> str:
     decoded = await decode_b64(b64)
     return str(uuid.uuid5(NAMESPACE, decoded[-52:]))
 
+def run_sync(coroutine):
+    """Runs a coroutine that never actually suspends (like the formatting helpers) to completion without an event loop"""
+    try:
+        coroutine.send(None)
+    except StopIteration as e:
+        return e.value
+    coroutine.close()
+    raise RuntimeError('run_sync was given a coroutine that suspends')
+
+def battle_played_at(b64: str) -> str:
+    """Returns the YYYYMMDDTHHMMSS timestamp embedded in a SplatNet battle id, for sorting battles chronologically"""
+    match = re.search(r':(\d{8}T\d{6})_', base64.b64decode(b64).decode('utf-8'))
+    return match.group(1) if match else ''
+
 async def rgba_to_hex(color_dict: dict) -> str:
     r = round(color_dict['r'] * 255)
     g = round(color_dict['g'] * 255)
@@ -29,12 +73,3 @@ def freakify(text: str) -> str:
     base = "abcdefghijklmnopqrstuvwxyzABCDEFGHJIKLMNOPQRSTUVWXYZ"
     lookup = "𝓪𝓫𝓬𝓭𝓮𝓯𝓰𝓱𝓲𝓳𝓴𝓵𝓶𝓷𝓸𝓹𝓺𝓻𝓼𝓽𝓾𝓿𝔀𝔁𝔂𝔃𝓐𝓑𝓒𝓓𝓔𝓕𝓖𝓗𝓙𝓘𝓚𝓛𝓜𝓝𝓞𝓟𝓠𝓡𝓢𝓣𝓤𝓥𝓦𝓧𝓨𝓩"
     return text.translate(str.maketrans(base, lookup))
-
-old_print = builtins.print
-def new_print(*args, **kwargs):
-    if params['freaky']:
-        old_print(freakify(*args), **kwargs)
-    else:
-        old_print(*args, **kwargs)
-
-builtins.print = new_print
\ No newline at end of file
@@ -0,0 +1,86 @@
+import os
+from time import monotonic
+
+from config import params
+
+# UserDatabase columns holding credentials: session_token, bullet_token, g_token, statink_key
+SECRET_COLUMNS: tuple = (1, 2, 3, 5)
+# marks an encrypted value, so rows written before the vault was turned on still read as plaintext
+PREFIX: str = 'vault1:'
+# where the key is read from before `vault_keyfile`. Either has to hold a key from `Fernet.generate_key()`
+KEY_ENVIRONMENT: str = 'DYNAMO_VAULT_KEY'
+
+class Vault:
+    '''Process-wide credential state: the cipher, and decrypted rows that are only kept for `vault_cache_ttl` seconds'''
+    fernet = None
+    rows: dict = {}
+    """ formatted as {username: (decrypted row, monotonic time it expires)} """
+
+def _cryptography():
+    try:
+        from cryptography import fernet
+        return fernet
+    except ImportError:
+        raise RuntimeError("The vault needs cryptography. Install it with `pip install cryptography`, or turn `vault` off.")
+
+def load_key() -> bytes:
+    '''Returns the key from DYNAMO_VAULT_KEY, or from `vault_keyfile`, generating that file if it doesn't exist yet'''
+    if key := os.environ.get(KEY_ENVIRONMENT):
+        return key.encode()
+    path = params.get('vault_keyfile', 'vault.key')
+    if not os.path.exists(path):
+        key = _cryptography().Fernet.generate_key()
+        # readable by this user only, and never overwrite a key someone else just wrote
+        descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(descriptor, 'wb') as fp:
+            fp.write(key)
+        return key
+    with open(path, 'rb') as fp:
+        return fp.read().strip()
+
+def _fernet():
+    if Vault.fernet is None:
+        Vault.fernet = _cryptography().Fernet(load_key())
+    return Vault.fernet
+
+def encrypt(value: str | None) -> str | None:
+    if value is None or not params.get('vault'):
+        return value
+    return PREFIX + _fernet().encrypt(value.encode()).decode()
+
+def decrypt(value: str | None) -> str | None:
+    '''Decrypts a vault value. Anything else is plaintext, and returned as it is.'''
+    if not isinstance(value, str) or not value.startswith(PREFIX):
+        return value
+    try:
+        return _fernet().decrypt(value[len(PREFIX):].encode()).decode()
+    except _cryptography().InvalidToken:
+        raise RuntimeError(f"Couldn't decrypt a stored credential. Is {KEY_ENVIRONMENT} or `vault_keyfile` the key it was encrypted with?")
+
+def seal(row: tuple) -> tuple:
+    '''Encrypts a users row's credential columns (if `vault` is on) for writing'''
+    return tuple(encrypt(value) if index in SECRET_COLUMNS else value for index, value in enumerate(row))
+
+def open_row(row: tuple) -> tuple:
+    return tuple(decrypt(value) if index in SECRET_COLUMNS else value for index, value in enumerate(row))
+
+def recall(username: str) -> tuple | None:
+    '''Returns a user's decrypted row if it was read in the last `vault_cache_ttl` seconds'''
+    entry = Vault.rows.get(username)
+    if entry is None:
+        return None
+    if entry[1] <= monotonic():
+        del Vault.rows[username]
+        return None
+    return entry[0]
+
+def remember(username: str, row: tuple) -> None:
+    if (ttl := params.get('vault_cache_ttl', 30)) > 0:
+        Vault.rows[username] = (row, monotonic() + ttl)
+
+def forget(username: str | None = None) -> None:
+    '''Drops one user's cached row, or everyone's'''
+    if username is None:
+        Vault.rows.clear()
+    else:
+        Vault.rows.pop(username, None)
@@ -0,0 +1,239 @@
+import asyncio, html, secrets, sys
+from urllib.parse import quote, urlsplit
+from collections import deque
+from time import time
+
+import dynamo, events, nso, planner
+from config import params
+from database import get_user_database
+
+# seconds of battle_uploaded events that throughput is averaged over
+THROUGHPUT_WINDOW: int = 300
+# login links handed out but not used yet. the oldest ones expire past this
+MAX_PENDING_LOGINS: int = 32
+
+class Account:
+    '''What the dashboard knows about one user. Kept up to date from the event bus, never read back from SQLite.'''
+    __slots__ = ('username', 'task', 'state', 'queued', 'remaining', 'uploaded', 'last_sync', 'last_error', 'recent')
+
+    def __init__(self, username: str) -> None:
+        self.username = username
+        self.task: asyncio.Task | None = None
+        self.state = 'stopped'
+        self.queued = self.remaining = self.uploaded = 0
+        self.last_sync: float | None = None
+        self.last_error: str | None = None
+        self.recent = deque()
+
+    def throughput(self) -> float:
+        '''Battles uploaded per minute over the last THROUGHPUT_WINDOW seconds'''
+        while self.recent and self.recent[0] < time() - THROUGHPUT_WINDOW:
+            self.recent.popleft()
+        return len(self.recent) * 60 / THROUGHPUT_WINDOW
+
+    def status(self) -> dict:
+        return {
+            'username': self.username, 'state': self.state, 'queued': self.queued, 'remaining': self.remaining,
+            'uploaded': self.uploaded, 'per_minute': round(self.throughput(), 2),
+            'last_sync': self.last_sync, 'last_error': self.last_error,
+        }
+
+class Controller:
+    '''Per-user sync tasks for the control server, running on the same event loop as everything else'''
+    accounts: dict = {}
+    follower: asyncio.Task | None = None
+    logins: dict = {}
+    """ LoginManagers waiting for their second step, formatted as {login id: LoginManager} """
+
+    @staticmethod
+    def account(username: str) -> Account:
+        if username not in Controller.accounts:
+            Controller.accounts[username] = Account(username)
+        return Controller.accounts[username]
+
+    @staticmethod
+    def start(username: str) -> None:
+        '''Keeps syncing a user every `refresh` seconds until stopped'''
+        Controller.stop(username)
+        account = Controller.account(username)
+        account.state = 'monitoring'
+        account.task = asyncio.create_task(Controller._run(account, check_all=False, repeat=True))
+
+    @staticmethod
+    def backfill(username: str) -> None:
+        '''Syncs every mode once, then goes back to monitoring if it was'''
+        account = Controller.account(username)
+        repeat = account.state == 'monitoring'
+        Controller.stop(username)
+        account.state = 'backfilling'
+        account.task = asyncio.create_task(Controller._run(account, check_all=True, repeat=repeat))
+
+    @staticmethod
+    def stop(username: str) -> None:
+        account = Controller.account(username)
+        if account.task is not None and not account.task.done():
+            account.task.cancel()
+        account.task, account.state = None, 'stopped'
+
+    @staticmethod
+    async def _run(account: Account, check_all: bool, repeat: bool) -> None:
+        while True:
+            try:
+                await dynamo.find_and_upload_missing_battles(account.username, check_all=check_all)
+                account.last_error = None
+            except Exception as e:
+                account.last_error = repr(e)
+                print(f"Failed to sync {account.username}: {e!r}", file=sys.stderr)
+            account.last_sync = time()
+            if not repeat:
+                account.state, account.task = 'stopped', None
+                return
+            account.state, check_all = 'monitoring', False
+            await asyncio.sleep(await planner.next_interval(account.username))
+
+    @staticmethod
+    async def follow() -> None:
+        '''Applies sync events to the in-memory accounts. Runs until cancelled.'''
+        queue = events.subscribe()
+        try:
+            while True:
+                event = await queue.get()
+                if 'username' not in event:
+                    continue
+                account = Controller.account(event['username'])
+                match event['type']:
+                    case 'sync_started':
+                        account.queued = account.remaining = event['queued']
+                    case 'sync_progress':
+                        account.remaining = event['remaining']
+                    case 'battle_uploaded':
+                        account.uploaded += 1
+                        account.recent.append(event['time'])
+        finally:
+            events.unsubscribe(queue)
+
+def _web():
+    from aiohttp import web
+    return web
+
+def _authorized(request) -> bool:
+    token = params.get('web_token')
+    if not token:
+        return True
+    given = request.headers.get('Authorization', '').removeprefix('Bearer ') or request.query.get('token', '')
+    return secrets.compare_digest(given, token)
+
+def _same_origin(request) -> bool:
+    '''Whether a POST came from the dashboard itself. Browsers send Origin (or at least Referer) with form posts, so a page
+    elsewhere can't start, stop or log in accounts through the user's browser. Clients that send neither (curl, scripts) aren't browsers.'''
+    source = request.headers.get('Origin') or request.headers.get('Referer')
+    if source is None:
+        return True
+    return source != 'null' and urlsplit(source).netloc == request.host
+
+def _done(request, result: dict):
+    '''Answers a control request: JSON for API clients, back to the dashboard for the HTML forms'''
+    web = _web()
+    if request.content_type == 'application/x-www-form-urlencoded':
+        raise web.HTTPSeeOther('/' + (f"?token={quote(request.query['token'])}" if 'token' in request.query else ''))
+    return web.json_response(result)
+
+async def dashboard(request):
+    token = f"?token={quote(request.query['token'])}" if 'token' in request.query else ''
+    rows = []
+    for account in Controller.accounts.values():
+        status = account.status()
+        buttons = ''.join(
+            f'<form method="post" action="/api/accounts/{quote(account.username)}/{action}{token}"><button>{action}</button></form>'
+            for action in ['start', 'stop', 'backfill'])
+        last_sync = '' if status['last_sync'] is None else f"{int(time() - status['last_sync'])}s ago"
+        rows.append(f"<tr><td>{html.escape(account.username)}</td><td>{status['state']}</td><td>{status['remaining']}/{status['queued']}</td>"
+                    f"<td>{status['uploaded']}</td><td>{status['per_minute']}</td><td>{last_sync}</td>"
+                    f"<td>{html.escape(status['last_error'] or '')}</td><td>{buttons}</td></tr>")
+    return _web().Response(content_type='text/html', text=f'''<!doctype html>
+<html><head><meta http-equiv="refresh" content="5"><title>Dynamo</title>
+<style>body{{font-family:sans-serif}} td,th{{padding:4px 8px;text-align:left}} form{{display:inline}}</style></head>
+<body><h1>Dynamo</h1><p><a href="/login{token}">Add a user</a></p>
+<table><tr><th>User</th><th>State</th><th>Queue</th><th>Uploaded</th><th>Per minute</th><th>Last sync</th><th>Last error</th><th></th></tr>
+{''.join(rows)}</table></body></html>''')
+
+async def status(request):
+    return _web().json_response({'accounts': [account.status() for account in Controller.accounts.values()]})
+
+async def control(request):
+    web = _web()
+    username, action = request.match_info['username'], request.match_info['action']
+    if username not in Controller.accounts:
+        raise web.HTTPNotFound(text=f'Unknown user {username}')
+    match action:
+        case 'start': Controller.start(username)
+        case 'stop': Controller.stop(username)
+        case 'backfill': Controller.backfill(username)
+        case _: raise web.HTTPNotFound(text=f'Unknown action {action}')
+    return _done(request, Controller.accounts[username].status())
+
+async def login_page(request):
+    '''Step one of nso.LoginManager: hands out the Nintendo login link'''
+    login_id = secrets.token_urlsafe(16)
+    Controller.logins[login_id] = manager = nso.LoginManager()
+    while len(Controller.logins) > MAX_PENDING_LOGINS:
+        del Controller.logins[next(iter(Controller.logins))]
+    token = f"?token={quote(request.query['token'])}" if 'token' in request.query else ''
+    return _web().Response(content_type='text/html', text=f'''<!doctype html>
+<html><head><title>Dynamo - add a user</title></head><body><h1>Add a user</h1>
+<p>Please consider reading through the "Token Generation" section in the README before proceeding.</p>
+<ol><li>Log in at <a href="{html.escape(manager.login_url)}" target="_blank">Nintendo Accounts</a>.</li>
+<li>Right click the "Select this account" button, copy the link address, and paste it below.</li></ol>
+<form method="post" action="/login{token}"><input type="hidden" name="login_id" value="{login_id}">
+<p><input name="link" size="80" placeholder="npf71b963c1b7b6d119://auth#..." required></p>
+<p><input name="statink_key" size="50" placeholder="stat.ink API key"></p>
+<button>Log in</button></form></body></html>''')
+
+async def login(request):
+    '''Step two of nso.LoginManager: exchanges the pasted link for tokens, saves the user, and starts monitoring them'''
+    web = _web()
+    form = await request.post()
+    manager = Controller.logins.pop(form.get('login_id', ''), None)
+    if manager is None:
+        raise web.HTTPBadRequest(text='This login link expired, start again from /login')
+    username, session_token, bullet_token, g_token, user_data, _ = await manager.login(form['link'])
+    await get_user_database().set(username, {
+        'session_token': session_token,
+        'bullet_token': bullet_token,
+        'g_token': g_token,
+        'user_data': user_data,
+        'statink_key': form.get('statink_key') or None
+    })
+    Controller.start(username)
+    return _done(request, Controller.accounts[username].status())
+
+def create_app():
+    web = _web()
+    @web.middleware
+    async def authorize(request, handler):
+        if not _authorized(request):
+            raise web.HTTPUnauthorized(text='Set the web_token as ?token= or a Bearer token')
+        if request.method == 'POST' and not _same_origin(request):
+            raise web.HTTPForbidden(text='Cross-origin requests to the control server are not allowed')
+        return await handler(request)
+    app = web.Application(middlewares=[authorize])
+    app.router.add_get('/', dashboard)
+    app.router.add_get('/api/status', status)
+    app.router.add_post('/api/accounts/{username}/{action}', control)
+    app.router.add_get('/login', login_page)
+    app.router.add_post('/login', login)
+    app.router.add_get('/events', events.sse_handler)
+    return app
+
+async def serve(host: str = '127.0.0.1', port: int = 8080, start_all: bool = False):
+    '''Starts the control server on the running event loop. Returns the runner so the caller can clean it up.'''
+    web = _web()
+    for username in await dynamo.get_users():
+        Controller.account(username)
+        if start_all:
+            Controller.start(username)
+    Controller.follower = asyncio.create_task(Controller.follow())
+    runner = web.AppRunner(create_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner